@@ -13,6 +13,8 @@ import numpy as np
 import os
 import matplotlib.pyplot as plt
 
+from tools.manifest import Manifest
+
 plt.switch_backend('Agg')
 plt.ioff()
 
@@ -217,14 +219,13 @@ if __name__ == '__main__':
                         analysis_hist[set_type] = []
 
                         # Iterate over all available classes
-                        for category in glob(os.path.join(set_type_path, '*')):
-                            if os.path.isdir(category):
-                                category_name = os.path.basename(category)
-                                # Get the number of images in this directory (dataset/set_type/category)
-                                num_elems = len(os.listdir(category))
-                                # Put it in the results placeholder
-                                analysis_res[set_type].update({category_name: num_elems})
-                                analysis_hist[set_type].append(num_elems)
+                        manifest = Manifest.load(set_type_path)
+                        for category_name in manifest.subdir_names():
+                            # Get the number of images in this directory (dataset/set_type/category)
+                            num_elems = len(manifest.list_files(category_name))
+                            # Put it in the results placeholder
+                            analysis_res[set_type].update({category_name: num_elems})
+                            analysis_hist[set_type].append(num_elems)
 
                     # Detection
                     elif dataset_type == 'detection':
@@ -234,7 +235,8 @@ if __name__ == '__main__':
                         bb_areas[set_type] = []
 
                         # Iterate over all annotation files
-                        for annotation in glob(os.path.join(set_type_path, '*.txt')):
+                        for annotation in Manifest.load(set_type_path).list_files(filter=lambda f: f.endswith('.txt')):
+                            annotation = os.path.join(set_type_path, annotation)
                             # Read the file, and for each instance of a class, store it in the results dictionaries
                             f = open(annotation, mode='rb')
                             for line in f.readlines():
@@ -261,7 +263,8 @@ if __name__ == '__main__':
 
                     # Segmentation
                     elif dataset_type == 'segmentation':
-                        all_masks = glob(os.path.join(set_type_path, 'masks', '*'))
+                        mask_path = os.path.join(set_type_path, 'masks')
+                        all_masks = [os.path.join(mask_path, f) for f in Manifest.load(mask_path).list_files(filter=lambda f: not f.startswith('.'))]
                         num_masks = len(all_masks)
                         for ind, mask in enumerate(all_masks):
                             # Load mask
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import argparse
+import imp
+import multiprocessing
+import os
+import resource
+import time
+
+from tools.data_loader import ImageDataGenerator, list_subdirs
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+"""
+    Measures the throughput and the memory of the DirectoryIterator of a
+    dataset split with several loader settings. Every setting runs in its own
+    process, so the peak memory of one does not hide the others.
+"""
+
+
+# Build the iterator of a split with the given loader settings
+def make_iterator(dataset_path, split, size, batch_size, **loader_args):
+    dataset_config = imp.load_source('config_dataset', os.path.join(dataset_path, 'config.py'))
+    class_mode = dataset_config.class_mode
+    if dataset_config.classes:
+        classes = dataset_config.classes
+    else:
+        classes = None
+
+    split_path = os.path.join(dataset_path, split)
+    if class_mode == 'segmentation':
+        directory = os.path.join(split_path, 'images')
+        gt_directory = os.path.join(split_path, 'masks')
+    else:
+        directory, gt_directory = split_path, None
+        if not classes:
+            classes = dict(enumerate(list_subdirs(split_path)))
+
+    dg = ImageDataGenerator(class_mode=class_mode, dim_ordering='th',
+                            void_label=dataset_config.void_class[0] if dataset_config.void_class else None,
+                            yolo=class_mode == 'detection')
+    return dg.flow_from_directory(directory, gt_directory=gt_directory,
+                                  resize=size, target_size=size,
+                                  color_mode=dataset_config.color_mode,
+                                  classes=classes, class_mode=class_mode,
+                                  batch_size=batch_size, shuffle=True, seed=1,
+                                  **loader_args)
+
+
+# Run one setting and send its results through the pipe
+def run_setting(conn, arguments, loader_args):
+    iterator = make_iterator(arguments.dataset, arguments.split,
+                             tuple(arguments.size), arguments.batch_size,
+                             **loader_args)
+    try:
+        # Warm up (worker processes, image cache)
+        next(iterator)
+
+        if tracemalloc is not None:
+            tracemalloc.start()
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start_time = time.time()
+        for _ in range(arguments.batches):
+            next(iterator)
+        seconds = time.time() - start_time
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        traced_peak = None
+        if tracemalloc is not None:
+            traced_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        conn.send((seconds, rss_before, rss_after, traced_peak))
+    finally:
+        iterator.close()
+        conn.close()
+
+
+def benchmark(arguments, settings):
+    print('\n {:<30} {:>10} {:>10} {:>12} {:>12}'.format(
+        'Setting', 'batch/s', 'img/s', 'peak RSS MB', 'peak alloc MB'))
+    for name, loader_args in settings:
+        parent_conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=run_setting,
+                                          args=(child_conn, arguments, loader_args))
+        process.start()
+        seconds, rss_before, rss_after, traced_peak = parent_conn.recv()
+        process.join()
+
+        batches_per_second = arguments.batches / seconds
+        print(' {:<30} {:>10.2f} {:>10.1f} {:>12.1f} {:>12}'.format(
+            name, batches_per_second, batches_per_second * arguments.batch_size,
+            rss_after / 1024.,
+            'n/a' if traced_peak is None else '{:.1f}'.format(traced_peak / 2. ** 20)))
+
+
+if __name__ == '__main__':
+    arguments_parser = argparse.ArgumentParser(description='Benchmark the data loader on a dataset split')
+    arguments_parser.add_argument('dataset', help='Path to the dataset (folder with config.py)')
+    arguments_parser.add_argument('--split', help='Split to read', default='train')
+    arguments_parser.add_argument('--size', help='Size (rows, cols) of the batches',
+                                  type=int, nargs=2, default=[320, 320])
+    arguments_parser.add_argument('--batch-size', type=int, default=10)
+    arguments_parser.add_argument('--batches', help='Batches measured per setting', type=int, default=50)
+    arguments_parser.add_argument('--ring-size', help='Ring size of the preallocated batch arrays',
+                                  type=int, default=12)
+    arguments_parser.add_argument('--shuffle-block', help='Contiguous files of a block of the block shuffling',
+                                  type=int, default=64)
+    arguments_parser.add_argument('--shuffle-buffer', help='Shuffle buffer of the block shuffling',
+                                  type=int, default=256)
+
+    arguments = arguments_parser.parse_args()
+
+    # Batch arrays allocated per batch against reused batch arrays, and
+    # files read in random order against block shuffling
+    benchmark(arguments, [
+        ('new arrays per batch', dict(ring_size=0)),
+        ('ring of {} batches'.format(arguments.ring_size), dict(ring_size=arguments.ring_size)),
+        ('block shuffle {}/{}'.format(arguments.shuffle_block, arguments.shuffle_buffer),
+         dict(ring_size=arguments.ring_size, shuffle_block=arguments.shuffle_block,
+              shuffle_buffer=arguments.shuffle_buffer)),
+    ])
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import argparse
+import imp
+import os
+
+import numpy as np
+
+from tools.annotations import AnnotationIndex
+from tools.data_loader import list_subdirs, has_valid_extension, load_img
+from tools.manifest import Manifest
+from tools.shards import ShardWriter
+
+"""
+    Packs the train, valid and test splits of a dataset into shards that the
+    ShardIterator reads with np.memmap (set loader_format = 'shards' in the
+    experiment configuration).
+"""
+
+
+# List the samples of a split as (name, image path, mask path, label)
+def list_split(split_path, class_mode, classes):
+    samples = []
+    if class_mode == 'segmentation':
+        img_dir = os.path.join(split_path, 'images')
+        mask_dir = os.path.join(split_path, 'masks')
+        for fname in Manifest.load(img_dir).list_files(filter=has_valid_extension):
+            samples.append((fname, os.path.join(img_dir, fname),
+                            os.path.join(mask_dir, fname), -1))
+    elif class_mode == 'detection':
+        for fname in Manifest.load(split_path).list_files(filter=has_valid_extension):
+            samples.append((fname, os.path.join(split_path, fname),
+                            None, -1))
+    else:
+        class_indices = dict(zip(classes, range(len(classes))))
+        manifest = Manifest.load(split_path)
+        for subdir in classes:
+            subpath = os.path.join(split_path, subdir)
+            for fname in manifest.list_files(subdir, filter=has_valid_extension):
+                samples.append((os.path.join(subdir, fname),
+                                os.path.join(subpath, fname), None,
+                                class_indices[subdir]))
+    return samples
+
+
+# Pack one split of the dataset
+def build_split(split_path, shard_dir, class_mode, classes, color_mode, size,
+                samples_per_shard):
+    grayscale = color_mode == 'grayscale'
+    image_shape = tuple(size) + ((1,) if grayscale else (3,))
+    writer = ShardWriter(shard_dir, image_shape, class_mode, color_mode,
+                         samples_per_shard)
+
+    samples = list_split(split_path, class_mode, classes)
+    if class_mode == 'detection':
+        annotations = AnnotationIndex.from_directory(
+            split_path, [name for name, _, _, _ in samples])
+
+    for ind, (name, img_path, mask_path, label) in enumerate(samples):
+        # Images are resized to the shard size and stored as uint8
+        img = load_img(img_path, grayscale=grayscale, resize=size, order=1)
+        img = np.clip(np.round(img), 0, 255).astype(np.uint8)
+        img = img.reshape(image_shape)
+
+        mask, boxes = None, None
+        if class_mode == 'segmentation':
+            mask = load_img(mask_path, grayscale=True, resize=size, order=0)
+            mask = np.round(mask).astype(np.uint8).reshape(size)
+        elif class_mode == 'detection':
+            # All the boxes, the ShardIterator drops the invalid ones
+            boxes = annotations.gt(ind, valid_only=False)
+
+        writer.add(name, img, label=label, mask=mask, boxes=boxes)
+
+        if (ind + 1) % 1000 == 0:
+            print('   {}/{} images'.format(ind + 1, len(samples)))
+
+    writer.close(classes)
+
+
+if __name__ == '__main__':
+    arguments_parser = argparse.ArgumentParser(description='Pack a dataset into memory mapped shards')
+    arguments_parser.add_argument('dataset', help='Path to the dataset (folder with config.py)')
+    arguments_parser.add_argument('--size', help='Size (rows, cols) of the packed images. '
+                                                 'Defaults to img_shape of the dataset config',
+                                  type=int, nargs=2, default=None)
+    arguments_parser.add_argument('--splits', help='Splits to pack', nargs='+',
+                                  default=['train', 'valid', 'test'])
+    arguments_parser.add_argument('--samples-per-shard', help='Number of images in each shard file',
+                                  type=int, default=1024)
+    arguments_parser.add_argument('--output', help='Output path. Defaults to the shards folder of the dataset',
+                                  default=None)
+
+    arguments = arguments_parser.parse_args()
+
+    dataset_path = arguments.dataset
+    output_path = arguments.output or os.path.join(dataset_path, 'shards')
+    dataset_config = imp.load_source('config_dataset', os.path.join(dataset_path, 'config.py'))
+    size = tuple(arguments.size or dataset_config.img_shape)
+
+    # Class names in the order used by the DirectoryIterator
+    if dataset_config.classes:
+        classes = list(dataset_config.classes.values())
+    else:
+        classes = list_subdirs(os.path.join(dataset_path, 'train'))
+
+    for split in arguments.splits:
+        print('\n > Packing {} split...'.format(split))
+        build_split(os.path.join(dataset_path, split),
+                    os.path.join(output_path, split),
+                    dataset_config.class_mode, classes,
+                    dataset_config.color_mode, size,
+                    arguments.samples_per_shard)
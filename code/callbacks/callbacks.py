@@ -1,11 +1,8 @@
 from __future__ import division, print_function
 
-import time
-
 import numpy as np
 from keras import backend as K
 from keras.callbacks import Callback, Progbar, ProgbarLogger
-from keras.engine.training import GeneratorEnqueuer
 from tools.plot_history import plot_history
 from tools.save_images import save_img3
 import math
@@ -171,22 +168,12 @@ class Save_results(Callback):
 
     def on_epoch_end(self, epoch, logs={}):
 
-        # Create a data generator
-        enqueuer = GeneratorEnqueuer(self.generator, pickle_safe=False)
-        enqueuer.start(nb_worker=1, max_q_size=1, wait_time=0.05)
-
-        # Process the dataset
+        # Process the dataset. The generator is a Prefetcher, so the next
+        # batches are built while the current one is predicted
         for _ in range(self.epoch_length):
 
             # Get data for this minibatch
-            data = None
-            while enqueuer.is_running():
-                if not enqueuer.queue.empty():
-                    data = enqueuer.queue.get()
-                    break
-                else:
-                    time.sleep(0.05)
-            # data = data_gen_queue.get()
+            data = next(self.generator)
             x_true = data[0]
             y_true = data[1].astype('int32')
 
@@ -207,9 +194,22 @@ class Save_results(Callback):
                       self.color_map, self.classes, self.tag + str(_), self.void_label,
                       self.n_legend_rows)
 
-        # Stop data generator
-        if enqueuer is not None:
-            enqueuer.stop()
+
+# Print the statistics of the prefetchers of the data generators at the end
+# of every epoch: if the model waits for the batches a large fraction of
+# the time, the training is input-bound
+class Prefetch_stats(Callback):
+    def __init__(self, prefetchers):
+        super(Prefetch_stats, self).__init__()
+        self.prefetchers = prefetchers
+
+    def on_epoch_begin(self, epoch, logs={}):
+        for prefetcher in self.prefetchers:
+            prefetcher.reset_stats()
+
+    def on_epoch_end(self, epoch, logs={}):
+        for prefetcher in self.prefetchers:
+            print('   ' + prefetcher.summary())
 
 
 # Deprecated
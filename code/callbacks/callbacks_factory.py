@@ -5,7 +5,7 @@ from keras.callbacks import (EarlyStopping, ModelCheckpoint, CSVLogger,
                              LearningRateScheduler, TensorBoard)
 
 from callbacks import (History_plot, Jacc_new, Save_results, LRDecayScheduler,
-                       LearningRateSchedulerBatch, Scheduler)
+                       LearningRateSchedulerBatch, Scheduler, Prefetch_stats)
 
 
 # Create callbacks
@@ -13,7 +13,7 @@ class Callbacks_Factory():
     def __init__(self):
         pass
 
-    def make(self, cf, valid_gen):
+    def make(self, cf, valid_gen, train_gen=None):
         cb = []
 
         # Jaccard callback
@@ -68,6 +68,12 @@ class Callbacks_Factory():
         cb += [CSVLogger(os.path.join(cf.savepath, 'logFile.csv'),
                          separator=',', append=False)]
 
+        # Print the waits for the prefetched batches after every epoch
+        if cf.loader_prefetch_stats:
+            print('   Prefetch statistics')
+            cb += [Prefetch_stats([gen for gen in (train_gen, valid_gen)
+                                   if gen is not None])]
+
         # Learning rate scheduler
         if cf.LRScheduler_enabled:
             print('   Learning rate cheduler by batch')
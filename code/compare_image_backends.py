@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+from __future__ import print_function, division
+
+import argparse
+import os
+import time
+
+import numpy as np
+import skimage.transform
+from skimage import io
+from skimage.color import gray2rgb, rgb2gray
+
+from tools.data_loader import has_valid_extension, image_backends, load_img
+from tools.manifest import Manifest
+
+"""
+    Compares the image backends of the data loader with the original skimage
+    pipeline (full resolution io.imread and skimage resize) on the images
+    (and masks) of a directory: pixel differences of the loaded images in
+    color and in grayscale, labels changed in the resized masks and time
+    per image. The skimage backend itself is compared, as it decodes the
+    JPEGs at reduced scale. tests/test_image_backends.py checks the same
+    differences on generated images.
+"""
+
+
+# Load a file with a backend, as the DirectoryIterator does
+def read_resized(backend, file_name, size, order, grayscale=False):
+    x = load_img(file_name, grayscale=grayscale, resize=size, order=order,
+                 backend=backend)
+    return np.asarray(x, dtype=np.float32)
+
+
+# Read a file at full resolution and resize it with skimage, the reference.
+# The grayscale conversion keeps the range of the file
+def read_reference(file_name, size, order, grayscale=False):
+    x = io.imread(file_name)
+    if size is not None:
+        x = skimage.transform.resize(x, size, order=order, preserve_range=True)
+    if x.ndim == 2 and not grayscale:
+        x = gray2rgb(x)
+    elif x.ndim == 3 and x.shape[2] == 3 and grayscale:
+        x = rgb2gray(x.astype(np.float64))
+    return np.asarray(x, dtype=np.float32)
+
+
+def differences(backend, file_names, size, order, grayscale=False):
+    """Differences of a backend with the reference.
+    # Return
+        Dictionary with the mean and max absolute pixel differences, the
+        percentage of changed pixels and the milliseconds per image
+    """
+    expected = [read_reference(f, size, order, grayscale) for f in file_names]
+    start_time = time.time()
+    results = [read_resized(backend, f, size, order, grayscale)
+               for f in file_names]
+    ms = 1000. * (time.time() - start_time) / len(file_names)
+
+    diffs = [np.abs(r - e) for r, e in zip(results, expected)]
+    return {'mean_diff': np.mean([d.mean() for d in diffs]),
+            'max_diff': np.max([d.max() for d in diffs]),
+            'changed': 100. * np.mean([np.mean(d > 0) for d in diffs]),
+            'ms': ms}
+
+
+def compare(backends, file_names, size, order, grayscale=False):
+    print('\n {:<10} {:>10} {:>10} {:>14} {:>10}'.format(
+        'Backend', 'mean diff', 'max diff', 'labels diff %', 'ms/img'))
+    for name in backends:
+        diff = differences(name, file_names, size, order, grayscale)
+        print(' {:<10} {:>10.3f} {:>10.1f} {:>14} {:>10.2f}'.format(
+            name, diff['mean_diff'], diff['max_diff'],
+            '{:.3f}'.format(diff['changed']) if order == 0 else '-',
+            diff['ms']))
+
+
+def list_images(directory, nb_images):
+    manifest = Manifest.load(directory)
+    file_names = manifest.list_files(filter=has_valid_extension)
+    return [os.path.join(directory, f) for f in sorted(file_names)[:nb_images]]
+
+
+if __name__ == '__main__':
+    arguments_parser = argparse.ArgumentParser(description='Compare the image backends of the data loader')
+    arguments_parser.add_argument('images', help='Directory of images')
+    arguments_parser.add_argument('--masks', help='Directory of masks (resized with nearest neighbour)')
+    arguments_parser.add_argument('--size', help='Size (rows, cols) of the resized images',
+                                  type=int, nargs=2, default=[320, 320])
+    arguments_parser.add_argument('--nb-images', help='Number of files compared', type=int, default=50)
+    arguments_parser.add_argument('--backends', nargs='+', default=sorted(image_backends))
+
+    arguments = arguments_parser.parse_args()
+
+    images = list_images(arguments.images, arguments.nb_images)
+    size = tuple(arguments.size)
+    print('Images, bilinear resize')
+    compare(arguments.backends, images, size, 1)
+    print('\nImages in grayscale, bilinear resize')
+    compare(arguments.backends, images, size, 1, grayscale=True)
+    print('\nImages in grayscale, not resized')
+    compare(arguments.backends, images, None, 1, grayscale=True)
+    if arguments.masks:
+        print('\nMasks, nearest neighbour resize')
+        compare(arguments.backends, list_images(arguments.masks, arguments.nb_images),
+                size, 0, grayscale=True)
@@ -58,6 +58,33 @@ class Configuration():
                                                    cf.problem_type,
                                                    'config_dataset2')
 
+        # Optional data loader and data augmentation parameters (see the README)
+        cf.loader_workers = getattr(cf, 'loader_workers', 0)
+        cf.loader_prefetch = getattr(cf, 'loader_prefetch', 2)
+        cf.loader_cache_size = getattr(cf, 'loader_cache_size', 0)
+        cf.loader_cache_dir = getattr(cf, 'loader_cache_dir', None)
+        cf.loader_format = getattr(cf, 'loader_format', 'directory')
+        cf.loader_ring_size = getattr(cf, 'loader_ring_size', 13)
+        cf.loader_queue_size = getattr(cf, 'loader_queue_size', 10)
+        cf.loader_queue_workers = getattr(cf, 'loader_queue_workers', 1)
+        cf.loader_queue_processes = getattr(cf, 'loader_queue_processes', False)
+        cf.loader_prefetch_stats = getattr(cf, 'loader_prefetch_stats', False)
+        cf.loader_autotune = getattr(cf, 'loader_autotune', False)
+        cf.loader_cpu_budget = getattr(cf, 'loader_cpu_budget', None)
+        cf.loader_backend = getattr(cf, 'loader_backend', 'skimage')
+        cf.loader_batch_affine = getattr(cf, 'loader_batch_affine', False)
+        cf.loader_uint8 = getattr(cf, 'loader_uint8', False)
+        cf.loader_valid_cache = getattr(cf, 'loader_valid_cache', None)
+        cf.loader_valid_cache_dir = getattr(cf, 'loader_valid_cache_dir', None)
+        cf.loader_metadata_dir = getattr(cf, 'loader_metadata_dir', None)
+        cf.loader_echo_factor = getattr(cf, 'loader_echo_factor', 1)
+        cf.loader_echo_buffer = getattr(cf, 'loader_echo_buffer', 4)
+        cf.loader_shuffle_block = getattr(cf, 'loader_shuffle_block', 0)
+        cf.loader_shuffle_buffer = getattr(cf, 'loader_shuffle_buffer', 0)
+        cf.loader_bucket_step = getattr(cf, 'loader_bucket_step', 0)
+        cf.da_warp_engine = getattr(cf, 'da_warp_engine', 'bank')
+        cf.da_warp_bank_size = getattr(cf, 'da_warp_bank_size', 16)
+
         # If in Debug mode use few images
         if cf.debug and cf.debug_images_train > 0:
             cf.dataset.n_images_train = cf.debug_images_train
@@ -175,6 +202,11 @@ class Configuration():
             dataset_conf.path_test_img = os.path.join(dataset_conf.path, 'test')
             dataset_conf.path_test_mask = None
 
+        # Packed shards of the dataset (see build_shards.py)
+        dataset_conf.path_train_shards = os.path.join(dataset_conf.path, 'shards', 'train')
+        dataset_conf.path_valid_shards = os.path.join(dataset_conf.path, 'shards', 'valid')
+        dataset_conf.path_test_shards = os.path.join(dataset_conf.path, 'shards', 'test')
+
         return dataset_conf
 
     # Copy result to shared directory
@@ -16,6 +16,8 @@ from models.yolo import build_yolo
 from models.ssd300 import build_ssd300
 from tools.yolo_utils import *
 from tools.ssd_utils import BBoxUtility
+from tools.annotations import AnnotationIndex
+from tools.manifest import Manifest
 import matplotlib.pyplot as plt
 
 plt.switch_backend('Agg')
@@ -118,14 +120,16 @@ if __name__ == '__main__':
     model.load_weights(weights_path)
 
     # Get images from test directory
-    imfiles = [os.path.join(test_dir, f) for f in os.listdir(test_dir)
-               if os.path.isfile(os.path.join(test_dir, f))
-               and f.endswith('jpg')]
+    imfiles = [os.path.join(test_dir, f) for f in
+               Manifest.load(test_dir).list_files(filter=lambda f: f.endswith('jpg'))]
 
     if len(imfiles) == 0:
         print("ERR: path_to_images does not contain any jpg file")
         exit(1)
 
+    # GT boxes of the images (the index is shared with the training)
+    annotations = AnnotationIndex.from_directory(test_dir, [os.path.basename(f) for f in imfiles])
+
     inputs = []
     img_paths = []
     chunk_size = 128  # we are going to process all image files in chunks
@@ -170,10 +174,7 @@ if __name__ == '__main__':
                     exit(1)
 
                 boxes_true = []
-                label_path = img_path.replace('jpg', 'txt')
-                gt = np.loadtxt(label_path)
-                if len(gt.shape) == 1:
-                    gt = gt[np.newaxis, ]
+                gt = annotations.gt(annotations.index_of(os.path.basename(img_path)), valid_only=False)
                 for j in range(gt.shape[0]):
                     bx = BoundBox(len(classes))
                     bx.probs[int(gt[j, 0])] = 1.
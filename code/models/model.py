@@ -4,6 +4,8 @@ import time
 
 import numpy as np
 from keras.engine.training import GeneratorEnqueuer
+from tools.annotations import AnnotationIndex
+from tools.manifest import Manifest
 from tools.save_images import save_img3
 from tools.yolo_utils import *
 from keras.preprocessing import image
@@ -46,6 +48,9 @@ class One_Net_Model(Model):
     def train(self, train_gen, valid_gen, cb):
         if self.cf.train_model:
             print('\n > Training the model...')
+            # The batches are built ahead by the prefetchers of the
+            # generators (tools/prefetcher.py). The Keras queue only hands
+            # them over
             hist = self.model.fit_generator(generator=train_gen,
                                             samples_per_epoch=self.cf.dataset.n_images_train,
                                             nb_epoch=self.cf.n_epochs,
@@ -54,7 +59,7 @@ class One_Net_Model(Model):
                                             validation_data=valid_gen,
                                             nb_val_samples=self.cf.dataset.n_images_valid,
                                             class_weight=None,
-                                            max_q_size=10,
+                                            max_q_size=1,
                                             nb_worker=1,
                                             pickle_safe=False)
             print('   Training finished.')
@@ -117,7 +122,7 @@ class One_Net_Model(Model):
             start_time_global = time.time()
             test_metrics = self.model.evaluate_generator(test_gen,
                                                          self.cf.dataset.n_images_test,
-                                                         max_q_size=10,
+                                                         max_q_size=1,
                                                          nb_worker=1,
                                                          pickle_safe=False)
 
@@ -150,10 +155,10 @@ class One_Net_Model(Model):
                 
 
                 
-                test_dir = test_gen.directory
-                imfiles = [os.path.join(test_dir,f) for f in os.listdir(test_dir) 
-                                    if os.path.isfile(os.path.join(test_dir,f)) 
-                                    and f.endswith('jpg')]
+                test_dir = self.cf.dataset.path_test_img
+                imfiles = [os.path.join(test_dir,f) for f in
+                           Manifest.load(test_dir).list_files(filter=lambda f: f.endswith('jpg'))]
+                annotations = AnnotationIndex.from_directory(test_dir, [os.path.basename(f) for f in imfiles])
                 inputs = []
                 img_paths = []
                 chunk_size = 128 # we are going to process all image files in chunks
@@ -181,10 +186,8 @@ class One_Net_Model(Model):
                             boxes_pred = yolo_postprocess_net_out(net_out[i], priors, classes, detection_threshold,
                                                                   nms_threshold)
                             boxes_true = []
-                            label_path = img_path.replace('jpg', 'txt')
-                            gt = np.loadtxt(label_path)
-                            if len(gt.shape) == 1:
-                                gt = gt[np.newaxis,]
+                            gt = annotations.gt(annotations.index_of(os.path.basename(img_path)),
+                                                valid_only=False)
                             for j in range(gt.shape[0]):
                                 bx = BoundBox(len(classes))
                                 bx.probs[int(gt[j,0])] = 1.
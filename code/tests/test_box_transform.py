@@ -0,0 +1,74 @@
+import numpy as np
+from numpy.linalg import inv
+
+from tools.data_loader import transform_boxes
+
+
+# The per box loop transform_boxes replaces
+def reference_transform_boxes(b, p_transform_matrix):
+    b = b.copy()
+    for ii in range(b.shape[0]):
+        x1, y1, x2, y2 = b.astype(int)[ii]
+        # get the four edge points of the bounding box
+        v1 = np.array([y1, x1, 1])
+        v2 = np.array([y2, x2, 1])
+        v3 = np.array([y2, x1, 1])
+        v4 = np.array([y1, x2, 1])
+        # transform the 4 points
+        v1 = np.dot(p_transform_matrix, v1)
+        v2 = np.dot(p_transform_matrix, v2)
+        v3 = np.dot(p_transform_matrix, v3)
+        v4 = np.dot(p_transform_matrix, v4)
+        # compute the new bounding box edges
+        b[ii, 0] = np.min([v1[1], v2[1], v3[1], v4[1]])
+        b[ii, 1] = np.min([v1[0], v2[0], v3[0], v4[0]])
+        b[ii, 2] = np.max([v1[1], v2[1], v3[1], v4[1]])
+        b[ii, 3] = np.max([v1[0], v2[0], v3[0], v4[0]])
+    return b
+
+
+# Affine matrix of a random rotation, shear, zoom and shift around the
+# center of an h x w image, as random_transform draws them
+def random_matrix(rng, h, w):
+    theta = np.deg2rad(rng.uniform(-30, 30))
+    shear = rng.uniform(-0.3, 0.3)
+    zx, zy = rng.uniform(0.7, 1.3, 2)
+    tx, ty = rng.uniform(-0.2, 0.2, 2) * (h, w)
+    rotation = np.array([[np.cos(theta), -np.sin(theta), 0],
+                         [np.sin(theta), np.cos(theta), 0],
+                         [0, 0, 1]])
+    shift = np.array([[1, 0, tx], [0, 1, ty], [0, 0, 1]])
+    shear = np.array([[1, -np.sin(shear), 0], [0, np.cos(shear), 0], [0, 0, 1]])
+    zoom = np.array([[zx, 0, 0], [0, zy, 0], [0, 0, 1]])
+    matrix = np.dot(np.dot(np.dot(rotation, shift), shear), zoom)
+    o_x, o_y = h / 2. + 0.5, w / 2. + 0.5
+    offset = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
+    reset = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
+    return np.dot(np.dot(offset, matrix), reset)
+
+
+def test_matches_the_loop():
+    rng = np.random.RandomState(0)
+    for _ in range(500):
+        h, w = rng.randint(50, 500, 2)
+        n = rng.randint(1, 40)
+        x1 = rng.uniform(0, w - 2, n)
+        y1 = rng.uniform(0, h - 2, n)
+        b = np.stack((x1, y1, rng.uniform(x1 + 1, w), rng.uniform(y1 + 1, h)),
+                     axis=1)
+        p_transform_matrix = inv(random_matrix(rng, h, w))
+        expected = reference_transform_boxes(b, p_transform_matrix)
+        assert np.array_equal(transform_boxes(b, p_transform_matrix), expected)
+
+
+def test_keeps_the_input():
+    b = np.array([[10.5, 20.2, 30.7, 40.1]])
+    before = b.copy()
+    transform_boxes(b, np.eye(3))
+    assert np.array_equal(b, before)
+
+
+def test_identity_truncates_the_corners():
+    b = np.array([[10.5, 20.2, 30.7, 40.1], [0., 0., 5., 5.]])
+    assert np.array_equal(transform_boxes(b, np.eye(3)),
+                          [[10., 20., 30., 40.], [0., 0., 5., 5.]])
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from compare_image_backends import differences
+from tools.data_loader import image_backends, load_img
+
+backends = sorted(image_backends)
+
+
+# Smooth RGB image, where the resize filters of the backends agree
+def smooth_image(rows, cols, seed):
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:rows, 0:cols] / float(max(rows, cols))
+    channels = [127.5 + 120 * np.sin(2 * np.pi * (rng.uniform(.5, 2) * x +
+                                                  rng.uniform(.5, 2) * y) +
+                                     rng.uniform(0, 6))
+                for _ in range(3)]
+    return np.rint(np.stack(channels, axis=2)).astype(np.uint8)
+
+
+@pytest.fixture(scope='module')
+def files(tmpdir_factory):
+    directory = str(tmpdir_factory.mktemp('images'))
+    files = {'png': [], 'jpg': [], 'mask': []}
+    for i in range(3):
+        path = os.path.join(directory, '{}.png'.format(i))
+        Image.fromarray(smooth_image(60, 80, i)).save(path)
+        files['png'].append(path)
+        # Large enough to be decoded at reduced scale
+        path = os.path.join(directory, '{}.jpg'.format(i))
+        Image.fromarray(smooth_image(240, 320, i)).save(path, quality=95)
+        files['jpg'].append(path)
+        path = os.path.join(directory, 'mask_{}.png'.format(i))
+        Image.fromarray(smooth_image(60, 80, 10 + i)[..., 0] // 64).save(path)
+        files['mask'].append(path)
+    return files
+
+
+@pytest.fixture(params=backends)
+def backend(request):
+    if request.param == 'opencv':
+        pytest.importorskip('cv2')
+    return request.param
+
+
+@pytest.mark.parametrize('grayscale', [False, True])
+def test_not_resized(files, backend, grayscale):
+    diff = differences(backend, files['png'], None, 1, grayscale)
+    assert diff['max_diff'] < 1e-3
+
+
+@pytest.mark.parametrize('kind,size', [('png', (48, 64)), ('jpg', (60, 80))])
+@pytest.mark.parametrize('grayscale', [False, True])
+def test_bilinear_resize(files, backend, kind, size, grayscale):
+    diff = differences(backend, files[kind], size, 1, grayscale)
+    assert diff['mean_diff'] < 1.
+    assert diff['max_diff'] < 5.
+
+
+def test_mask_resize(files, backend):
+    diff = differences(backend, files['mask'], (48, 64), 0, grayscale=True)
+    assert diff['changed'] < 1.
+
+
+@pytest.mark.parametrize('resize', [None, (30, 40)])
+def test_grayscale_range(tmpdir, backend, resize):
+    # Every backend, resized or not, keeps the range of the file
+    path = str(tmpdir.join('gray.png'))
+    Image.fromarray(np.full((60, 80, 3), 200, dtype=np.uint8)).save(path)
+    x = load_img(path, grayscale=True, resize=resize, backend=backend)
+    assert x.ndim == 2
+    assert np.allclose(x, 200, atol=1e-3)
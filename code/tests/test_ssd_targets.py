@@ -0,0 +1,93 @@
+import numpy as np
+
+from tools.ssd_utils import BBoxUtility
+
+
+# BBoxUtility without the TF session, which the targets do not use
+def make_utility(rng, num_priors=2000, num_classes=4):
+    centers = rng.uniform(0, 1, (num_priors, 2))
+    half_wh = rng.uniform(0.01, 0.16, (num_priors, 2))
+    variances = np.tile([.1, .1, .2, .2], (num_priors, 1))
+    utility = object.__new__(BBoxUtility)
+    utility.num_classes = num_classes
+    utility.priors = np.concatenate((centers - half_wh, centers + half_wh,
+                                     variances), axis=1)
+    utility.num_priors = num_priors
+    utility.overlap_threshold = 0.5
+    return utility
+
+
+# The per box assignment assign_batch replaces
+def reference_assign_boxes(utility, boxes):
+    assignment = np.zeros((utility.num_priors, 4 + utility.num_classes + 8))
+    assignment[:, 4] = 1.0
+    if len(boxes) == 0:
+        return assignment
+
+    encoded_boxes = np.apply_along_axis(utility.encode_box, 1, boxes[:, :4])
+    encoded_boxes = encoded_boxes.reshape(-1, utility.num_priors, 5)
+    best_iou = encoded_boxes[:, :, -1].max(axis=0)
+    best_iou_idx = encoded_boxes[:, :, -1].argmax(axis=0)
+    best_iou_mask = best_iou > 0
+    best_iou_idx = best_iou_idx[best_iou_mask]
+    assign_num = len(best_iou_idx)
+    encoded_boxes = encoded_boxes[:, best_iou_mask, :]
+    assignment[:, :4][best_iou_mask] = encoded_boxes[best_iou_idx,
+                                                     np.arange(assign_num), :4]
+    assignment[:, 4][best_iou_mask] = 0
+    assignment[:, 5:-8][best_iou_mask] = boxes[best_iou_idx, 4:]
+    assignment[:, -8][best_iou_mask] = 1
+    return assignment
+
+
+# [class, xcenter, ycenter, width, height] rows
+def random_gt(rng, n, num_classes):
+    centers = rng.uniform(0.1, 0.9, (n, 2))
+    wh = rng.uniform(0.01, 0.41, (n, 2))
+    if n > 1 and rng.rand() < .3:
+        # Duplicated box
+        centers[-1], wh[-1] = centers[0], wh[0]
+    return np.column_stack((rng.randint(0, num_classes, n), centers, wh))
+
+
+def corner_boxes(gt, num_classes):
+    boxes = np.zeros((len(gt), 4 + num_classes))
+    boxes[:, 0:2] = gt[:, 1:3] - gt[:, 3:5] / 2
+    boxes[:, 2:4] = gt[:, 1:3] + gt[:, 3:5] / 2
+    boxes[np.arange(len(gt)), 4 + gt[:, 0].astype(int)] = 1
+    return boxes
+
+
+def test_matches_the_per_box_assignment():
+    rng = np.random.RandomState(0)
+    utility = make_utility(rng)
+    for _ in range(50):
+        # Images without boxes and images of different numbers of boxes
+        batch_boxes = [corner_boxes(random_gt(rng, n, 3), 3)
+                       for n in rng.randint(0, 8, 4)]
+        assignment = utility.assign_batch(batch_boxes)
+        assert assignment.dtype == np.float32
+        for boxes, y in zip(batch_boxes, assignment):
+            expected = reference_assign_boxes(utility, boxes)
+            assert np.array_equal(y, expected.astype(np.float32))
+
+
+def test_empty_batch():
+    utility = make_utility(np.random.RandomState(1))
+    assignment = utility.assign_batch([np.zeros((0, 7))] * 2)
+    assert assignment.shape == (2, utility.num_priors, 4 + 4 + 8)
+    assert np.all(assignment[:, :, 4] == 1)
+    assert np.count_nonzero(assignment) == 2 * utility.num_priors
+
+
+def test_build_gt_batch_corners():
+    rng = np.random.RandomState(2)
+    utility = make_utility(rng)
+    batch_gt = [random_gt(rng, n, 3) for n in (0, 3, 6)]
+    before = [gt.copy() for gt in batch_gt]
+    y = utility.ssd_build_gt_batch(batch_gt, (3, 300, 300))
+    assert y.shape == (3, utility.num_priors, 4 + 4 + 8)
+    expected = utility.assign_batch([corner_boxes(gt, 3) for gt in before])
+    assert np.array_equal(y, expected)
+    for gt, old_gt in zip(batch_gt, before):
+        assert np.array_equal(gt, old_gt)
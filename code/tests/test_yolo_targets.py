@@ -0,0 +1,86 @@
+import numpy as np
+
+from tools.yolo_utils import yolo_build_gt_batch
+
+
+# The per object loop yolo_build_gt_batch replaces
+def reference_build_gt_batch(batch_gt, image_shape, num_classes, num_priors=5):
+    h = image_shape[1] // 32
+    w = image_shape[2] // 32
+    c = num_classes
+    b = num_priors
+    batch_size = len(batch_gt)
+    batch_y = np.zeros([batch_size, h * w, b, c + 4 + 1 + 1 + 2 + 2])
+
+    cellx = 32
+    celly = 32
+    for i, gt in enumerate(batch_gt):
+        if gt.shape[0] == 0:
+            batch_y[i] = np.ones((h * w, b, c + 4 + 1 + 1 + 2 + 2))
+            continue
+        objects = gt.tolist()
+        for obj in objects:
+            centerx = obj[1] * image_shape[2]
+            centery = obj[2] * image_shape[1]
+            cx = centerx / cellx
+            cy = centery / celly
+            obj[1] = cx - np.floor(cx)
+            obj[2] = cy - np.floor(cy)
+            obj[3] = np.sqrt(obj[3])
+            obj[4] = np.sqrt(obj[4])
+            obj += [int(np.floor(cy) * w + np.floor(cx))]
+
+        probs = np.zeros([h * w, b, c])
+        confs = np.zeros([h * w, b, 1])
+        coord = np.zeros([h * w, b, 4])
+        prear = np.zeros([h * w, 4])
+
+        for obj in objects:
+            probs[obj[5], :, :] = [[0.] * c] * b
+            probs[obj[5], :, int(obj[0])] = 1.
+            coord[obj[5], :, :] = [obj[1:5]] * b
+            prear[obj[5], 0] = obj[1] - obj[3] ** 2 * .5 * w
+            prear[obj[5], 1] = obj[2] - obj[4] ** 2 * .5 * h
+            prear[obj[5], 2] = obj[1] + obj[3] ** 2 * .5 * w
+            prear[obj[5], 3] = obj[2] + obj[4] ** 2 * .5 * h
+            confs[obj[5], :, 0] = [1.] * b
+
+        upleft = np.expand_dims(prear[:, 0:2], 1)
+        botright = np.expand_dims(prear[:, 2:4], 1)
+        wh = botright - upleft
+        area = wh[:, :, 0] * wh[:, :, 1]
+        upleft = np.concatenate([upleft] * b, 1)
+        botright = np.concatenate([botright] * b, 1)
+        areas = np.concatenate([area] * b, 1)
+
+        batch_y[i, :] = np.concatenate((probs, confs, coord,
+                                        areas[:, :, np.newaxis], upleft,
+                                        botright), axis=2)
+    return batch_y
+
+
+def random_gt(rng, n, num_classes):
+    return np.column_stack((rng.randint(0, num_classes, n),
+                            rng.uniform(0, 1, (n, 2)),
+                            rng.uniform(0.01, 0.8, (n, 2))))
+
+
+def test_matches_the_loop():
+    rng = np.random.RandomState(0)
+    for image_shape in [(3, 320, 320), (3, 416, 608)]:
+        for _ in range(20):
+            # Images without objects, and objects sharing a cell
+            batch_gt = [random_gt(rng, n, 20)
+                        for n in rng.choice([0, 1, 5, 30], 4)]
+            expected = reference_build_gt_batch(batch_gt, image_shape, 20)
+            batch_y = yolo_build_gt_batch(batch_gt, image_shape, 20)
+            assert batch_y.dtype == np.float32
+            assert np.array_equal(batch_y, expected.astype(np.float32))
+
+
+def test_keeps_the_input():
+    rng = np.random.RandomState(1)
+    batch_gt = [random_gt(rng, 5, 3)]
+    before = batch_gt[0].copy()
+    yolo_build_gt_batch(batch_gt, (3, 320, 320), 3)
+    assert np.array_equal(batch_gt[0], before)
@@ -0,0 +1,133 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import warnings
+
+import numpy as np
+
+from tools.manifest import Manifest, cache_path
+
+"""
+    Index of the detection annotations of a dataset split.
+    Every image has a .txt file with one [class, x, y, w, h] row per box
+    (relative coordinates). The index parses them once and keeps:
+        - class_ids: int32 class of every box
+        - boxes: float32 (n_boxes, 4) table with the [x, y, w, h] rows
+        - starts, counts: offset and number of boxes of every image
+        - valid: whether each box lies inside the image
+    It is saved in the cache directory of the manifests and rebuilt when
+    the manifest of the directory shows that the .txt files changed.
+"""
+
+
+# Path of the annotation of an image
+def label_path(img_path):
+    return img_path.replace('jpg', 'txt')
+
+
+# Boxes with the center and the size inside (0, 1)
+def valid_box_mask(boxes):
+    return np.all((boxes > 0.) & (boxes < 1.), axis=1)
+
+
+class AnnotationIndex(object):
+    """Detection annotations of a list of images.
+    # Arguments
+        names: Image names.
+        class_ids: Class of every box.
+        boxes: (n_boxes, 4) [x, y, w, h] rows of all the images.
+        starts: Index of the first box of every image.
+        counts: Number of boxes of every image.
+    """
+
+    def __init__(self, names, class_ids, boxes, starts, counts):
+        self.names = np.asarray(names)
+        self.class_ids = np.asarray(class_ids, dtype=np.int32)
+        self.boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.positions = None
+
+        # Valid boxes, stored contiguous per image
+        self.valid = valid_box_mask(self.boxes)
+        valid_before = np.concatenate(([0], np.cumsum(self.valid)))
+        self.valid_starts = valid_before[self.starts]
+        self.valid_counts = valid_before[self.starts + self.counts] - self.valid_starts
+        self.valid_table = np.hstack((self.class_ids[self.valid, None],
+                                      self.boxes[self.valid]))
+
+        # Images with an invalid box or without boxes
+        self.valid_image = (self.valid_counts == self.counts) & (self.counts > 0)
+
+    def __len__(self):
+        return len(self.names)
+
+    def gt(self, j, valid_only=True):
+        """Boxes of the image j as [class, x, y, w, h] rows.
+        # Arguments
+            j: Index of the image.
+            valid_only: Drop the boxes outside the image.
+        """
+        if valid_only:
+            start = self.valid_starts[j]
+            return self.valid_table[start:start + self.valid_counts[j]].astype(np.float64)
+        rows = slice(self.starts[j], self.starts[j] + self.counts[j])
+        return np.hstack((self.class_ids[rows, None],
+                          self.boxes[rows])).astype(np.float64)
+
+    def index_of(self, name):
+        if self.positions is None:
+            self.positions = dict((n, j) for j, n in enumerate(self.names))
+        return self.positions[name]
+
+    @classmethod
+    def from_directory(cls, directory, filenames):
+        """Index of the annotations of the images of a directory.
+        The index is read from the directory cache if the annotation files
+        did not change.
+        # Arguments
+            directory: Directory with the images and their .txt files.
+            filenames: Image names in the directory.
+        """
+        manifest = Manifest.load(directory)
+        label_paths = [label_path(os.path.join(directory, f)) for f in filenames]
+        for f in filenames:
+            if not manifest.has_file(label_path(f)):
+                raise ValueError('GT file not found: ' +
+                                 label_path(os.path.join(directory, f)))
+        key = manifest.key([label_path(f) for f in filenames])
+
+        index_path = cache_path(directory, 'annotations.npz')
+        if index_path is not None and os.path.isfile(index_path):
+            data = np.load(index_path)
+            if str(data['key']) == key:
+                return cls(filenames, data['class_ids'], data['boxes'],
+                           data['starts'], data['counts'])
+
+        # Parse the annotations
+        rows, counts = [], []
+        for path in label_paths:
+            with warnings.catch_warnings():
+                # Images without boxes have an empty file
+                warnings.simplefilter('ignore')
+                gt = np.loadtxt(path, ndmin=2).reshape(-1, 5)
+            rows.append(gt)
+            counts.append(len(gt))
+        rows = np.vstack(rows) if rows else np.zeros((0, 5))
+        counts = np.array(counts, dtype=np.int64)
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1])).astype(np.int64)
+        index = cls(filenames, rows[:, 0], rows[:, 1:], starts, counts)
+
+        # Save the index
+        if index_path is None:
+            return index
+        tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, key=key, class_ids=index.class_ids,
+                         boxes=index.boxes, starts=starts, counts=counts)
+            os.rename(tmp_path, index_path)
+        except (IOError, OSError) as e:
+            print('   Could not save the annotation index: ' + str(e))
+        return index
@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+
+import numpy as np
+
+"""
+    Automatic choice of the number of worker processes of a data loader and
+    of the depth of its prefetch queue. During the first batches the
+    iterator builds the batches in process, so the prefetcher measures the
+    time the model takes per batch (the consumer step), the time it waits
+    for a batch and the time one process takes to build a batch. The
+    workers needed to keep up with the model follow from their ratio,
+    within a CPU budget. A loader the model does not wait for is kept as
+    it is.
+"""
+
+
+class LoaderTuner(object):
+    """Tunes the iterator of a Prefetcher once, from the timings of its
+    first batches.
+    # Arguments
+        cpu_budget: Maximum number of worker processes (None: the number
+            of CPUs minus the one of the training process).
+        warmup: Batches skipped before measuring (model compilation, image
+            cache, first files read).
+        window: Batches measured.
+        headroom: Throughput of the workers over the one the model needs.
+        idle_wait: Fraction of the consumer step under which the waits for
+            the batches are taken as none.
+    """
+
+    def __init__(self, cpu_budget=None, warmup=5, window=20, headroom=1.25,
+                 idle_wait=0.05):
+        if cpu_budget is None:
+            cpu_budget = max(1, multiprocessing.cpu_count() - 1)
+        self.cpu_budget = cpu_budget
+        self.warmup = warmup
+        self.window = window
+        self.headroom = headroom
+        self.idle_wait = idle_wait
+
+        self.nb_seen = 0
+        self.step_times = []
+        self.wait_times = []
+        self.build_times = []
+        self.done = False
+
+    def update(self, prefetcher, step_time, wait_time, build_time):
+        """Record the timings of a batch of the prefetcher.
+        # Arguments
+            prefetcher: Prefetcher of the batch.
+            step_time: Seconds the consumer spent on the previous batch, or
+                None for the first one.
+            wait_time: Seconds the consumer waited for the batch.
+            build_time: Seconds a worker took to build the batch.
+        """
+        if self.done:
+            return
+        self.nb_seen += 1
+        if self.nb_seen <= self.warmup:
+            return
+        if step_time is not None:
+            self.step_times.append(step_time)
+        self.wait_times.append(wait_time)
+        self.build_times.append(build_time)
+        if len(self.build_times) >= self.window:
+            self.done = True
+            self.tune(prefetcher)
+
+    def choose(self, step_time, build_times, max_depth, wait_times=None):
+        """Settings for the measured timings.
+        # Arguments
+            step_time: Seconds the consumer spends per batch.
+            build_times: Seconds one process took to build each batch.
+            max_depth: Maximum queue depth (the batch ring is sized for it).
+            wait_times: Seconds the consumer waited for each batch, or None.
+        # Return
+            nb_worker, depth: Worker processes (0: keep building the
+                batches in process) and prefetch queue depth
+        """
+        build_time = np.median(build_times)
+        step_time = max(step_time, 1e-3)
+
+        # The queue never ran empty (the prefetch threads keep up): no
+        # workers and no change of depth
+        if (wait_times is not None and
+                np.percentile(wait_times, 90) < self.idle_wait * step_time):
+            return 0, max_depth
+
+        # Workers needed so that the batches are built faster than consumed
+        needed = self.headroom * build_time / step_time
+        if needed <= 1:
+            nb_worker = 0
+        else:
+            nb_worker = int(min(np.ceil(needed), self.cpu_budget))
+
+        # Queue deep enough to absorb the slow batches (90th percentile)
+        # while the others are built
+        slow_time = np.percentile(build_times, 90) / max(nb_worker, 1)
+        depth = int(np.clip(np.ceil(slow_time / step_time) + 1, 2, max_depth))
+        return nb_worker, depth
+
+    def tune(self, prefetcher):
+        if not self.step_times:
+            return
+        step_time = np.median(self.step_times)
+        nb_worker, depth = self.choose(step_time, self.build_times,
+                                       prefetcher.depth, self.wait_times)
+
+        print('\n   {}: model {:.0f} ms/batch, waits {:.0f} ms/batch, batches '
+              'built in {:.0f} ms in process (CPU budget {})'.format(
+                  prefetcher.name, 1000 * step_time,
+                  1000 * np.mean(self.wait_times),
+                  1000 * np.median(self.build_times), self.cpu_budget))
+        if nb_worker > 0:
+            try:
+                prefetcher.generator.set_workers(nb_worker)
+                print('   {}: {} worker processes'.format(prefetcher.name,
+                                                          nb_worker))
+            except ValueError as e:
+                print('   {}: building the batches in process ({})'.format(
+                    prefetcher.name, e))
+        else:
+            print('   {}: building the batches in process'.format(
+                prefetcher.name))
+
+        prefetcher.set_depth(depth)
+        print('   {}: prefetch queue depth {}'.format(prefetcher.name, depth))
@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+"""
+    Batch-level affine augmentation.
+    The rotation, shift, shear and zoom of every sample of a batch are drawn
+    as arrays, composed with vectorized math and applied to the whole batch
+    (images and GT masks stacked as channels) with a single gather.
+"""
+
+
+# Draw n random affine matrices mapping output to input [row, col, 1] points
+def random_affine_matrices(n, h, w, rotation_range=0., height_shift_range=0.,
+                           width_shift_range=0., shear_range=0.,
+                           zoom_range=(1., 1.)):
+    # Draw the parameters of all the samples
+    theta = np.zeros(n)
+    if rotation_range:
+        theta = np.pi / 180 * np.random.uniform(-rotation_range,
+                                                rotation_range, n)
+    tx = np.zeros(n)
+    if height_shift_range:
+        tx = np.random.uniform(-height_shift_range, height_shift_range, n) * h
+    ty = np.zeros(n)
+    if width_shift_range:
+        ty = np.random.uniform(-width_shift_range, width_shift_range, n) * w
+    shear = np.zeros(n)
+    if shear_range:
+        shear = np.random.uniform(-shear_range, shear_range, n)
+    if zoom_range[0] == 1 and zoom_range[1] == 1:
+        zx, zy = np.ones(n), np.ones(n)
+    else:
+        zx, zy = np.random.uniform(zoom_range[0], zoom_range[1], (2, n))
+
+    # Compose rotation * translation * shear * zoom in closed form
+    cos, sin = np.cos(theta), np.sin(theta)
+    cos_s, sin_s = np.cos(shear), np.sin(shear)
+    matrices = np.zeros((n, 3, 3))
+    matrices[:, 0, 0] = cos * zx
+    matrices[:, 0, 1] = (-cos * sin_s - sin * cos_s) * zy
+    matrices[:, 0, 2] = cos * tx - sin * ty
+    matrices[:, 1, 0] = sin * zx
+    matrices[:, 1, 1] = (-sin * sin_s + cos * cos_s) * zy
+    matrices[:, 1, 2] = sin * tx + cos * ty
+    matrices[:, 2, 2] = 1
+
+    # Transform around the center of the image
+    o_x, o_y = h / 2 + 0.5, w / 2 + 0.5
+    offset = np.array([[1, 0, o_x], [0, 1, o_y], [0, 0, 1]])
+    reset = np.array([[1, 0, -o_x], [0, 1, -o_y], [0, 0, 1]])
+    return np.matmul(np.matmul(offset, matrices), reset)
+
+
+# Map source indices outside [0, n) following the fill mode
+def fill_indices(idx, n, fill_mode):
+    if fill_mode == 'nearest' or fill_mode == 'constant':
+        return np.clip(idx, 0, n - 1)
+    elif fill_mode == 'wrap':
+        return np.mod(idx, n)
+    elif fill_mode == 'reflect':
+        idx = np.mod(idx, 2 * n)
+        return np.where(idx >= n, 2 * n - 1 - idx, idx)
+    else:
+        raise ValueError('Unsupported fill mode "{}"'.format(fill_mode))
+
+
+def batch_apply_transform(batch, matrices, channel_index, fill_mode='nearest',
+                          cval=0.):
+    """Nearest neighbour affine resampling of a whole batch.
+    # Arguments
+        batch: Batch of images, channels on axis channel_index.
+        matrices: (batch size, 3, 3) matrices mapping each output [row, col, 1]
+            point to its input point.
+        channel_index: Channel axis of the batch (1 or 3).
+        fill_mode: 'constant', 'nearest', 'reflect' or 'wrap'.
+        cval: Value (or per channel values) of the points outside the
+            images when fill_mode is 'constant'.
+    # Return
+        The transformed batch.
+    """
+    # Work with the channels last
+    batch = np.rollaxis(batch, channel_index, 4)
+    n, h, w = batch.shape[:3]
+
+    # Source point of every output point of every sample
+    rows, cols = np.mgrid[0:h, 0:w]
+    points = np.stack((rows.ravel(), cols.ravel(), np.ones(h * w)))
+    src = np.matmul(matrices[:, :2, :], points)
+
+    outside = None
+    if fill_mode == 'constant':
+        outside = ((src[:, 0] < 0) | (src[:, 0] > h - 1) |
+                   (src[:, 1] < 0) | (src[:, 1] > w - 1))
+    src_rows = np.floor(src[:, 0] + 0.5).astype(np.int64)
+    src_cols = np.floor(src[:, 1] + 0.5).astype(np.int64)
+    src_rows = fill_indices(src_rows, h, fill_mode)
+    src_cols = fill_indices(src_cols, w, fill_mode)
+
+    # One gather for the whole batch
+    out = batch[np.arange(n)[:, None], src_rows, src_cols]
+    if outside is not None:
+        out[outside] = cval
+
+    out = out.reshape((n, h, w, batch.shape[3]))
+    return np.rollaxis(out, 3, channel_index)
@@ -0,0 +1,179 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+import numpy as np
+from keras import backend as K
+
+from tools.resample import cast_image
+
+"""
+    Cache of the final batches of a deterministic iterator (the validation
+    set: no shuffle, no random augmentation). The batches of the first pass
+    over the dataset are stored, in memory or in .npy files on disk, and the
+    next passes serve them in the same order instead of reading, resizing
+    and standardizing the images again. The batches on disk are memory
+    mapped and reused by the next runs while the hash of the settings they
+    depend on does not change.
+    With uint8_augmentation the images are stored as uint8 and standardized
+    when they are served (a quarter of the memory).
+"""
+
+
+# Hash of the settings the batches depend on and of the samples
+def cache_key(settings, filenames):
+    h = hashlib.sha1(json.dumps(settings, sort_keys=True, default=str).encode('utf-8'))
+    for fname in filenames:
+        h.update(str(fname).encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class BatchCache(object):
+    """Iterator over the batches of a deterministic iterator, built once.
+    # Arguments
+        iterator: DirectoryIterator (or ShardIterator) of the batches. It
+            must not shuffle the samples nor augment them at random.
+        cache_dir: Directory of the stored batches, or None to keep them in
+            memory.
+        settings: Settings the batches depend on (dataset, loader and
+            normalization configuration). With the file names of the
+            iterator, they name the stored batches on disk.
+        name: Name of the batches in the messages.
+    """
+
+    def __init__(self, iterator, cache_dir=None, settings=None,
+                 name='batches'):
+        if iterator.shuffle:
+            raise ValueError('The batches of a shuffling iterator can not be '
+                             'cached')
+        if iterator.image_data_generator.has_random_transform():
+            raise ValueError('The batches of a random augmentation can not '
+                             'be cached')
+        self.iterator = iterator
+        self.directory = iterator.directory
+        self.name = name
+        self.lock = threading.Lock()
+
+        # Store the images as uint8 and standardize them when served
+        self.compact = iterator.image_data_generator.uint8_augmentation
+        iterator.standardize_batches = not self.compact
+
+        self.batches = []
+        self.nb_cached = 0
+        self.complete = False
+        self.position = 0
+
+        self.path = None
+        if cache_dir is not None:
+            key = cache_key(settings, iterator.filenames)
+            self.path = os.path.join(cache_dir, key)
+            if os.path.isfile(os.path.join(self.path, 'index.json')):
+                self.load()
+
+    def load(self):
+        # Memory map the batches stored by a previous run
+        with open(os.path.join(self.path, 'index.json')) as f:
+            index = json.load(f)
+        for i in range(index['nb_batch']):
+            self.batches.append(tuple(
+                np.load(os.path.join(self.path, '{:05d}_{}.npy'.format(i, k)),
+                        mmap_mode='r')
+                for k in range(index['nb_array'])))
+        self.complete = True
+        # The images are not read any more
+        self.iterator.close()
+        print('   {}: {} batches read from {}'.format(self.name,
+                                                      len(self.batches),
+                                                      self.path))
+
+    def save(self):
+        # Write the batches to a temporary directory, renamed when complete
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            if not os.path.exists(tmp_path):
+                os.makedirs(tmp_path)
+            for i, arrays in enumerate(self.batches):
+                for k, a in enumerate(arrays):
+                    np.save(os.path.join(tmp_path, '{:05d}_{}.npy'.format(i, k)), a)
+            with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+                json.dump({'nb_batch': len(self.batches),
+                           'nb_array': len(self.batches[0])}, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            print('   {}: could not save the batches to {}: {}'.format(
+                self.name, self.path, e))
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            return
+
+        # Serve the memory mapped files
+        self.batches = []
+        self.load()
+
+    def store(self, batch):
+        # Copy of a batch (the arrays of the iterator may be reused)
+        arrays = list(batch) if isinstance(batch, tuple) else [batch]
+        if self.compact:
+            arrays[0] = cast_image(arrays[0], np.uint8)
+            if self.iterator.has_gt_image:
+                arrays[1] = cast_image(arrays[1], np.uint8)
+        arrays = tuple(np.array(a) for a in arrays)
+        for a in arrays:
+            a.flags.writeable = False
+        return arrays
+
+    def serve(self, arrays):
+        if self.compact:
+            arrays = list(arrays)
+            batch_x = arrays[0].astype(K.floatx())
+            batch_y = None
+            if self.iterator.has_gt_image:
+                arrays[1] = batch_y = arrays[1].astype(K.floatx())
+            arrays[0] = self.iterator.image_data_generator.standardize_batch(
+                batch_x, batch_y)
+        if self.iterator.class_mode is None:
+            return arrays[0]
+        return tuple(arrays)
+
+    def next(self):
+        with self.lock:
+            if not self.complete:
+                # First pass: build the batches in order
+                batch = next(self.iterator)
+                arrays = self.store(batch)
+                self.batches.append(arrays)
+                self.nb_cached += len(arrays[0])
+                if self.nb_cached >= self.iterator.nb_sample:
+                    self.complete = True
+                    self.iterator.close()
+                    size = sum(a.nbytes for arrays in self.batches for a in arrays)
+                    print('\n   {}: {} batches cached ({:.1f} MB)'.format(
+                        self.name, len(self.batches), size / 2. ** 20))
+                    if self.path is not None:
+                        self.save()
+                return self.serve(arrays)
+
+            arrays = self.batches[self.position]
+            self.position = (self.position + 1) % len(self.batches)
+        return self.serve(arrays)
+
+    def set_workers(self, nb_worker, prefetch=None):
+        if not self.complete:
+            self.iterator.set_workers(nb_worker, prefetch)
+
+    def init_worker(self):
+        self.iterator.init_worker()
+
+    def close(self):
+        self.iterator.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
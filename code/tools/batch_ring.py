@@ -0,0 +1,46 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+"""
+    Preallocated batch arrays, reused in turn by the DirectoryIterator so
+    that no batch arrays are allocated while training.
+"""
+
+
+class BatchRing(object):
+    """Ring of preallocated batch arrays.
+    The arrays of a batch are overwritten `size` batches later, so size
+    must be larger than the number of batches the consumers hold at the same
+    time (queued batches plus the one in use), and the batches must be
+    finished in the order of their arrays (one thread building them).
+    # Arguments
+        size: Number of batches in the ring.
+        batch_size: Maximum number of samples of a batch.
+        x_shape: Shape of an image.
+        y_shape: Shape of a GT image or None.
+        dtype: Data type of the arrays.
+    """
+
+    def __init__(self, size, batch_size, x_shape, y_shape=None,
+                 dtype=np.float32):
+        self.size = size
+        self.batch_x = np.zeros((size, batch_size) + tuple(x_shape), dtype=dtype)
+        if y_shape is not None:
+            self.batch_y = np.zeros((size, batch_size) + tuple(y_shape), dtype=dtype)
+        else:
+            self.batch_y = None
+        self.position = 0
+
+    def next(self, n):
+        # Arrays of the next slot, for a batch of n samples
+        slot = self.position
+        self.position = (slot + 1) % self.size
+        batch_y = self.batch_y[slot, :n] if self.batch_y is not None else None
+        return self.batch_x[slot, :n], batch_y
+
+    def nbytes(self):
+        nbytes = self.batch_x.nbytes
+        if self.batch_y is not None:
+            nbytes += self.batch_y.nbytes
+        return nbytes
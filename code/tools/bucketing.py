@@ -0,0 +1,146 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+
+import numpy as np
+from PIL import Image
+
+from tools.manifest import Manifest, cache_path
+
+"""
+    Size bucketing of the samples of a dataset whose images have no fixed
+    target size (fully convolutional models at native resolution). The
+    samples are grouped in buckets of similar sizes, rounded up to a grid
+    step, and every batch is drawn from one bucket: its images are padded to
+    a common size by less than the step (not at all with a step of 1).
+    The image sizes are read from the file headers, without decoding, and
+    saved in the cache directory of the manifests.
+"""
+
+
+# Size (rows, cols) of an image file, read from its header
+def read_image_size(path):
+    img = Image.open(path)
+    try:
+        cols, rows = img.size
+    finally:
+        img.close()
+    return rows, cols
+
+
+def image_sizes(directory, filenames):
+    """Sizes (rows, cols) of the images of a directory. They are saved
+    with its manifest and read again while the manifest is valid.
+    # Arguments
+        directory: Path of the directory.
+        filenames: Paths of the images, relative to the directory.
+    # Return
+        Integer array of shape (n_images, 2)
+    """
+    manifest = Manifest.load(directory)
+    sizes_path = cache_path(directory, 'image_sizes.json')
+    saved = {}
+    if sizes_path is not None and os.path.isfile(sizes_path):
+        try:
+            with open(sizes_path) as f:
+                data = json.load(f)
+            if data['mtimes'] == manifest.mtimes:
+                saved = data['sizes']
+        except (IOError, OSError, ValueError, KeyError):
+            saved = {}
+
+    sizes = []
+    for fname in filenames:
+        size = saved.get(fname)
+        if size is None:
+            size = read_image_size(os.path.join(directory, fname))
+        sizes.append(tuple(size))
+
+    # Save them, if some were read
+    if sizes_path is not None and (len(saved) != len(filenames) or
+                                   any(f not in saved for f in filenames)):
+        saved.update((f, list(s)) for f, s in zip(filenames, sizes))
+        tmp_path = '{}.{}.tmp'.format(sizes_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'mtimes': manifest.mtimes, 'sizes': saved}, f)
+            os.rename(tmp_path, sizes_path)
+        except (IOError, OSError) as e:
+            print('   Could not save the image sizes of {}: {}'.format(directory, e))
+    return np.array(sizes, dtype=np.int64).reshape(-1, 2)
+
+
+def pad_concatenate(batches, value=0):
+    """Concatenate batches of images of different sizes, padding them at the
+    bottom and right to the largest one.
+    # Arguments
+        batches: Batches (arrays of shape (n, ...)) with the same number of
+            dimensions.
+        value: Value of the padded pixels.
+    """
+    shape = tuple(np.max([b.shape[1:] for b in batches], axis=0))
+    if all(b.shape[1:] == shape for b in batches):
+        return np.concatenate(batches)
+    batch = np.full((sum(len(b) for b in batches),) + shape, value,
+                    dtype=batches[0].dtype)
+    start = 0
+    for b in batches:
+        batch[(slice(start, start + len(b)),) +
+              tuple(slice(0, s) for s in b.shape[1:])] = b
+        start += len(b)
+    return batch
+
+
+class SizeBuckets(object):
+    """Samples grouped by size, for batches of images of similar sizes.
+    # Arguments
+        sizes: Size (rows, cols) of every sample.
+        batch_size: Maximum number of samples of a batch.
+        step: Grid step (in pixels) the sizes are rounded up to. 1 groups
+            the samples of the same size only.
+    """
+
+    def __init__(self, sizes, batch_size, step=32):
+        if step < 1:
+            raise ValueError('The bucket step must be at least 1')
+        self.batch_size = batch_size
+        self.step = step
+
+        sizes = np.asarray(sizes, dtype=np.int64).reshape(-1, 2)
+        keys = -(-sizes // step) * step
+        self.shapes, bucket_of = np.unique(keys, axis=0, return_inverse=True)
+        bucket_of = bucket_of.ravel()
+        self.buckets = [np.flatnonzero(bucket_of == b)
+                        for b in range(len(self.shapes))]
+
+        # Fraction of the pixels of the batches that are padding, at most
+        self.padding = 1. - (np.sum(np.prod(sizes, axis=1)) /
+                             float(np.sum(np.prod(keys, axis=1))))
+
+    def epoch(self, shuffle=True):
+        """Batches of an epoch. Each one holds the samples of one bucket,
+        and every bucket ends with a smaller batch if its size is not a
+        multiple of batch_size. The draws use the numpy RNG.
+        # Return
+            List of arrays of sample indices
+        """
+        batches = []
+        for bucket in self.buckets:
+            if shuffle:
+                bucket = np.random.permutation(bucket)
+            batches.extend(bucket[i:i + self.batch_size]
+                           for i in range(0, len(bucket), self.batch_size))
+        if shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return batches
+
+    def nb_batch(self):
+        return sum(-(-len(b) // self.batch_size) for b in self.buckets)
+
+    def summary(self):
+        return ('{} size buckets (step {}), {} batches per epoch, at most '
+                '{:.1f}% padding'.format(len(self.buckets), self.step,
+                                         self.nb_batch(), 100 * self.padding))
@@ -2,28 +2,42 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import os
+import threading
+import time
 import warnings
 
-import SimpleITK as sitk
 import numpy as np
 import skimage.io as io
 import skimage.transform
 from keras import backend as K
 from keras.preprocessing.image import (Iterator,
-                                       img_to_array,
                                        transform_matrix_offset_center,
                                        apply_transform,
                                        flip_axis,
                                        array_to_img,
-                                       NumpyArrayIterator,
-                                       random_channel_shift)
-from numpy import ma
+                                       NumpyArrayIterator)
+from multiprocessing.pool import ThreadPool
+from PIL import Image
 from numpy.linalg import inv
 from six.moves import range
 from skimage.color import rgb2gray, gray2rgb
+from tools.annotations import AnnotationIndex
+from tools.batch_augmentation import random_affine_matrices, batch_apply_transform
+from tools.batch_ring import BatchRing
+from tools.bucketing import SizeBuckets, image_sizes, pad_concatenate
+from tools.dataset_stats import image_mean_std, label_counts
+from tools.echo import SampleHold, echo_index
+from tools.elastic_warp import WarpFieldBank, apply_warp_field
+from tools.image_cache import ImageCache
+from tools.manifest import Manifest
+from tools.resample import cast_image, compose_matrix, resample_transform, transform_box_points
+from tools.sampling import ReadStats, block_permutation
 from tools.save_images import save_img2
+from tools.shards import ShardReader
+from tools.standardization import IMAGENET_BGR_MEAN, Standardization
 from tools.yolo_utils import yolo_build_gt_batch
 from tools.ssd_utils import BBoxUtility
+from tools.worker_pool import SharedBatchPool
 
 
 # Pad image
@@ -63,8 +77,10 @@ def pad_image(x, pad_amount, mode='reflect', constant=0.):
     return x_padded
 
 
-# Define warp
+# Define warp (SimpleITK engine, only imported when it is used)
 def gen_warp_field(shape, sigma=0.1, grid_size=3):
+    import SimpleITK as sitk
+
     # Initialize bspline transform
     args = shape + (sitk.sitkFloat32,)
     ref_image = sitk.Image(*args)
@@ -93,8 +109,12 @@ def gen_warp_field(shape, sigma=0.1, grid_size=3):
 
 # Apply warp
 def apply_warp(x, warp_field, fill_mode='reflect',
-               interpolator=sitk.sitkLinear,
+               interpolator='linear',
                fill_constant=0):
+    import SimpleITK as sitk
+    interpolator = {'linear': sitk.sitkLinear,
+                    'nearest': sitk.sitkNearestNeighbor}[interpolator]
+
     # Expand deformation field (and later the image), padding for the largest
     # deformation
     warp_field_arr = sitk.GetArrayFromImage(warp_field)
@@ -121,13 +141,44 @@ def apply_warp(x, warp_field, fill_mode='reflect',
     return x_warped
 
 
+# Add an intensity to each channel, clipped to the range of the image
+def channel_shift(x, shifts, channel_index=0):
+    x = np.rollaxis(x, channel_index, 0)
+    min_x, max_x = np.min(x), np.max(x)
+    channel_images = [np.clip(x_channel + shift, min_x, max_x)
+                      for x_channel, shift in zip(x, shifts)]
+    x = np.stack(channel_images, axis=0)
+    x = np.rollaxis(x, 0, channel_index + 1)
+    return x
+
+
+# Transform boxes [x1, y1, x2, y2] with a matrix acting on [row, col, 1]
+# points and return the boxes enclosing the transformed corners
+def transform_boxes(b, p_transform_matrix):
+    # Corners (y1, x1), (y2, x2), (y2, x1), (y1, x2) of each box as a
+    # (n_boxes, 4, 3) tensor of homogeneous points
+    b_int = b.astype(int)
+    corners = np.ones((b.shape[0], 4, 3))
+    corners[:, :, 0] = b_int[:, [1, 3, 3, 1]]
+    corners[:, :, 1] = b_int[:, [0, 2, 0, 2]]
+
+    # Transform all the corners at once (one matrix row at a time, which
+    # gives the same rounding as transforming each corner on its own)
+    corners = corners.reshape(-1, 3)
+    rows = np.dot(corners, p_transform_matrix[0]).reshape(-1, 4)
+    cols = np.dot(corners, p_transform_matrix[1]).reshape(-1, 4)
+
+    b = np.empty_like(b)
+    b[:, 0] = cols.min(axis=1)
+    b[:, 1] = rows.min(axis=1)
+    b[:, 2] = cols.max(axis=1)
+    b[:, 3] = rows.max(axis=1)
+    return b
+
+
 # List the subdirectories in a directory
 def list_subdirs(directory):
-    subdirs = []
-    for subdir in sorted(os.listdir(directory)):
-        if os.path.isdir(os.path.join(directory, subdir)):
-            subdirs.append(subdir)
-    return subdirs
+    return Manifest.load(directory).subdir_names()
 
 
 # Checks if a file is an image
@@ -138,28 +189,211 @@ def has_valid_extension(fname, white_list_formats={'png', 'jpg', 'jpeg', 'bmp',
     return False
 
 
-# Load image
-def load_img(path, grayscale=False, resize=None, order=1):
-    # Load image
-    img = io.imread(path)
+# JPEG images larger than the resize are decoded by the codec at a reduced
+# scale (1/2, 1/4 or 1/8) that is still at least the resize
+def is_jpeg(path):
+    return os.path.splitext(path)[1].lower() in {'.jpg', '.jpeg'}
+
+
+def jpeg_scale(path, resize):
+    # Only the header of the file is read
+    width, height = Image.open(path).size
+    for scale in (8, 4, 2):
+        if height // scale >= resize[0] and width // scale >= resize[1]:
+            return scale
+    return 1
+
+
+class SkimageBackend(object):
+    """Image backend using skimage, the reference of the other backends.
+    Resized images are float64.
+    Interpolation: order 1 is bilinear, order 0 is nearest neighbour.
+    """
+    name = 'skimage'
+
+    def imread(self, path, resize=None):
+        if resize is not None and is_jpeg(path):
+            # Reduced scale JPEG decoding with PIL
+            img = Image.open(path)
+            img.draft(img.mode, (resize[1], resize[0]))
+            if img.mode not in {'L', 'RGB'}:
+                img = img.convert('RGB')
+            return np.asarray(img)
+        return io.imread(path)
+
+    def resize(self, img, size, order):
+        return skimage.transform.resize(img, size, order=order,
+                                        preserve_range=True)
+
+    def gray2rgb(self, img):
+        return gray2rgb(img)
+
+    def rgb2gray(self, img):
+        # skimage scales integer images to [0, 1], a float image keeps the
+        # range of the file as with the other backends
+        return rgb2gray(img.astype(np.float64))
+
 
-    # Resize
-    # print('Desired resize: ' + str(resize))
-    if resize is not None:
-        img = skimage.transform.resize(img, resize, order=order,
-                                       preserve_range=True)
-        # print('Final resize: ' + str(img.shape))
+# Color conversions of the uint8 backends, without scaling the values
+def stack_gray2rgb(img):
+    return np.repeat(img[:, :, None], 3, axis=2)
+
+
+def weighted_rgb2gray(img):
+    # Same weights as skimage rgb2gray
+    return np.dot(img[..., :3].astype(np.float32),
+                  np.array([0.2125, 0.7154, 0.0721], dtype=np.float32))
+
+
+class OpenCVBackend(SkimageBackend):
+    """Image backend using OpenCV. uint8 images stay uint8.
+    Interpolation: order 1 is cv2.INTER_LINEAR, order 0 is
+    cv2.INTER_NEAREST_EXACT (pixel centers, as skimage) when available.
+    """
+    name = 'opencv'
+
+    def __init__(self):
+        import cv2
+        self.cv2 = cv2
+        self.nearest = getattr(cv2, 'INTER_NEAREST_EXACT', cv2.INTER_NEAREST)
+
+    def imread(self, path, resize=None):
+        cv2 = self.cv2
+        if resize is not None and is_jpeg(path):
+            # Reduced scale decoding with the libjpeg scale factors
+            scale = jpeg_scale(path, resize)
+            gray = Image.open(path).mode == 'L'
+            if scale == 1:
+                flags = cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR
+            else:
+                flags = getattr(cv2, 'IMREAD_REDUCED_{}_{}'.format(
+                    'GRAYSCALE' if gray else 'COLOR', scale))
+        else:
+            flags = cv2.IMREAD_UNCHANGED
+        img = cv2.imread(path, flags)
+        if img is None:
+            raise IOError('Could not read image: ' + path)
+        if img.ndim == 3 and img.shape[2] == 3:
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        elif img.ndim == 3 and img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2RGBA)
+        return img
+
+    def resize(self, img, size, order):
+        interpolation = self.cv2.INTER_LINEAR if order == 1 else self.nearest
+        resized = self.cv2.resize(img, (size[1], size[0]),
+                                  interpolation=interpolation)
+        # cv2 drops the channel axis of single channel images
+        return resized.reshape(tuple(size) + img.shape[2:])
+
+    def gray2rgb(self, img):
+        return stack_gray2rgb(img)
+
+    def rgb2gray(self, img):
+        return weighted_rgb2gray(img)
+
+
+class PILBackend(SkimageBackend):
+    """Image backend using PIL (or Pillow-SIMD). uint8 images stay uint8.
+    Interpolation: order 1 is Image.BILINEAR, order 0 is Image.NEAREST.
+    PIL widens the bilinear filter when downscaling (antialiasing).
+    """
+    name = 'pil'
+
+    def imread(self, path, resize=None):
+        img = Image.open(path)
+        if resize is not None and is_jpeg(path):
+            img.draft(img.mode, (resize[1], resize[0]))
+        if img.mode in {'P', 'CMYK', 'YCbCr'}:
+            img = img.convert('RGB')
+        return np.asarray(img)
+
+    def resize(self, img, size, order):
+        if img.dtype != np.uint8 or (img.ndim == 3 and img.shape[2] not in {3, 4}):
+            # PIL only resizes 8 bit images with 1, 3 or 4 channels
+            return super(PILBackend, self).resize(img, size, order)
+        resample = Image.BILINEAR if order == 1 else Image.NEAREST
+        resized = Image.fromarray(img).resize((size[1], size[0]), resample)
+        return np.asarray(resized)
+
+    def gray2rgb(self, img):
+        return stack_gray2rgb(img)
+
+    def rgb2gray(self, img):
+        return weighted_rgb2gray(img)
+
+
+image_backends = {'skimage': SkimageBackend,
+                  'opencv': OpenCVBackend,
+                  'pil': PILBackend}
+_backends = {}
+
+
+# Get the image backend of a name (one instance per process)
+def get_backend(name='skimage'):
+    if name not in image_backends:
+        raise ValueError('Unknown image backend: ' + str(name))
+    if name not in _backends:
+        _backends[name] = image_backends[name]()
+    return _backends[name]
+
+
+# Load image. With dtype the image is returned with that data type, cast
+# once from the decoded or cached image
+def load_img(path, grayscale=False, resize=None, order=1, cache=None,
+             dtype=None, backend='skimage'):
+    backend = get_backend(backend)
+
+    # Look for the decoded and resized image in the cache
+    img = None
+    if cache is not None:
+        key = cache.key(path, resize, order, backend.name)
+        img = cache.get(key)
+        if img is not None and resize is not None and dtype is None:
+            # The resize returns floats
+            img = img.astype(np.float64)
+
+    if img is None:
+        # Load image
+        img = backend.imread(path, resize)
+        src_dtype = img.dtype
+
+        # Resize
+        # print('Desired resize: ' + str(resize))
+        if resize is not None:
+            img = backend.resize(img, resize, order)
+            # print('Final resize: ' + str(img.shape))
+
+        if cache is not None:
+            img = cache.put(key, img, src_dtype)
+            if resize is not None and dtype is None:
+                img = img.astype(np.float64)
+
+    if dtype is not None:
+        img = cast_image(img, dtype)
 
     # Color conversion
     if len(img.shape) == 2 and not grayscale:
-        img = gray2rgb(img)
+        img = backend.gray2rgb(img)
     elif len(img.shape) > 2 and img.shape[2] == 3 and grayscale:
-        img = rgb2gray(img)
+        img = backend.rgb2gray(img)
+        if dtype is not None:
+            img = cast_image(img, dtype)
 
     # Return image
     return img
 
 
+# As keras img_to_array, keeping the data type of the image
+def image_array(img, dim_ordering):
+    x = np.asarray(img)
+    if x.ndim == 2:
+        x = x[np.newaxis] if dim_ordering == 'th' else x[..., np.newaxis]
+    elif dim_ordering == 'th':
+        x = x.transpose(2, 0, 1)
+    return x
+
+
 class ImageDataGenerator(object):
     """
     Generate minibatches withGT4_DAComb_3cl_224x224_rescale_lr10-4_noCWB
@@ -188,11 +422,26 @@ class ImageDataGenerator(object):
         rescale: rescaling factor. If None or 0, no rescaling is applied,
             otherwise we multiply the data by the value provided (before
             applying any other transformation).
+        spline_warp: whether to apply a random elastic deformation.
+        warp_sigma: std of the shifts (pixels) of the deformation control
+            points.
+        warp_grid_size: number of mesh intervals of the deformation grid.
+        warp_engine: 'bank' to draw the deformation from a bank of
+            precomputed warp fields or 'sitk' to compute a new one per image
+            with SimpleITK ('th' only).
+        warp_bank_size: number of warp fields in the bank.
         dim_ordering: 'th' or 'tf'. In 'th' mode, the channels dimension
             (the depth) is at index 1, in 'tf' mode it is at index 3.
             It defaults to the `image_dim_ordering` value found in your
             Keras config file at `~/.keras/keras.json`.
             If you never set it, then it will be "th".
+        batch_affine: whether the DirectoryIterator applies the rotation,
+            shift, shear and zoom to the whole batch at once (nearest
+            neighbour resampling) instead of image by image.
+        uint8_augmentation: whether the DirectoryIterator decodes, augments
+            and crops the images (and masks) as uint8, and standardizes the
+            whole batch once it is collated. For 8 bit images only. cval and
+            channel_shift_range are then in pixel values (0-255).
     """
 
     def __init__(self,
@@ -219,12 +468,16 @@ class ImageDataGenerator(object):
                  spline_warp=False,
                  warp_sigma=0.1,
                  warp_grid_size=3,
+                 warp_engine='bank',
+                 warp_bank_size=16,
                  dim_ordering='default',
                  class_mode='categorical',
                  rgb_mean=None,
                  rgb_std=None,
                  crop_size=None,
-                 yolo=False):
+                 yolo=False,
+                 batch_affine=False,
+                 uint8_augmentation=False):
         if dim_ordering == 'default':
             dim_ordering = K.image_dim_ordering()
         self.__dict__.update(locals())
@@ -233,6 +486,7 @@ class ImageDataGenerator(object):
         self.preprocessing_function = preprocessing_function
         self.cb_weights = None
         self.yolo = yolo
+        self.warp_bank = None
         if dim_ordering not in {'tf', 'th'}:
             raise Exception('dim_ordering should be "tf" (channel after row '
                             'and column) or "th" (channel before row and '
@@ -278,6 +532,18 @@ class ImageDataGenerator(object):
                              '"binary", "sparse", "segmentation", "detection" or None.')
         self.class_mode = class_mode
         self.has_gt_image = True if self.class_mode == 'segmentation' else False
+        self.compile_standardization()
+
+        # The geometric augmentation is one resampling pass (see
+        # tools/resample.py), except with the 'wrap' fill mode (scipy does not
+        # wrap as numpy indexing does) and the SimpleITK warp engine
+        self.resample_once = (fill_mode != 'wrap' and
+                              not (spline_warp and warp_engine == 'sitk'))
+
+        # The crop window can be drawn before the standardization when it is
+        # local to each pixel
+        self.crop_first = (self.resample_once and bool(crop_size) and
+                           not gcn and not zca_whitening)
 
     def flow(self, X, y=None, batch_size=32, shuffle=True, seed=None,
              save_to_dir=None, save_prefix='', save_format='jpeg'):
@@ -295,7 +561,10 @@ class ImageDataGenerator(object):
                             batch_size=32, shuffle=True, seed=None,
                             gt_directory=None,
                             save_to_dir=None, save_prefix='',
-                            save_format='jpeg'):
+                            save_format='jpeg', nb_worker=0, prefetch=2,
+                            cache_size=0, cache_dir=None, ring_size=0,
+                            backend='skimage', bucket_step=0, echo_factor=1,
+                            echo_buffer=4, shuffle_block=0, shuffle_buffer=0):
         return DirectoryIterator(
             directory, self, resize=resize,
             target_size=target_size, color_mode=color_mode,
@@ -304,7 +573,35 @@ class ImageDataGenerator(object):
             batch_size=batch_size, shuffle=shuffle, seed=seed,
             gt_directory=gt_directory,
             save_to_dir=save_to_dir, save_prefix=save_prefix,
-            save_format=save_format, yolo=self.yolo)
+            save_format=save_format, yolo=self.yolo,
+            nb_worker=nb_worker, prefetch=prefetch,
+            cache_size=cache_size, cache_dir=cache_dir, ring_size=ring_size,
+            backend=backend, bucket_step=bucket_step, echo_factor=echo_factor,
+            echo_buffer=echo_buffer, shuffle_block=shuffle_block,
+            shuffle_buffer=shuffle_buffer)
+
+    def flow_from_shards(self, directory,
+                         resize=None, target_size=(256, 256),
+                         color_mode='rgb',
+                         classes=None, class_mode='categorical',
+                         batch_size=32, shuffle=True, seed=None,
+                         save_to_dir=None, save_prefix='',
+                         save_format='jpeg', nb_worker=0, prefetch=2,
+                         ring_size=0, backend='skimage', bucket_step=0,
+                         echo_factor=1, echo_buffer=4, shuffle_block=0,
+                         shuffle_buffer=0):
+        return ShardIterator(
+            directory, self, resize=resize,
+            target_size=target_size, color_mode=color_mode,
+            classes=classes, class_mode=class_mode,
+            dim_ordering=self.dim_ordering,
+            batch_size=batch_size, shuffle=shuffle, seed=seed,
+            save_to_dir=save_to_dir, save_prefix=save_prefix,
+            save_format=save_format, yolo=self.yolo,
+            nb_worker=nb_worker, prefetch=prefetch, ring_size=ring_size,
+            backend=backend, bucket_step=bucket_step, echo_factor=echo_factor,
+            echo_buffer=echo_buffer, shuffle_block=shuffle_block,
+            shuffle_buffer=shuffle_buffer)
 
     def flow_from_directory2(self, directory,
                              resize=None, target_size=(256, 256),
@@ -314,7 +611,11 @@ class ImageDataGenerator(object):
                              gt_directory=None,
                              save_to_dir=None, save_prefix='',
                              save_format='jpeg', directory2=None,
-                             gt_directory2=None, batch_size2=None):
+                             gt_directory2=None, batch_size2=None,
+                             nb_worker=0, prefetch=2,
+                             cache_size=0, cache_dir=None, ring_size=0,
+                             backend='skimage', bucket_step=0, echo_factor=1,
+                             echo_buffer=4, shuffle_block=0, shuffle_buffer=0):
         return DirectoryIterator2(
             directory, self, resize=resize,
             target_size=target_size, color_mode=color_mode,
@@ -325,104 +626,97 @@ class ImageDataGenerator(object):
             save_to_dir=save_to_dir, save_prefix=save_prefix,
             save_format=save_format,
             directory2=directory2, gt_directory2=gt_directory2,
-            batch_size2=batch_size2)
-
-    def standardize(self, x, y=None):
+            batch_size2=batch_size2, nb_worker=nb_worker, prefetch=prefetch,
+            cache_size=cache_size, cache_dir=cache_dir, ring_size=ring_size,
+            backend=backend, bucket_step=bucket_step, echo_factor=echo_factor,
+            echo_buffer=echo_buffer, shuffle_block=shuffle_block,
+            shuffle_buffer=shuffle_buffer)
+
+    def flow_from_directories(self, directories, gt_directories=None,
+                              weights=None, batch_size=32, ring_size=0,
+                              **kwargs):
+        # Batches mixing the samples of several directories, in proportion
+        # to their weights. kwargs are the arguments of flow_from_directory
+        if weights is None:
+            weights = [1.] * len(directories)
+        return MultiDirectoryIterator(
+            directories, self, gt_directories=gt_directories,
+            batch_sizes=split_batch_size(batch_size, weights),
+            ring_size=ring_size, dim_ordering=self.dim_ordering, **kwargs)
+
+    def compile_standardization(self):
+        """Fold the standardization settings (and the fitted statistics)
+        into one Standardization, applied per batch. Called again by fit and
+        fit_from_directory.
+        """
+        n_channels = 3
+        broadcast_shape = [1, 1, 1]
+        broadcast_shape[self.channel_index - 1] = n_channels
         if self.imageNet:
-            if self.dim_ordering == 'th':
-                # 'RGB'->'BGR'
-                x = x[::-1, :, :]
-                # Zero-center by mean pixel
-                x[0, :, :] -= 103.939
-                x[1, :, :] -= 116.779
-                x[2, :, :] -= 123.68
-            else:
-                # 'RGB'->'BGR'
-                x = x[:, :, ::-1]
-                # Zero-center by mean pixel
-                x[:, :, 0] -= 103.939
-                x[:, :, 1] -= 116.779
-                x[:, :, 2] -= 123.68
-            return x
-
-        # x is a single image, so it doesn't have image number at index 0
-        img_channel_index = self.channel_index - 1
-
-        if self.rescale:
-            x *= self.rescale
-
-        if self.gcn:
-            x_before = x.copy()
-            # Compute the void mask
-            mask = np.ones_like(y).astype('int32')
-            mask[y == self.void_label] = 0.
-            mask = np.repeat(mask, 3, axis=0)
-
-            # Mask image
-            x_masked = ma.masked_array(x, mask=~mask.astype(bool))
-
-            # Compute mean and std masked
-            mean_masked = np.mean(x_masked)
-            std_masked = np.std(x_masked)
-
-            # Normalize
-            s = 1
-            eps = 1e-8
-            x = s * (x - mean_masked) / max(eps, std_masked)
-
-            # Set void pixels to 0
-            x = x * mask
-
-        if self.samplewise_center:
-            x -= np.mean(x, axis=img_channel_index, keepdims=True)
-        if self.samplewise_std_normalization:
-            x /= (np.std(x, axis=img_channel_index, keepdims=True) + 1e-7)
-
+            # 'RGB'->'BGR' and zero-center by mean pixel
+            self.standardization = Standardization(
+                self.channel_index, permutation=[2, 1, 0],
+                offset=-np.reshape(IMAGENET_BGR_MEAN, broadcast_shape),
+                dtype=K.floatx())
+            return
+
+        # The rescale is folded into the scale unless data dependent steps
+        # come after it
+        data_dependent = (self.gcn or self.samplewise_center or
+                          self.samplewise_std_normalization)
+        pre_scale = self.rescale if self.rescale and data_dependent else None
+        scale = self.rescale if self.rescale and not data_dependent else 1.
+        offset = 0.
+
+        # Settings without statistics are skipped (with a warning per batch)
+        mean = getattr(self, 'mean', None)
+        std = getattr(self, 'std', None)
+        not_fitted = []
         if self.featurewise_center:
-            if self.mean is not None:
-                x -= self.mean
+            if mean is not None:
+                offset = -mean
             else:
-                warnings.warn('This ImageDataGenerator specifies '
-                              '`featurewise_center`, but it hasn\'t'
-                              'been fit on any training data. Fit it '
-                              'first by calling `.fit(numpy_data)`.')
+                not_fitted.append('featurewise_center')
         if self.featurewise_std_normalization:
-            if self.std is not None:
-                x /= (self.std + 1e-7)
+            if std is not None:
+                scale = scale / (std + 1e-7)
+                offset = offset / (std + 1e-7)
             else:
-                warnings.warn('This ImageDataGenerator specifies '
-                              '`featurewise_std_normalization`, but it hasn\'t'
-                              'been fit on any training data. Fit it '
-                              'first by calling `.fit(numpy_data)`.')
-
-        if self.zca_whitening:
-            if self.principal_components is not None:
-                flatx = np.reshape(x, (x.size))
-                whitex = np.dot(flatx, self.principal_components)
-                x = np.reshape(whitex, (x.shape[0], x.shape[1], x.shape[2]))
-            else:
-                warnings.warn('This ImageDataGenerator specifies '
-                              '`zca_whitening`, but it hasn\'t'
-                              'been fit on any training data. Fit it '
-                              'first by calling `.fit(numpy_data)`.')
-
-        return x
-
-    def random_transform(self, x, y=None):
-        # x is a single image, so it doesn't have image number at index 0
-        img_row_index = self.row_index - 1
-        img_col_index = self.col_index - 1
-        img_channel_index = self.channel_index - 1
+                not_fitted.append('featurewise_std_normalization')
+        if self.zca_whitening and self.principal_components is None:
+            not_fitted.append('zca_whitening')
+
+        self.standardization = Standardization(
+            self.channel_index, scale=scale, offset=offset,
+            pre_scale=pre_scale, gcn=self.gcn, void_label=self.void_label,
+            samplewise_center=self.samplewise_center,
+            samplewise_std_normalization=self.samplewise_std_normalization,
+            principal_components=(self.principal_components
+                                  if self.zca_whitening else None),
+            not_fitted=not_fitted, dtype=K.floatx())
+
+    def standardize_batch(self, batch_x, batch_y=None):
+        """Standardize a batch of images in place.
+        # Arguments
+            batch_x: Batch of images (float).
+            batch_y: Batch of GT images, needed by the GCN.
+        """
+        return self.standardization.apply(batch_x, batch_y)
 
-        # prepare the data if GT is detection
-        if self.class_mode == 'detection':
-            h, w = x.shape[img_row_index], x.shape[img_col_index]
-            # convert relative coordinates x,y,w,h to absolute x1,y1,x2,y2
-            b = np.copy(y[:, 1:5])
-            b[:, 0] = y[:, 1] * w - y[:, 3] * w / 2
-            b[:, 1] = y[:, 2] * h - y[:, 4] * h / 2
-            b[:, 2] = y[:, 1] * w + y[:, 3] * w / 2
-            b[:, 3] = y[:, 2] * h + y[:, 4] * h / 2
+    def standardize(self, x, y=None):
+        # x is a single image, standardized as a batch of one
+        if not np.issubdtype(x.dtype, np.floating):
+            x = x.astype(K.floatx())
+        batch_y = y[np.newaxis] if self.gcn else None
+        return self.standardize_batch(x[np.newaxis], batch_y)[0]
+
+    def draw_transform(self, h, w, n_channels):
+        """Draw the random parameters of the augmentation of an image of
+        h x w pixels, in the order random_transform has always drawn them.
+        The crop window is drawn last, for the image padded to the crop
+        size if it is smaller.
+        """
+        p = {}
 
         # use composition of homographies to generate final transform that
         # needs to be applied
@@ -439,7 +733,7 @@ class ImageDataGenerator(object):
         # Shift in height
         if self.height_shift_range:
             tx = np.random.uniform(-self.height_shift_range,
-                                   self.height_shift_range) * x.shape[img_row_index]
+                                   self.height_shift_range) * h
             need_transform = True
         else:
             tx = 0
@@ -447,7 +741,7 @@ class ImageDataGenerator(object):
         # Shift in width
         if self.width_shift_range:
             ty = np.random.uniform(-self.width_shift_range,
-                                   self.width_shift_range) * x.shape[img_col_index]
+                                   self.width_shift_range) * w
             need_transform = True
         else:
             ty = 0
@@ -467,6 +761,7 @@ class ImageDataGenerator(object):
                                        self.zoom_range[1], 2)
             need_transform = True
 
+        p['transform_matrix'] = None
         if need_transform:
             rotation_matrix = np.array([[np.cos(theta), -np.sin(theta), 0],
                                         [np.sin(theta), np.cos(theta), 0],
@@ -487,10 +782,90 @@ class ImageDataGenerator(object):
             transform_matrix = np.dot(np.dot(np.dot(rotation_matrix,
                                                     translation_matrix),
                                              shear_matrix), zoom_matrix)
+            p['transform_matrix'] = transform_matrix_offset_center(
+                transform_matrix, h, w)
+
+        # Channel shift, one intensity per channel
+        p['channel_shifts'] = None
+        if self.channel_shift_range != 0:
+            p['channel_shifts'] = np.array(
+                [np.random.uniform(-self.channel_shift_range,
+                                   self.channel_shift_range)
+                 for _ in range(n_channels)])
+
+        p['horizontal_flip'] = self.horizontal_flip and np.random.random() < 0.5
+        p['vertical_flip'] = self.vertical_flip and np.random.random() < 0.5
 
-            h, w = x.shape[img_row_index], x.shape[img_col_index]
-            transform_matrix = transform_matrix_offset_center(transform_matrix,
-                                                              h, w)
+        # Elastic deformation
+        p['warp'] = None
+        if self.spline_warp:
+            if self.warp_engine == 'sitk':
+                p['warp'] = gen_warp_field(shape=(h, w),
+                                           sigma=self.warp_sigma,
+                                           grid_size=self.warp_grid_size)
+            elif self.warp_engine == 'bank':
+                if self.warp_bank is None:
+                    self.warp_bank = WarpFieldBank(self.warp_bank_size)
+                p['warp'] = self.warp_bank.get((h, w),
+                                               sigma=self.warp_sigma,
+                                               grid_size=self.warp_grid_size)
+            else:
+                raise ValueError('Unknown warp engine: ' + str(self.warp_engine))
+
+        # Crop window (top, left, rows, cols)
+        p['crop'] = None
+        if self.crop_size:
+            crop = list(self.crop_size)
+            h, w = max(h, crop[0]), max(w, crop[1])
+            if crop[0] < h:
+                top = np.random.randint(h - crop[0])
+            else:
+                top, crop[0] = 0, h
+            if crop[1] < w:
+                left = np.random.randint(w - crop[1])
+            else:
+                left, crop[1] = 0, w
+            p['crop'] = (top, left, crop[0], crop[1])
+
+        return p
+
+    def random_transform(self, x, y=None, affine=True, standardize=False,
+                         p=None):
+        # x is a single image, so it doesn't have image number at index 0
+        # affine=False skips the rotation, shift, shear and zoom (already
+        # applied by batch_affine_transform)
+        # standardize=True standardizes x first. With crop_first only the
+        # source region of the crop is standardized
+        # p are the parameters of draw_transform, drawn here if None
+        img_row_index = self.row_index - 1
+        img_col_index = self.col_index - 1
+        img_channel_index = self.channel_index - 1
+        h, w = x.shape[img_row_index], x.shape[img_col_index]
+
+        if p is None:
+            p = self.draw_transform(h, w, x.shape[img_channel_index])
+        if not affine:
+            p['transform_matrix'] = None
+
+        if self.resample_once:
+            return self.transform_once(x, y, p, standardize)
+
+        # Step by step augmentation
+        if standardize:
+            x = self.standardize(x, y)
+        x_dtype = x.dtype
+        y_dtype = y.dtype if y is not None and self.has_gt_image else None
+
+        # prepare the data if GT is detection
+        if self.class_mode == 'detection':
+            # convert relative coordinates x,y,w,h to absolute x1,y1,x2,y2
+            size = np.array([w, h])
+            centers = y[:, 1:3] * size
+            half_sizes = y[:, 3:5] * size / 2
+            b = np.hstack((centers - half_sizes, centers + half_sizes))
+
+        transform_matrix = p['transform_matrix']
+        if transform_matrix is not None:
             x = apply_transform(x, transform_matrix, img_channel_index,
                                 fill_mode=self.fill_mode, cval=self.cval)
             if y is not None:
@@ -499,84 +874,68 @@ class ImageDataGenerator(object):
                                         fill_mode=self.fill_mode, cval=self.void_label)
                 elif self.class_mode == 'detection':
                     # point transformation is the inverse of image transformation
-                    p_transform_matrix = inv(transform_matrix)
-                    for ii in range(b.shape[0]):
-                        x1, y1, x2, y2 = b.astype(int)[ii]
-                        # get the four edge points of the bounding box
-                        v1 = np.array([y1, x1, 1])
-                        v2 = np.array([y2, x2, 1])
-                        v3 = np.array([y2, x1, 1])
-                        v4 = np.array([y1, x2, 1])
-                        # transform the 4 points
-                        v1 = np.dot(p_transform_matrix, v1)
-                        v2 = np.dot(p_transform_matrix, v2)
-                        v3 = np.dot(p_transform_matrix, v3)
-                        v4 = np.dot(p_transform_matrix, v4)
-                        # compute the new bounding box edges
-                        b[ii, 0] = np.min([v1[1], v2[1], v3[1], v4[1]])
-                        b[ii, 1] = np.min([v1[0], v2[0], v3[0], v4[0]])
-                        b[ii, 2] = np.max([v1[1], v2[1], v3[1], v4[1]])
-                        b[ii, 3] = np.max([v1[0], v2[0], v3[0], v4[0]])
+                    b = transform_boxes(b, inv(transform_matrix))
 
-        if self.channel_shift_range != 0:
-            x = random_channel_shift(x, self.channel_shift_range,
-                                     img_channel_index)
+        if p['channel_shifts'] is not None:
+            x = channel_shift(x, p['channel_shifts'], img_channel_index)
 
-        if self.horizontal_flip:
-            if np.random.random() < 0.5:
-                x = flip_axis(x, img_col_index)
-                if y is not None:
-                    if self.has_gt_image:
-                        y = flip_axis(y, img_col_index)
-                    elif self.class_mode == 'detection':
-                        b[:, 0], b[:, 2] = w - b[:, 2], w - b[:, 0]
+        if p['horizontal_flip']:
+            x = flip_axis(x, img_col_index)
+            if y is not None:
+                if self.has_gt_image:
+                    y = flip_axis(y, img_col_index)
+                elif self.class_mode == 'detection':
+                    b[:, [0, 2]] = w - b[:, [2, 0]]
 
-        if self.vertical_flip:
-            if np.random.random() < 0.5:
-                x = flip_axis(x, img_row_index)
-                if y is not None:
-                    if self.has_gt_image:
-                        y = flip_axis(y, img_row_index)
-                    elif self.class_mode == 'detection':
-                        b[:, 1], b[:, 3] = h - b[:, 3], h - b[:, 1]
+        if p['vertical_flip']:
+            x = flip_axis(x, img_row_index)
+            if y is not None:
+                if self.has_gt_image:
+                    y = flip_axis(y, img_row_index)
+                elif self.class_mode == 'detection':
+                    b[:, [1, 3]] = h - b[:, [3, 1]]
 
         if self.spline_warp:
-            warp_field = gen_warp_field(shape=x.shape[-2:],
-                                        sigma=self.warp_sigma,
-                                        grid_size=self.warp_grid_size)
-            x = apply_warp(x, warp_field,
-                           interpolator=sitk.sitkLinear,
-                           fill_mode=self.fill_mode, fill_constant=self.cval)
+            if y is not None and self.class_mode == 'detection':
+                raise ValueError('Elastic deformation is not supported for class_mode:', self.class_mode)
 
-            if y is not None:
-                if self.has_gt_image:
+            if self.warp_engine == 'sitk':
+                warp_field = p['warp']
+                x = apply_warp(x, warp_field,
+                               interpolator='linear',
+                               fill_mode=self.fill_mode, fill_constant=self.cval)
+
+                if y is not None and self.has_gt_image:
                     y = np.round(apply_warp(y, warp_field,
-                                            interpolator=sitk.sitkNearestNeighbor,
+                                            interpolator='nearest',
                                             fill_mode=self.fill_mode,
                                             fill_constant=self.void_label))
-                elif self.class_mode == 'detection':
-                    raise ValueError('Elastic deformation is not supported for class_mode:', self.class_mode)
+            else:
+                x, y_warped = apply_warp_field(p['warp'], x,
+                                               y if self.has_gt_image else None,
+                                               channel_index=img_channel_index,
+                                               fill_mode=self.fill_mode,
+                                               cval=self.cval,
+                                               y_cval=self.void_label)
+                if self.has_gt_image:
+                    y = y_warped
 
         # Crop
         # TODO: tf compatible???
-        crop = list(self.crop_size) if self.crop_size else None
-        if crop:
-            # print ('X before: ' + str(x.shape))
-            # print ('Y before: ' + str(y.shape))
-            # print ('Crop_size: ' + str(self.crop_size))
-            h, w = x.shape[img_row_index], x.shape[img_col_index]
+        if p['crop'] is not None:
+            top, left, crop_h, crop_w = p['crop']
 
             # Padd image if it is smaller than the crop size
             pad_h1, pad_h2, pad_w1, pad_w2 = 0, 0, 0, 0
-            if h < crop[0]:
-                total_pad = crop[0] - h
-                pad_h1 = total_pad / 2
+            if h < crop_h:
+                total_pad = crop_h - h
+                pad_h1 = total_pad // 2
                 pad_h2 = total_pad - pad_h1
-            if w < crop[1]:
-                total_pad = crop[1] - w
-                pad_w1 = total_pad / 2
+            if w < crop_w:
+                total_pad = crop_w - w
+                pad_w1 = total_pad // 2
                 pad_w2 = total_pad - pad_w1
-            if h < crop[0] or w < crop[1]:
+            if h < crop_h or w < crop_w:
                 x = np.lib.pad(x, ((0, 0), (pad_h1, pad_h2), (pad_w1, pad_w2)),
                                'constant')
                 if y is not None:
@@ -584,64 +943,20 @@ class ImageDataGenerator(object):
                         y = np.lib.pad(y, ((0, 0), (pad_h1, pad_h2), (pad_w1, pad_w2)),
                                        'constant', constant_values=self.void_label)
                     elif self.class_mode == 'detection':
-                        b[:, 0] = b[:, 0] + pad_w1
-                        b[:, 1] = b[:, 1] + pad_h1
-                        b[:, 2] = b[:, 2] + pad_w1
-                        b[:, 3] = b[:, 3] + pad_h1
-
-                h, w = x.shape[img_row_index], x.shape[img_col_index]
-                # print ('New size X: ' + str(x.shape))
-                # print ('New size Y: ' + str(y.shape))
-                # exit()
-
-            if crop[0] < h:
-                top = np.random.randint(h - crop[0])
-            else:
-                # print('Data augmentation: Crop height >= image size')
-                top, crop[0] = 0, h
-            if crop[1] < w:
-                left = np.random.randint(w - crop[1])
-            else:
-                # print('Data augmentation: Crop width >= image size')
-                left, crop[1] = 0, w
-
-            if self.dim_ordering == 'th':
-                x = x[..., :, top:top + crop[0], left:left + crop[1]]
-                if y is not None:
-                    if self.has_gt_image:
-                        y = y[..., :, top:top + crop[0], left:left + crop[1]]
-            else:
-                x = x[..., top:top + crop[0], left:left + crop[1], :]
-                if y is not None:
-                    if self.has_gt_image:
-                        y = y[..., top:top + crop[0], left:left + crop[1], :]
+                        b += [pad_w1, pad_h1, pad_w1, pad_h1]
 
+            x, y = self.crop(x, y, p['crop'])
+            h, w = crop_h, crop_w
             if self.class_mode == 'detection':
-                b[:, 0] = b[:, 0] - left
-                b[:, 1] = b[:, 1] - top
-                b[:, 2] = b[:, 2] - left
-                b[:, 3] = b[:, 3] - top
-
-                # print ('X after: ' + str(x.shape))
-                # print ('Y after: ' + str(y.shape))
+                b -= [left, top, left, top]
 
         if self.class_mode == 'detection':
-            # clamp to valid coordinate values
-            b[:, 0] = np.clip(b[:, 0], 0, w)
-            b[:, 1] = np.clip(b[:, 1], 0, h)
-            b[:, 2] = np.clip(b[:, 2], 0, w)
-            b[:, 3] = np.clip(b[:, 3], 0, h)
-            # convert back from absolute x1,y1,x2,y2 coordinates to relative x,y,w,h
-            y[:, 1] = (b[:, 0] + (b[:, 2] - b[:, 0]) / 2) / w
-            y[:, 2] = (b[:, 1] + (b[:, 3] - b[:, 1]) / 2) / h
-            y[:, 3] = (b[:, 2] - b[:, 0]) / w
-            y[:, 4] = (b[:, 3] - b[:, 1]) / h
-            # reject regions that are too small
-            y = y[y[:, 3] > 0.005]
-            y = y[y[:, 4] > 0.005]
-            if y.shape[0] == 0:
-                warnings.warn('DirectoryIterator: your data augmentation strategy '
-                              'is is moving all the boxes out of the image ')
+            y = self.finish_boxes(y, b, h, w)
+
+        # The channel shift and the warp return floats
+        x = cast_image(x, x_dtype)
+        if y_dtype is not None:
+            y = cast_image(y, y_dtype)
 
         # TODO:
         # channel-wise normalization
@@ -650,6 +965,148 @@ class ImageDataGenerator(object):
         # blur
         return x, y
 
+    def crop(self, x, y, window):
+        # Crop an image and its GT image to the window (top, left, rows, cols)
+        top, left, crop_h, crop_w = window
+        if self.dim_ordering == 'th':
+            x = x[..., :, top:top + crop_h, left:left + crop_w]
+            if y is not None and self.has_gt_image:
+                y = y[..., :, top:top + crop_h, left:left + crop_w]
+        else:
+            x = x[..., top:top + crop_h, left:left + crop_w, :]
+            if y is not None and self.has_gt_image:
+                y = y[..., top:top + crop_h, left:left + crop_w, :]
+        return x, y
+
+    def finish_boxes(self, y, b, h, w):
+        # clamp to valid coordinate values
+        b = np.clip(b, 0, [w, h, w, h])
+        # convert back from absolute x1,y1,x2,y2 coordinates to relative x,y,w,h
+        size = np.array([w, h])
+        box_sizes = b[:, 2:] - b[:, :2]
+        y[:, 1:3] = (b[:, :2] + box_sizes / 2) / size
+        y[:, 3:5] = box_sizes / size
+        # reject regions that are too small
+        y = y[y[:, 3] > 0.005]
+        y = y[y[:, 4] > 0.005]
+        if y.shape[0] == 0:
+            warnings.warn('DirectoryIterator: your data augmentation strategy '
+                          'is is moving all the boxes out of the image ')
+        return y
+
+    def output_window(self, h, w, crop):
+        # Window (top, left, rows, cols) of the output in the augmented
+        # image, with negative offsets when an image smaller than the crop
+        # is padded
+        if crop is None:
+            return 0, 0, h, w
+        top, left, crop_h, crop_w = crop
+        if h < crop_h:
+            top -= (crop_h - h) // 2
+        if w < crop_w:
+            left -= (crop_w - w) // 2
+        return top, left, crop_h, crop_w
+
+    def transform_once(self, x, y, p, standardize=False):
+        """Augment an image and its GT with one resampling pass: the affine
+        transform, the flips and the crop or pad are one matrix (see
+        tools/resample.py). The boxes are transformed by the same matrix.
+        # Arguments
+            x: Image.
+            y: GT image, boxes or None.
+            p: Parameters of draw_transform.
+            standardize: Whether x still has to be standardized. With
+                crop_first only the source region of the output is.
+        # Return
+            x, y: The augmented image and its GT
+        """
+        img_channel_index = self.channel_index - 1
+        h, w = x.shape[self.row_index - 1], x.shape[self.col_index - 1]
+        window = self.output_window(h, w, p['crop'])
+        if self.class_mode == 'detection' and self.spline_warp:
+            raise ValueError('Elastic deformation is not supported for class_mode:', self.class_mode)
+
+        region_standardize = None
+        if standardize:
+            if self.crop_first:
+                region_standardize = self.standardize
+            else:
+                x = self.standardize(x, y)
+
+        x_out, y_out = resample_transform(
+            x, y if self.has_gt_image else None, img_channel_index, window,
+            matrix=p['transform_matrix'],
+            horizontal_flip=p['horizontal_flip'],
+            vertical_flip=p['vertical_flip'],
+            warp_coords=p['warp'], channel_shifts=p['channel_shifts'],
+            fill_mode=self.fill_mode, cval=self.cval, y_cval=self.void_label,
+            standardize=region_standardize)
+
+        if self.class_mode == 'detection':
+            # convert relative coordinates x,y,w,h to absolute x1,y1,x2,y2
+            size = np.array([w, h])
+            centers = y[:, 1:3] * size
+            half_sizes = y[:, 3:5] * size / 2
+            b = np.hstack((centers - half_sizes, centers + half_sizes))
+
+            # point transformation is the inverse of image transformation
+            composed = compose_matrix(h, w, window, p['transform_matrix'],
+                                      p['horizontal_flip'],
+                                      p['vertical_flip'])
+            b = transform_box_points(b, inv(composed))
+            y_out = self.finish_boxes(y, b, window[2], window[3])
+
+        return x_out, y_out
+
+    def has_random_transform(self):
+        # Whether draw_transform draws anything (the random crop included)
+        return bool(self.rotation_range or self.height_shift_range or
+                    self.width_shift_range or self.shear_range or
+                    tuple(self.zoom_range) != (1, 1) or
+                    self.channel_shift_range or self.horizontal_flip or
+                    self.vertical_flip or self.spline_warp or self.crop_size)
+
+    def draw_affine_matrices(self, n, h, w):
+        # Random rotation, shift, shear and zoom matrices of n images
+        return random_affine_matrices(n, h, w,
+                                      rotation_range=self.rotation_range,
+                                      height_shift_range=self.height_shift_range,
+                                      width_shift_range=self.width_shift_range,
+                                      shear_range=self.shear_range,
+                                      zoom_range=self.zoom_range)
+
+    def batch_affine_transform(self, batch_x, batch_y=None, matrices=None):
+        """Random rotation, shift, shear and zoom of a whole batch.
+        The images and GT images are resampled together in one pass.
+
+        # Arguments
+            batch_x: Batch of images of the same size.
+            batch_y: Batch of GT images or None.
+            matrices: Matrices of draw_affine_matrices, drawn here if None.
+        # Return
+            batch_x, batch_y: The transformed batches
+        """
+        if matrices is None:
+            h, w = batch_x.shape[self.row_index], batch_x.shape[self.col_index]
+            matrices = self.draw_affine_matrices(len(batch_x), h, w)
+        if batch_y is None:
+            batch_x = batch_apply_transform(batch_x, matrices,
+                                            self.channel_index,
+                                            fill_mode=self.fill_mode,
+                                            cval=self.cval)
+            return batch_x, None
+
+        # Stack the GT images as extra channels, filled with the void label
+        n_channels = batch_x.shape[self.channel_index]
+        n_gt_channels = batch_y.shape[self.channel_index]
+        cval = [self.cval] * n_channels + [self.void_label] * n_gt_channels
+        batch = np.concatenate((batch_x, batch_y), axis=self.channel_index)
+        batch = batch_apply_transform(batch, matrices, self.channel_index,
+                                      fill_mode=self.fill_mode, cval=cval)
+        batch_x, batch_y = np.split(batch, [n_channels],
+                                    axis=self.channel_index)
+        return batch_x, batch_y
+
     def fit(self, X, augment=False, rounds=1, seed=None):
         """Required for featurewise_center, featurewise_std_normalization
         and zca_whitening.
@@ -710,10 +1167,14 @@ class ImageDataGenerator(object):
             U, S, V = linalg.svd(sigma)
             self.principal_components = np.dot(np.dot(U, np.diag(1. / np.sqrt(S + 10e-7))), U.T)
 
+        self.compile_standardization()
+
     def fit_from_directory(self, directory, gt_directory=None, n_classes=None,
-                           void_labels=None, cb_weights_method=None):
+                           void_labels=None, cb_weights_method=None,
+                           nb_worker=None):
         """Required for featurewise_center, featurewise_std_normalization
-        and zca_whitening.
+        and zca_whitening. The statistics are computed in one parallel pass
+        and saved in the directories (see tools/dataset_stats.py).
 
         # Arguments
             directory: Path to the images
@@ -721,51 +1182,31 @@ class ImageDataGenerator(object):
             n_classes: Number of classes (Only for segmentation)
             void_labels: Void labels (Only for segmentation)
             cb_weights_method: Class weight balance (Only for segmentation)
+            nb_worker: Number of processes (None: one per CPU)
         """
 
-        # Get file names
+        # Get file names (of the directory and its subdirectories)
         def get_filenames(directory):
-            subdirs = list_subdirs(directory)
-            subdirs.append(directory)
+            manifest = Manifest.load(directory)
+            subdirs = manifest.subdir_names() + [None]
 
             file_names = []
             for subdir in subdirs:
-                subpath = os.path.join(directory, subdir)
-                for fname in os.listdir(subpath):
-                    if has_valid_extension(fname):
-                        file_names.append(os.path.join(directory, subdir,
-                                                       fname))
+                subpath = os.path.join(directory, subdir or '')
+                for fname in manifest.list_files(subdir, filter=has_valid_extension):
+                    file_names.append(os.path.join(subpath, fname))
 
             return file_names
 
-        # Precompute the mean and std
-        def compute_mean_std(directory, method='mean', mean=None):
-            # Get file names
-            file_names = get_filenames(directory)
-
-            # Process each file
-            sum, n = 0, 0
-            for file_name in file_names:
-                # Load image and reshape as a vector
-                x = io.imread(file_name)
-                if self.rescale:
-                    x = x * self.rescale
-                x = x.reshape((x.shape[0] * x.shape[1], x.shape[2]))
-                n += x.shape[0]
-
-                # Compute mean or std
-                if method == 'mean':
-                    sum += np.sum(x, axis=0)
-                elif method == 'var':
-                    x -= mean
-                    sum += np.sum(x * x, axis=0)
-
-            return sum / n
-
-        # Compute mean
+        # Compute mean and std
+        if self.featurewise_center or self.featurewise_std_normalization:
+            mean, std = image_mean_std(directory, get_filenames(directory),
+                                       nb_worker=nb_worker)
+            if self.rescale:
+                mean, std = mean * self.rescale, std * abs(self.rescale)
+
         if self.featurewise_center:
-            self.rgb_mean = compute_mean_std(directory, method='mean',
-                                             mean=None)
+            self.rgb_mean = mean
             # Broadcast the shape
             broadcast_shape = [1, 1, 1]
             broadcast_shape[self.channel_index - 1] = len(self.rgb_mean)
@@ -773,13 +1214,9 @@ class ImageDataGenerator(object):
             print('   Mean {}: {}'.format(self.mean.shape, self.rgb_mean,
                                           self.mean))
 
-        # Compute std
         if self.featurewise_std_normalization:
-            if not self.featurewise_center:
-                self.rgb_mean = compute_mean_std(directory, method='mean',
-                                                 mean=None)
-            var = compute_mean_std(directory, method='var', mean=self.rgb_mean)
-            self.rgb_std = np.sqrt(var)
+            self.rgb_mean = mean
+            self.rgb_std = std
             # Broadcast the shape
             broadcast_shape = [1, 1, 1]
             broadcast_shape[self.channel_index - 1] = len(self.rgb_std)
@@ -790,25 +1227,14 @@ class ImageDataGenerator(object):
         if self.zca_whitening:
             raise ValueError('ZCA Not implemented')
 
+        self.compile_standardization()
+
         # Compute class balance segmentation
         if cb_weights_method:
-            # Get file names
-            file_names = get_filenames(gt_directory)
-
             # Count the number of samples of each class
-            count_per_label = np.zeros(n_classes + len(void_labels))
-            total_count_per_label = np.zeros(n_classes + len(void_labels))
-
-            # Process each file
-            for file_name in file_names:
-                # Load image and mask
-                mask = io.imread(file_name)
-                mask = mask.astype('int32')
-
-                # Count elements
-                unique_labels, counts_label = np.unique(mask, return_counts=True)
-                count_per_label[unique_labels] += counts_label
-                total_count_per_label[unique_labels] += np.sum(counts_label[:n_classes])
+            count_per_label, total_count_per_label = label_counts(
+                gt_directory, get_filenames(gt_directory), n_classes,
+                n_classes + len(void_labels), nb_worker=nb_worker)
 
             # Remove void class
             count_per_label = count_per_label[:n_classes]
@@ -837,13 +1263,29 @@ class ImageDataGenerator(object):
                 raise ValueError('Unknown class balancing method: ' + cb_weights_method)
 
 
+# Serializes the draws of the iterators from the global numpy RNG. The
+# iterators of a MultiDirectoryIterator build their batches in concurrent
+# threads, and the draws of a sample (after seeding) must not interleave
+# with the ones of another
+random_lock = threading.Lock()
+
+
+# A forked process may inherit the lock held by another thread
+def reset_random_lock():
+    global random_lock
+    random_lock = threading.Lock()
+
+
 class DirectoryIterator(Iterator):
     def __init__(self, directory, image_data_generator,
                  resize=None, target_size=None, color_mode='rgb',
                  dim_ordering='default',
                  classes=None, class_mode='categorical',
                  batch_size=32, shuffle=True, seed=None, gt_directory=None,
-                 save_to_dir=None, save_prefix='', save_format='jpeg', model_name=None, yolo=False):
+                 save_to_dir=None, save_prefix='', save_format='jpeg', model_name=None, yolo=False,
+                 nb_worker=0, prefetch=2, cache_size=0, cache_dir=None,
+                 ring_size=0, backend='skimage', bucket_step=0, echo_factor=1,
+                 echo_buffer=4, shuffle_block=0, shuffle_buffer=0):
         # Check dim order
         if dim_ordering == 'default':
             dim_ordering = K.image_dim_ordering()
@@ -853,16 +1295,72 @@ class DirectoryIterator(Iterator):
         self.gt_directory = gt_directory
         self.image_data_generator = image_data_generator
         self.resize = resize
+        self.backend = get_backend(backend)
+        # Data type of the samples until the batch is collated
+        if image_data_generator.uint8_augmentation:
+            self.sample_dtype = np.uint8
+        else:
+            self.sample_dtype = np.dtype(K.floatx())
         self.save_to_dir = save_to_dir
         self.save_prefix = save_prefix
         self.save_format = save_format
         self.model_name = model_name
         self.yolo = yolo
-        # Check target size
-        if target_size is None and batch_size > 1:
-            raise ValueError('Target_size None works only with batch_size=1')
+        # Check target size. Batches of images of any size need the size
+        # buckets
+        if target_size is None and batch_size > 1 and bucket_step < 1:
+            raise ValueError('Target_size None works only with batch_size=1 '
+                             'or with size buckets (bucket_step > 0)')
+        if (target_size is None and bucket_step > 1 and
+                class_mode == 'segmentation' and
+                image_data_generator.void_label is None):
+            raise ValueError('Padding the GT images of a size bucket needs a '
+                             'void label. Use bucket_step=1 (images of the '
+                             'same size only)')
         self.target_size = (None, None) if target_size is None else tuple(target_size)
 
+        # Check the worker processes
+        self.check_workers(nb_worker)
+        self.nb_worker = nb_worker
+        self.prefetch = prefetch
+        self.worker_pool = None
+
+        # Check the batch affine augmentation
+        if image_data_generator.batch_affine and class_mode == 'detection':
+            raise ValueError('batch_affine is not supported for class_mode:', class_mode)
+
+        # Block shuffling: blocks of contiguous files in random order, mixed
+        # by a shuffle buffer (0: global permutation of the files)
+        self.shuffle_block = shuffle_block
+        self.shuffle_buffer = shuffle_buffer
+        if shuffle_block > 0 and bucket_step > 0 and target_size is None:
+            raise ValueError('The size buckets set the order of the batches. '
+                             'Use shuffle_block=0 with bucket_step')
+        # Reads of the samples, per epoch of the batches. Epochs drawn from
+        # the index generator so far
+        self.read_stats = ReadStats()
+        self.epochs_drawn = 0
+
+        # Whether finish_batch standardizes the uint8_augmentation batches
+        self.standardize_batches = True
+
+        # Data echoing: several augmented samples per decoded sample. The
+        # samples are held until their echoes are built
+        if echo_factor < 1 or echo_buffer < 1:
+            raise ValueError('echo_factor and echo_buffer must be at least 1')
+        self.echo_factor = echo_factor
+        if echo_factor > 1:
+            self.sample_hold = SampleHold(echo_factor,
+                                          2 * echo_buffer * batch_size)
+        else:
+            self.sample_hold = None
+
+        # Cache of decoded images (cache_size in MB)
+        if cache_size > 0:
+            self.image_cache = ImageCache(int(cache_size * 2 ** 20), cache_dir)
+        else:
+            self.image_cache = None
+
         # Check color mode
         if color_mode not in {'rgb', 'grayscale', 'bgr'}:
             raise ValueError('Invalid color mode:', color_mode,
@@ -908,6 +1406,7 @@ class DirectoryIterator(Iterator):
         self.nb_sample = 0
         self.filenames = []
         self.classes = []
+        self.annotations = None
 
         ###########################
         ## SDD utility if needed ##
@@ -918,111 +1417,465 @@ class DirectoryIterator(Iterator):
             self.ssd_generator = None
 
         # Get filenames
-        if self.class_mode == 'detection':
-            for fname in os.listdir(directory):
-                if has_valid_extension(fname):
-                    self.filenames.append(fname)
-                    # Look for the GT filename
-                    gt_fname = os.path.join(directory, fname.replace('jpg', 'txt'))
-                    if not os.path.isfile(gt_fname):
-                        raise ValueError('GT file not found: ' + gt_fname)
-            self.filenames = np.sort(self.filenames)
-        elif not self.class_mode == 'segmentation':
-            for subdir in classes:
-                subpath = os.path.join(directory, subdir)
-                for fname in os.listdir(subpath):
-                    if has_valid_extension(fname):
-                        self.classes.append(self.class_indices[subdir])
-                        self.filenames.append(os.path.join(subdir, fname))
-            self.classes = np.array(self.classes)
-        else:
-            for fname in os.listdir(directory):
-                if has_valid_extension(fname):
-                    self.filenames.append(fname)
-                    # Look for the GT filename
-                    gt_fname = os.path.join(gt_directory,
-                                            os.path.split(fname)[1])
-                    if not os.path.isfile(gt_fname):
-                        raise ValueError('GT file not found: ' + gt_fname)
-            self.filenames = np.sort(self.filenames)
+        self.find_files(classes)
 
         self.nb_sample = len(self.filenames)
         print('   Found %d images belonging to %d classes' % (self.nb_sample,
                                                               self.nb_class))
 
+        # Batches of images of similar sizes when they have no target size
+        if None in self.target_size and bucket_step > 0:
+            self.size_buckets = SizeBuckets(self.sample_sizes(), batch_size,
+                                            bucket_step)
+            print('   ' + self.size_buckets.summary())
+        else:
+            self.size_buckets = None
+
+        # Preallocated batch arrays (only for a fixed target size)
+        if ring_size > 0 and None not in self.target_size:
+            self.batch_ring = BatchRing(ring_size, batch_size, self.image_shape,
+                                        self.gt_image_shape if self.has_gt_image else None,
+                                        dtype=K.floatx())
+        else:
+            self.batch_ring = None
+
         super(DirectoryIterator, self).__init__(self.nb_sample, batch_size,
                                                 shuffle, seed)
+        if self.size_buckets is not None:
+            self.index_generator = self._flow_bucket_index(shuffle, seed)
+        elif shuffle and shuffle_block > 0:
+            self.index_generator = self._flow_block_index(seed)
+        if echo_factor > 1:
+            # The echoes of a size bucket stay in its batches
+            self.index_generator = echo_index(
+                self.index_generator, self.nb_sample, batch_size, echo_factor,
+                1 if self.size_buckets is not None else echo_buffer)
+
+    def _flow_bucket_index(self, shuffle, seed):
+        # As Iterator._flow_index, with the batches of an epoch drawn from
+        # the size buckets. current_index counts the samples of the epoch
+        # before the batch
+        self.reset()
+        while 1:
+            if seed is not None:
+                np.random.seed(seed + self.total_batches_seen)
+            if self.batch_index == 0:
+                batches = self.size_buckets.epoch(shuffle)
+                current_index = 0
+            index_array = batches[self.batch_index]
+            self.batch_index = (self.batch_index + 1) % len(batches)
+            self.total_batches_seen += 1
+            yield index_array, current_index, len(index_array)
+            current_index += len(index_array)
+
+    def _flow_block_index(self, seed):
+        # As Iterator._flow_index, with the block permutation of the samples
+        self.reset()
+        n, batch_size = self.nb_sample, self.batch_size
+        while 1:
+            if seed is not None:
+                np.random.seed(seed + self.total_batches_seen)
+            if self.batch_index == 0:
+                index_array = block_permutation(n, self.shuffle_block,
+                                                self.shuffle_buffer)
+
+            current_index = (self.batch_index * batch_size) % n
+            if n >= current_index + batch_size:
+                current_batch_size = batch_size
+                self.batch_index += 1
+            else:
+                current_batch_size = n - current_index
+                self.batch_index = 0
+            self.total_batches_seen += 1
+            yield (index_array[current_index: current_index + current_batch_size],
+                   current_index, current_batch_size)
+
+    def sample_sizes(self):
+        # Size (rows, cols) of every image once loaded
+        if self.resize is not None:
+            return np.tile(self.resize, (self.nb_sample, 1))
+        return image_sizes(self.directory, self.filenames)
+
+    def collate(self, xs, ys):
+        # Batch of samples of any size, padded at the bottom and right to the
+        # largest one (the GT images with the void label)
+        batch_x = pad_concatenate([np.asarray(x, dtype=K.floatx())[np.newaxis]
+                                   for x in xs])
+        if not self.has_gt_image:
+            return batch_x, None
+        void_label = self.image_data_generator.void_label
+        batch_y = pad_concatenate([np.asarray(y, dtype=K.floatx())[np.newaxis]
+                                   for y in ys],
+                                  0 if void_label is None else void_label)
+        return batch_x, batch_y
+
+    def check_workers(self, nb_worker):
+        # The worker processes write into fixed size buffers and build the
+        # batches sample by sample
+        if nb_worker > 0 and None in self.target_size:
+            raise ValueError('Target_size None does not work with nb_worker > 0')
+        if nb_worker > 0 and self.image_data_generator.batch_affine:
+            raise ValueError('batch_affine does not work with nb_worker > 0')
+
+    def set_workers(self, nb_worker, prefetch=None):
+        """Change the number of worker processes building the batches. The
+        pool is restarted on the next batch (the batches in flight are
+        dropped).
+
+        # Arguments
+            nb_worker: Number of worker processes (0: build the batches in
+                the calling process)
+            prefetch: Batches in flight in the worker pool. None keeps
+                every worker busy: one batch more than the workers fill
+        """
+        self.check_workers(nb_worker)
+        if prefetch is None:
+            prefetch = max(2, int(np.ceil(nb_worker / float(self.batch_size))) + 1)
+        with self.lock:
+            self.close()
+            self.nb_worker = nb_worker
+            self.prefetch = prefetch
+
+    def find_files(self, classes):
+        # Fill self.filenames (and self.classes) from the directory tree
+        directory = self.directory
+        gt_directory = self.gt_directory
+        manifest = Manifest.load(directory)
+        self.manifest = manifest
+        if self.class_mode == 'detection':
+            self.filenames = np.array(manifest.list_files(filter=has_valid_extension))
+            # Index the GT boxes (checks that the GT files exist)
+            self.annotations = AnnotationIndex.from_directory(directory,
+                                                              self.filenames)
+        elif not self.class_mode == 'segmentation':
+            for subdir in classes:
+                for fname in manifest.list_files(subdir, filter=has_valid_extension):
+                    self.classes.append(self.class_indices[subdir])
+                    self.filenames.append(os.path.join(subdir, fname))
+            self.classes = np.array(self.classes)
+        else:
+            gt_manifest = Manifest.load(gt_directory)
+            self.gt_manifest = gt_manifest
+            for fname in manifest.list_files(filter=has_valid_extension):
+                self.filenames.append(fname)
+                # Look for the GT filename
+                if not gt_manifest.has_file(fname):
+                    raise ValueError('GT file not found: ' +
+                                     os.path.join(gt_directory, fname))
+            self.filenames = np.array(self.filenames)
+
+    def next(self, out=None):
+        # out: (batch_x, batch_y) arrays the batch is written to, or None
+        if self.nb_worker > 0:
+            return self._next_from_workers(out)
+        if self.image_data_generator.batch_affine:
+            return self._next_batch_affine(out)
 
-    def next(self):
         # Lock the generation of index only. The rest is not under thread
         # lock so it can be done in parallel
         with self.lock:
-            index_array, current_index, current_batch_size = next(self.index_generator)
-
-        # Create the batch_x and batch_y
-        if current_batch_size > 1:
-            batch_x = np.zeros((current_batch_size,) + self.image_shape)
+            with random_lock:
+                index_array, current_index, current_batch_size = next(self.index_generator)
+                seeds = self.sample_seeds(current_batch_size)
+            epoch = self.batch_epoch(current_index, current_batch_size)
+            batch_x, batch_y = self.new_batch(current_batch_size, out)
+        if self.class_mode == 'detection':
+            batch_y = []
+        self.read_stats.start()
+
+        # Load and standardize the batch, then augment it sample by sample.
+        # With crop_first every sample is standardized on its own, on the
+        # region its crop needs. With uint8_augmentation the samples are
+        # built as uint8 and the batch is standardized in finish_batch
+        dg = self.image_data_generator
+        if dg.uint8_augmentation or dg.crop_first:
+            samples = (self.build_sample(j, seeds[i])
+                       for i, j in enumerate(index_array))
+        else:
+            xs, ys = self.load_batch(index_array, batch_x)
+            samples = (self.augment_sample(xs[i], ys[i], seeds[i])
+                       for i in range(current_batch_size))
+        if batch_x is None:
+            # Images of any size (target_size None), padded to the largest
+            samples = list(samples)
+            xs, ys = [x for x, _ in samples], [y for _, y in samples]
+            batch_x, batch_y = self.collate(xs, ys)
+            if self.class_mode == 'detection':
+                batch_y = ys
+            samples = []
+        for i, (x, y) in enumerate(samples):
+            # Add images to batches
+            batch_x[i] = x
             if self.has_gt_image:
-                batch_y = np.zeros((current_batch_size,) + self.gt_image_shape)
+                batch_y[i] = y
             if self.class_mode == 'detection':
-                batch_y = []
-
-        # Build batch of image data
-        for i, j in enumerate(index_array):
-            # Load image
-            fname = self.filenames[j]
-            # print(fname)
-            img = load_img(os.path.join(self.directory, fname),
-                           grayscale=self.grayscale,
-                           resize=self.resize, order=1)
-            x = img_to_array(img, dim_ordering=self.dim_ordering)
-
-            # Load GT image if segmentation
+                batch_y.append(y)
+        epoch_reads = self.read_stats.add(epoch, self.read_stats.stop())
+
+        return self.finish_batch(index_array, current_index, batch_x, batch_y,
+                                 epoch_reads)
+
+    def _next_batch_affine(self, out=None):
+        with self.lock:
+            with random_lock:
+                index_array, current_index, current_batch_size = next(self.index_generator)
+                seeds = self.sample_seeds(current_batch_size + 1)
+            epoch = self.batch_epoch(current_index, current_batch_size)
+            out_x, out_y = self.new_batch(current_batch_size, out)
+
+        # Load and standardize the whole batch (a uint8 batch with
+        # uint8_augmentation, standardized in finish_batch)
+        dg = self.image_data_generator
+        self.read_stats.start()
+        batch_x, batch_y = self.load_batch(
+            index_array, None if dg.uint8_augmentation else out_x)
+        epoch_reads = self.read_stats.add(epoch, self.read_stats.stop())
+        if isinstance(batch_x, list):
+            raise ValueError('batch_affine needs images of the same size. '
+                             'Set the resize of the dataset or bucket_step=1')
+        if not self.has_gt_image:
+            batch_y = None
+
+        # Affine transform of the batch, with the last seed
+        h, w = batch_x.shape[dg.row_index], batch_x.shape[dg.col_index]
+        with random_lock:
+            np.random.seed(seeds[-1])
+            matrices = dg.draw_affine_matrices(current_batch_size, h, w)
+        batch_x, batch_y = dg.batch_affine_transform(batch_x, batch_y,
+                                                     matrices)
+
+        # Rest of the augmentation, sample by sample
+        samples = []
+        for i in range(current_batch_size):
+            with random_lock:
+                np.random.seed(seeds[i])
+                p = dg.draw_transform(h, w, batch_x.shape[dg.channel_index])
+            x, y = dg.random_transform(batch_x[i],
+                                       batch_y[i] if self.has_gt_image else None,
+                                       affine=False, p=p)
+            if out_x is None:
+                # Images of any size (target_size None)
+                samples.append((x, y))
+                continue
+            out_x[i] = x
             if self.has_gt_image:
-                # Load GT image
-                gt_img = load_img(os.path.join(self.gt_directory, fname),
-                                  grayscale=True,
-                                  resize=self.resize, order=0)
-                y = img_to_array(gt_img, dim_ordering=self.dim_ordering)
-            else:
-                y = None
+                out_y[i] = y
+        if out_x is None:
+            out_x, out_y = self.collate([x for x, _ in samples],
+                                        [y for _, y in samples])
+
+        return self.finish_batch(index_array, current_index, out_x, out_y,
+                                 epoch_reads)
+
+    def _next_from_workers(self, out=None):
+        # The worker pool is started on the first batch and always keeps
+        # `prefetch` batches in flight
+        with self.lock:
+            if self.worker_pool is None:
+                if self.image_cache is not None:
+                    self.image_cache.set_workers(self.nb_worker)
+                self.worker_pool = SharedBatchPool(self, self.nb_worker,
+                                                   self.prefetch)
+            while not self.worker_pool.full():
+                with random_lock:
+                    index_array, current_index, current_batch_size = next(self.index_generator)
+                    seeds = self.sample_seeds(current_batch_size)
+                epoch = self.batch_epoch(current_index, current_batch_size)
+                self.worker_pool.submit(index_array, current_index, epoch,
+                                        seeds)
+            (index_array, current_index, epoch, batch_x, batch_y,
+             reads) = self.worker_pool.get(lambda n: self.new_batch(n, out))
+        epoch_reads = self.read_stats.add(epoch, reads)
+
+        return self.finish_batch(index_array, current_index, batch_x, batch_y,
+                                 epoch_reads)
+
+    def batch_epoch(self, current_index, current_batch_size):
+        # Epoch of the batch just drawn from the index generator (called
+        # under self.lock)
+        epoch = self.epochs_drawn
+        last = current_index + current_batch_size >= self.nb_sample
+        self.read_stats.draw(epoch, last)
+        if last:
+            self.epochs_drawn += 1
+        return epoch
+
+    def init_worker(self, worker=None, nb_worker=1):
+        # Called in the processes forked to build the batches. worker: index
+        # of the process in the worker pool (None for a prefetch process)
+        reset_random_lock()
+        if self.image_cache is not None:
+            self.image_cache.init_worker(worker, nb_worker)
+
+    def new_batch(self, n, out=None):
+        # Arrays for a batch of n samples: the first n of out, the next
+        # arrays of the ring or new ones. None if the images have no fixed
+        # size
+        if out is not None:
+            batch_x, batch_y = out
+            return batch_x[:n], batch_y[:n] if batch_y is not None else None
+        if self.batch_ring is not None:
+            return self.batch_ring.next(n)
+        if None in self.target_size:
+            return None, None
+        batch_x = np.zeros((n,) + self.image_shape, dtype=K.floatx())
+        if self.has_gt_image:
+            batch_y = np.zeros((n,) + self.gt_image_shape, dtype=K.floatx())
+        else:
+            batch_y = None
+        return batch_x, batch_y
+
+    def sample_seeds(self, n):
+        # One seed per sample, drawn in the main process. Seeding each sample
+        # makes the augmentation independent of which process builds it
+        return np.random.randint(0, 2 ** 31 - 1, size=n)
+
+    def build_sample(self, j, seed=None):
+        """Load, standardize and augment the sample j of the dataset. With
+        uint8_augmentation the sample is not standardized (and stays uint8).
+
+        # Arguments
+            j: Index of the sample in self.filenames
+            seed: Seed of the random draws of the sample or None
+        # Return
+            x, y: The image and its GT image, boxes or None
+        """
+        x, y = self.decode_sample(j)
+        if self.image_data_generator.uint8_augmentation:
+            return self.augment_sample(x, y, seed)
+        if self.image_data_generator.crop_first:
+            return self.augment_sample(x, y, seed, standardize=True)
+
+        # Standarize image
+        x = self.image_data_generator.standardize(x, y)
+
+        return self.augment_sample(x, y, seed)
+
+    def load_batch(self, index_array, batch_x=None):
+        """Load the samples of a batch and standardize them. Images of the
+        same size are standardized together, in place. With
+        uint8_augmentation they are not standardized.
+
+        # Arguments
+            index_array: Indices of the samples in self.filenames
+            batch_x: Array where the images are loaded if they have its
+                size, or None
+        # Return
+            xs, ys: The images (a batch array, or a list if their sizes
+                differ) and the GT images (a batch array), boxes or None
+        """
+        dg = self.image_data_generator
+        samples = [self.decode_sample(j) for j in index_array]
+        ys = [y for _, y in samples]
+        if self.has_gt_image and len(set(y.shape for y in ys)) == 1:
+            ys = np.stack(ys)
+
+        if len(set(x.shape for x, _ in samples)) > 1:
+            # Images of different sizes, standardized one by one
+            if dg.uint8_augmentation:
+                return [x for x, _ in samples], ys
+            return [dg.standardize(x, y) for x, y in samples], ys
+
+        if batch_x is None or batch_x.shape[1:] != samples[0][0].shape:
+            batch_x = np.stack([x for x, _ in samples])
+        else:
+            for i, (x, _) in enumerate(samples):
+                batch_x[i] = x
+        if not dg.uint8_augmentation:
+            dg.standardize_batch(batch_x, ys if self.has_gt_image else None)
+        return batch_x, ys
+
+    def augment_sample(self, x, y, seed=None, standardize=False):
+        """Augment a standardized sample.
+
+        # Arguments
+            x, y: The image and its GT image, boxes or None
+            seed: Seed of the random draws of the sample or None
+            standardize: Whether x still has to be standardized
+        # Return
+            x, y: The augmented image and GT
+        """
+        dg = self.image_data_generator
+        with random_lock:
+            if seed is not None:
+                np.random.seed(seed)
 
-            # Load GT image if detection
             if self.class_mode == 'detection':
-                label_path = os.path.join(self.directory, fname).replace('jpg', 'txt')
-                gt = np.loadtxt(label_path)
-                if len(gt.shape) == 1:
-                    gt = gt[np.newaxis,]
-                y = gt.copy()
-                y = y[((y[:, 1] > 0.) & (y[:, 1] < 1.))]
-                y = y[((y[:, 2] > 0.) & (y[:, 2] < 1.))]
-                y = y[((y[:, 3] > 0.) & (y[:, 3] < 1.))]
-                y = y[((y[:, 4] > 0.) & (y[:, 4] < 1.))]
-                if (y.shape != gt.shape) or (y.shape[0] == 0):
-                    warnings.warn('DirectoryIterator: found an invalid annotation '
-                                  'on GT file ' + label_path)
                 # shuffle gt boxes order
                 np.random.shuffle(y)
 
-            # Standarize image
-            x = self.image_data_generator.standardize(x, y)
+            p = dg.draw_transform(x.shape[dg.row_index - 1],
+                                  x.shape[dg.col_index - 1],
+                                  x.shape[dg.channel_index - 1])
+
+        # Data augmentation
+        return dg.random_transform(x, y, standardize=standardize, p=p)
+
+    def decode_sample(self, j):
+        # read_sample, or the sample held for its echoes
+        if self.sample_hold is None:
+            return self.read_sample(j)
+        return self.sample_hold.get(j, self.read_sample)
+
+    def read_sample(self, j):
+        # load_sample, timed for the read statistics
+        start_time = time.time()
+        sample = self.load_sample(j)
+        self.read_stats.count(self.sample_nbytes(j), time.time() - start_time)
+        return sample
+
+    def sample_nbytes(self, j):
+        # Size of the files of the sample j
+        nbytes = self.manifest.file_size(self.filenames[j])
+        if self.has_gt_image:
+            nbytes += self.gt_manifest.file_size(self.filenames[j])
+        return nbytes
+
+    def load_sample(self, j):
+        # Load image
+        fname = self.filenames[j]
+        # print(fname)
+        img = load_img(os.path.join(self.directory, fname),
+                       grayscale=self.grayscale,
+                       resize=self.resize, order=1,
+                       cache=self.image_cache, dtype=self.sample_dtype,
+                       backend=self.backend.name)
+        x = image_array(img, self.dim_ordering)
+
+        # Load GT image if segmentation
+        if self.has_gt_image:
+            # Load GT image
+            gt_img = load_img(os.path.join(self.gt_directory, fname),
+                              grayscale=True,
+                              resize=self.resize, order=0,
+                              cache=self.image_cache, dtype=self.sample_dtype,
+                              backend=self.backend.name)
+            y = image_array(gt_img, self.dim_ordering)
+        else:
+            y = None
+
+        # Get GT boxes if detection. The annotation index only returns the
+        # valid boxes
+        if self.class_mode == 'detection':
+            if not self.annotations.valid_image[j]:
+                warnings.warn('DirectoryIterator: found an invalid annotation '
+                              'on GT of ' + fname)
+            y = self.annotations.gt(j)
 
-            # Data augmentation
-            x, y = self.image_data_generator.random_transform(x, y)
+        return x, y
 
-            # Add images to batches
-            if current_batch_size > 1:
-                batch_x[i] = x
-                if self.has_gt_image:
-                    batch_y[i] = y
-                elif self.class_mode == 'detection':
-                    batch_y.append(y)
-            else:
-                batch_x = np.expand_dims(x, axis=0)
-                if self.has_gt_image:
-                    batch_y = np.expand_dims(y, axis=0)
-                elif self.class_mode == 'detection':
-                    batch_y = [y]
+    def finish_batch(self, index_array, current_index, batch_x, batch_y,
+                     epoch_reads=None):
+        # epoch_reads: Summary of the reads of the epoch the batch completes
+        # (the last one of its batches to finish), or None
+        current_batch_size = len(index_array)
+
+        # With uint8_augmentation the collated batch is standardized here,
+        # once (unless a BatchCache stores it as uint8)
+        if (self.image_data_generator.uint8_augmentation and
+                self.standardize_batches):
+            self.image_data_generator.standardize_batch(
+                batch_x, batch_y if self.has_gt_image else None)
 
         # optionally save augmented images to disk for debugging purposes
         if self.save_to_dir:
@@ -1046,6 +1899,16 @@ class DirectoryIterator(Iterator):
                                        scale=True)
                     img.save(os.path.join(self.save_to_dir, fname))
 
+        # Report the image cache and the data echoing at the end of each
+        # epoch, and the reads of the shuffled (training) samples
+        if current_index + current_batch_size >= self.nb_sample:
+            if self.image_cache is not None:
+                print('\n   Image cache: ' + self.image_cache.summary())
+            if self.sample_hold is not None:
+                print('\n   Data echoing: ' + self.sample_hold.summary())
+        if epoch_reads is not None and self.shuffle:
+            print('\n   Reads: ' + epoch_reads)
+
         # Build batch of labels
         if self.class_mode == 'sparse':
             batch_y = self.classes[index_array]
@@ -1067,42 +1930,239 @@ class DirectoryIterator(Iterator):
 
         return batch_x, batch_y
 
+    def close(self):
+        # Stop the worker processes, if any. Their batches in flight are
+        # dropped
+        if self.worker_pool is not None:
+            for epoch in self.worker_pool.pending_epochs():
+                self.read_stats.add(epoch)
+            self.worker_pool.close()
+            self.worker_pool = None
+
+
+class ShardIterator(DirectoryIterator):
+    """Iterator over a dataset split packed with build_shards.py.
+    Takes the arguments of DirectoryIterator, with directory being the
+    shard directory. The images, masks and boxes are read from the memory
+    mapped shards.
+    """
 
-class DirectoryIterator2(object):
-    def __init__(self, directory, image_data_generator,
-                 resize=None, target_size=None, color_mode='rgb',
-                 dim_ordering='default',
-                 classes=None, class_mode='categorical',
-                 batch_size=32, shuffle=True, seed=None, gt_directory=None,
-                 save_to_dir=None, save_prefix='', save_format='jpeg',
-                 directory2=None, gt_directory2=None, batch_size2=None):
-        self.DI1 = DirectoryIterator(
-            directory, image_data_generator, resize=resize,
-            target_size=target_size, color_mode=color_mode,
-            classes=classes, class_mode=class_mode,
-            dim_ordering=dim_ordering,
-            batch_size=batch_size, shuffle=shuffle, seed=seed,
-            gt_directory=gt_directory,
-            save_to_dir=save_to_dir, save_prefix=save_prefix,
-            save_format=save_format)
+    def __init__(self, directory, image_data_generator, **kwargs):
+        self.shards = ShardReader(directory)
+        if not kwargs.get('classes'):
+            kwargs['classes'] = dict(enumerate(self.shards.class_names))
+        super(ShardIterator, self).__init__(directory, image_data_generator,
+                                            **kwargs)
+
+    def find_files(self, classes):
+        # Check that the shards fit the configuration
+        if [str(c) for c in classes] != self.shards.class_names:
+            raise ValueError('The classes do not match the ones of the '
+                             'shards in ' + self.directory)
+        if (self.shards.color_mode == 'grayscale') != self.grayscale:
+            raise ValueError('The shards in {} have color mode {}'.format(
+                self.directory, self.shards.color_mode))
+        if (self.class_mode in {'segmentation', 'detection'} and
+                self.shards.class_mode != self.class_mode):
+            raise ValueError('The shards in {} have class mode {}'.format(
+                self.directory, self.shards.class_mode))
+
+        self.filenames = self.shards.names
+        self.classes = self.shards.labels
+        if self.class_mode == 'detection':
+            table = self.shards.box_table()
+            self.annotations = AnnotationIndex(self.filenames, table[:, 0],
+                                               table[:, 1:],
+                                               self.shards.box_starts,
+                                               self.shards.box_counts)
+
+    def sample_nbytes(self, j):
+        # Bytes of the image (and mask) of the sample j in the shards
+        nbytes = int(np.prod(self.shards.image_shape))
+        if self.has_gt_image:
+            nbytes += int(np.prod(self.shards.image_shape[:2]))
+        return nbytes
+
+    def sample_sizes(self):
+        # The images of the shards have the same size
+        size = self.resize if self.resize is not None else self.shards.image_shape[:2]
+        return np.tile(size, (self.nb_sample, 1))
+
+    def load_sample(self, j):
+        # Load image. It only needs a resize if the shards have another size
+        img = self.shards.image(j)
+        if self.resize is not None and tuple(self.resize) != img.shape[:2]:
+            img = self.backend.resize(img, self.resize, 1)
+        x = image_array(cast_image(img, self.sample_dtype), self.dim_ordering)
+
+        # Load GT image if segmentation
+        if self.has_gt_image:
+            gt_img = self.shards.mask(j)
+            if self.resize is not None and tuple(self.resize) != gt_img.shape:
+                gt_img = self.backend.resize(gt_img, self.resize, 0)
+            y = image_array(cast_image(gt_img, self.sample_dtype),
+                            self.dim_ordering)
+        elif self.class_mode == 'detection':
+            if not self.annotations.valid_image[j]:
+                warnings.warn('DirectoryIterator: found an invalid annotation '
+                              'on GT of ' + self.filenames[j])
+            y = self.annotations.gt(j)
+        else:
+            y = None
 
-        self.DI2 = DirectoryIterator(
-            directory2, image_data_generator, resize=resize,
-            target_size=target_size, color_mode=color_mode,
-            classes=classes, class_mode=class_mode,
-            dim_ordering=dim_ordering,
-            batch_size=batch_size2, shuffle=shuffle, seed=seed,
-            gt_directory=gt_directory2,
-            save_to_dir=save_to_dir, save_prefix=save_prefix,
-            save_format=save_format)
+        return x, y
+
+
+# Split a batch between sources in proportion to their weights, giving
+# the remaining samples to the largest remainders so that the sizes add up
+# to batch_size
+def split_batch_size(batch_size, weights):
+    weights = np.asarray(weights, dtype=np.float64)
+    if np.any(weights < 0) or np.sum(weights) <= 0:
+        raise ValueError('Invalid source weights: ' + str(list(weights)))
+    shares = batch_size * weights / np.sum(weights)
+    sizes = np.floor(shares).astype(np.int64)
+    order = np.argsort(sizes - shares, kind='mergesort')
+    sizes[order[:batch_size - np.sum(sizes)]] += 1
+    return [int(n) for n in sizes]
+
+
+class MultiDirectoryIterator(object):
+    """Iterator over batches mixing the samples of several datasets
+    (domains). The DirectoryIterators of the sources build their part of
+    every batch concurrently, one thread each, directly into their slice of
+    one batch: the next arrays of a ring, or new arrays if ring_size is 0.
+
+    # Arguments
+        directories: Image directory of each source.
+        image_data_generator: ImageDataGenerator of the batches.
+        gt_directories: GT directory of each source, or None.
+        batch_sizes: Samples of each source in every batch.
+        ring_size: Batches of the ring of merged batch arrays (0: new
+            arrays per batch).
+        kwargs: Other arguments of the DirectoryIterator of every source.
+    """
+
+    def __init__(self, directories, image_data_generator, gt_directories=None,
+                 batch_sizes=None, ring_size=0, **kwargs):
+        if gt_directories is None:
+            gt_directories = [None] * len(directories)
+        if batch_sizes is None:
+            batch_sizes = [32] * len(directories)
+        if not len(directories) == len(gt_directories) == len(batch_sizes):
+            raise ValueError('Expected one GT directory and batch size per '
+                             'source directory')
+        if min(batch_sizes) < 1:
+            raise ValueError('Every source needs at least one sample per '
+                             'batch. Batch sizes: ' + str(batch_sizes))
+
+        self.iterators = [DirectoryIterator(directory, image_data_generator,
+                                            gt_directory=gt_directory,
+                                            batch_size=batch_size,
+                                            ring_size=0, **kwargs)
+                          for directory, gt_directory, batch_size
+                          in zip(directories, gt_directories, batch_sizes)]
+        self.batch_sizes = list(batch_sizes)
+        self.batch_size = sum(batch_sizes)
+        self.offsets = np.cumsum([0] + self.batch_sizes)
+
+        first = self.iterators[0]
+        self.class_mode = first.class_mode
+        self.has_gt_image = first.has_gt_image
+        if ring_size > 0 and None not in first.target_size:
+            self.batch_ring = BatchRing(ring_size, self.batch_size,
+                                        first.image_shape,
+                                        first.gt_image_shape if self.has_gt_image else None,
+                                        dtype=K.floatx())
+        else:
+            self.batch_ring = None
+
+        self.lock = threading.Lock()
+        self.thread_pool = None
+
+    def new_batch(self):
+        # Arrays of the merged batch, None if the images have no fixed size
+        if self.batch_ring is not None:
+            return self.batch_ring.next(self.batch_size)
+        first = self.iterators[0]
+        if None in first.target_size:
+            return None, None
+        batch_x = np.zeros((self.batch_size,) + first.image_shape,
+                           dtype=K.floatx())
+        if self.has_gt_image:
+            batch_y = np.zeros((self.batch_size,) + first.gt_image_shape,
+                               dtype=K.floatx())
+        else:
+            batch_y = None
+        return batch_x, batch_y
 
     def next(self):
-        batch_x1, batch_y1 = self.DI1.next()
-        batch_x2, batch_y2 = self.DI2.next()
-        batch_x = np.concatenate((batch_x1, batch_x2))
-        batch_y = np.concatenate((batch_y1, batch_y2))
+        with self.lock:
+            batch_x, batch_y = self.new_batch()
+            if self.thread_pool is None and len(self.iterators) > 1:
+                self.thread_pool = ThreadPool(len(self.iterators))
+
+        # Slice of the batch of every source
+        outs = []
+        for start, stop in zip(self.offsets[:-1], self.offsets[1:]):
+            if batch_x is None:
+                outs.append(None)
+            else:
+                outs.append((batch_x[start:stop],
+                             batch_y[start:stop] if batch_y is not None else None))
+
+        if self.thread_pool is None:
+            results = [self.iterators[0].next(outs[0])]
+        else:
+            results = self.thread_pool.map(lambda args: args[0].next(args[1]),
+                                           list(zip(self.iterators, outs)))
+        return self.merge(results, batch_x, batch_y)
+
+    def merge(self, results, batch_x, batch_y):
+        # The images (and GT images) are already in the batch, unless a
+        # source returned a smaller batch (the last one of its epoch) or the
+        # images have no fixed size
+        if self.class_mode is None:
+            xs, ys = results, None
+        else:
+            xs, ys = zip(*results)
+        filled = (batch_x is not None and
+                  [len(x) for x in xs] == self.batch_sizes)
+        if not filled:
+            # The images of size buckets are padded to the largest one
+            batch_x = pad_concatenate(xs)
+        if self.class_mode is None:
+            return batch_x
+        if not filled and self.has_gt_image:
+            void_label = self.iterators[0].image_data_generator.void_label
+            batch_y = pad_concatenate(ys, 0 if void_label is None else void_label)
+        elif not filled or not self.has_gt_image:
+            # Labels and GT boxes are built per source
+            batch_y = np.concatenate(ys)
         return batch_x, batch_y
 
+    def set_workers(self, nb_worker, prefetch=None):
+        # Share the worker processes between the sources, in proportion to
+        # their batch sizes
+        for iterator, n in zip(self.iterators,
+                               split_batch_size(nb_worker, self.batch_sizes)):
+            iterator.set_workers(n, prefetch)
+
+    def init_worker(self):
+        # Called in a process forked to build the batches. The threads of
+        # the pool are not forked
+        reset_random_lock()
+        self.thread_pool = None
+        for iterator in self.iterators:
+            iterator.init_worker()
+
+    def close(self):
+        for iterator in self.iterators:
+            iterator.close()
+        if self.thread_pool is not None:
+            self.thread_pool.terminate()
+            self.thread_pool = None
+
     def __iter__(self):
         # needed if we want to do something like:
         # for x, y in data_gen.flow(...):
@@ -1110,3 +2170,31 @@ class DirectoryIterator2(object):
 
     def __next__(self, *args, **kwargs):
         return self.next(*args, **kwargs)
+
+
+class DirectoryIterator2(MultiDirectoryIterator):
+    # Batches of two datasets, batch_size samples of the first one and
+    # batch_size2 of the second one
+    def __init__(self, directory, image_data_generator,
+                 resize=None, target_size=None, color_mode='rgb',
+                 dim_ordering='default',
+                 classes=None, class_mode='categorical',
+                 batch_size=32, shuffle=True, seed=None, gt_directory=None,
+                 save_to_dir=None, save_prefix='', save_format='jpeg',
+                 directory2=None, gt_directory2=None, batch_size2=None,
+                 nb_worker=0, prefetch=2, cache_size=0, cache_dir=None,
+                 ring_size=0, backend='skimage', bucket_step=0, echo_factor=1,
+                 echo_buffer=4, shuffle_block=0, shuffle_buffer=0):
+        super(DirectoryIterator2, self).__init__(
+            [directory, directory2], image_data_generator,
+            gt_directories=[gt_directory, gt_directory2],
+            batch_sizes=[batch_size, batch_size2], ring_size=ring_size,
+            resize=resize, target_size=target_size, color_mode=color_mode,
+            classes=classes, class_mode=class_mode,
+            dim_ordering=dim_ordering, shuffle=shuffle, seed=seed,
+            save_to_dir=save_to_dir, save_prefix=save_prefix,
+            save_format=save_format, nb_worker=nb_worker, prefetch=prefetch,
+            cache_size=cache_size, cache_dir=cache_dir, backend=backend,
+            bucket_step=bucket_step, echo_factor=echo_factor,
+            echo_buffer=echo_buffer, shuffle_block=shuffle_block,
+            shuffle_buffer=shuffle_buffer)
@@ -1,4 +1,13 @@
+import os
+
+import numpy as np
+from keras import backend as K
+
 from tools.data_loader import ImageDataGenerator
+from tools.autotune import LoaderTuner
+from tools.batch_cache import BatchCache
+from tools.manifest import Manifest, set_cache_dir
+from tools.prefetcher import Prefetcher
 
 
 # Load datasets
@@ -8,6 +17,9 @@ class Dataset_Generators():
         pass
 
     def make(self, cf):
+        # Manifests, annotation indexes and statistics of the datasets
+        set_cache_dir(cf.loader_metadata_dir or os.path.join(cf.savepath, 'dataset_cache'))
+
         mean = cf.dataset.rgb_mean
         std = cf.dataset.rgb_std
         cf.dataset.cb_weights = None
@@ -41,9 +53,13 @@ class Dataset_Generators():
                                        spline_warp=cf.da_spline_warp,
                                        warp_sigma=cf.da_warp_sigma,
                                        warp_grid_size=cf.da_warp_grid_size,
+                                       warp_engine=cf.da_warp_engine,
+                                       warp_bank_size=cf.da_warp_bank_size,
                                        dim_ordering='th' if 'yolo' in cf.model_name else 'default',
                                        class_mode=cf.dataset.class_mode,
-                                       yolo=True if 'yolo' in cf.model_name else False
+                                       yolo=True if 'yolo' in cf.model_name else False,
+                                       batch_affine=cf.loader_batch_affine,
+                                       uint8_augmentation=cf.loader_uint8
                                        )
 
             # Compute normalization constants if required
@@ -64,38 +80,53 @@ class Dataset_Generators():
 
             # Load training data
             if not cf.dataset_name2:
-                train_gen = dg_tr.flow_from_directory(directory=cf.dataset.path_train_img,
-                                                      gt_directory=cf.dataset.path_train_mask,
-                                                      resize=cf.resize_train,
-                                                      target_size=cf.target_size_train,
-                                                      color_mode=cf.dataset.color_mode,
-                                                      classes=cf.dataset.classes,
-                                                      class_mode=cf.dataset.class_mode,
-                                                      batch_size=cf.batch_size_train,
-                                                      shuffle=cf.shuffle_train,
-                                                      seed=cf.seed_train,
-                                                      save_to_dir=cf.savepath if cf.da_save_to_dir else None,
-                                                      save_prefix='data_augmentation',
-                                                      save_format='png')
+                train_gen = self.flow(cf, dg_tr,
+                                      cf.dataset.path_train_img,
+                                      cf.dataset.path_train_mask,
+                                      cf.dataset.path_train_shards,
+                                      resize=cf.resize_train,
+                                      target_size=cf.target_size_train,
+                                      batch_size=cf.batch_size_train,
+                                      shuffle=cf.shuffle_train,
+                                      seed=cf.seed_train,
+                                      save_to_dir=cf.savepath if cf.da_save_to_dir else None,
+                                      save_prefix='data_augmentation',
+                                      save_format='png',
+                                      echo_factor=cf.loader_echo_factor,
+                                      echo_buffer=cf.loader_echo_buffer,
+                                      shuffle_block=cf.loader_shuffle_block,
+                                      shuffle_buffer=cf.loader_shuffle_buffer)
             else:
-                train_gen = dg_tr.flow_from_directory2(directory=cf.dataset.path_train_img,
-                                                       gt_directory=cf.dataset.path_train_mask,
-                                                       resize=cf.resize_train,
-                                                       target_size=cf.target_size_train,
-                                                       color_mode=cf.dataset.color_mode,
-                                                       classes=cf.dataset.classes,
-                                                       class_mode=cf.dataset.class_mode,
-                                                       batch_size=int(cf.batch_size_train * (1. - cf.perc_mb2)),
-                                                       shuffle=cf.shuffle_train,
-                                                       seed=cf.seed_train,
-                                                       save_to_dir=cf.savepath if cf.da_save_to_dir else None,
-                                                       save_prefix='data_augmentation',
-                                                       save_format='png',
-                                                       directory2=cf.dataset2.path_train_img,
-                                                       gt_directory2=cf.dataset2.path_train_mask,
-                                                       batch_size2=int(cf.batch_size_train * cf.perc_mb2)
-                                                       )
+                # Both datasets in every batch, perc_mb2 of the second one
+                train_gen = dg_tr.flow_from_directories(directories=[cf.dataset.path_train_img,
+                                                                     cf.dataset2.path_train_img],
+                                                        gt_directories=[cf.dataset.path_train_mask,
+                                                                        cf.dataset2.path_train_mask],
+                                                        weights=[1. - cf.perc_mb2, cf.perc_mb2],
+                                                        resize=cf.resize_train,
+                                                        target_size=cf.target_size_train,
+                                                        color_mode=cf.dataset.color_mode,
+                                                        classes=cf.dataset.classes,
+                                                        class_mode=cf.dataset.class_mode,
+                                                        batch_size=cf.batch_size_train,
+                                                        shuffle=cf.shuffle_train,
+                                                        seed=cf.seed_train,
+                                                        save_to_dir=cf.savepath if cf.da_save_to_dir else None,
+                                                        save_prefix='data_augmentation',
+                                                        save_format='png',
+                                                        nb_worker=self.nb_worker(cf),
+                                                        prefetch=cf.loader_prefetch,
+                                                        cache_size=cf.loader_cache_size,
+                                                        cache_dir=cf.loader_cache_dir,
+                                                        ring_size=self.ring_size(cf),
+                                                        backend=cf.loader_backend,
+                                                        bucket_step=cf.loader_bucket_step,
+                                                        echo_factor=cf.loader_echo_factor,
+                                                        echo_buffer=cf.loader_echo_buffer,
+                                                        shuffle_block=cf.loader_shuffle_block,
+                                                        shuffle_buffer=cf.loader_shuffle_buffer)
 
+            train_gen = self.prefetch(cf, train_gen, 'Train batches')
         else:
             train_gen = None
 
@@ -114,17 +145,26 @@ class Dataset_Generators():
                                    crop_size=cf.crop_size_valid,
                                    dim_ordering='th' if 'yolo' in cf.model_name else 'default',
                                    class_mode=cf.dataset.class_mode,
-                                   yolo=True if 'yolo' in cf.model_name else False)
-        valid_gen = dg_va.flow_from_directory(directory=cf.dataset.path_valid_img,
-                                              gt_directory=cf.dataset.path_valid_mask,
-                                              resize=cf.resize_valid,
-                                              target_size=cf.target_size_valid,
-                                              color_mode=cf.dataset.color_mode,
-                                              classes=cf.dataset.classes,
-                                              class_mode=cf.dataset.class_mode,
-                                              batch_size=cf.batch_size_valid,
-                                              shuffle=cf.shuffle_valid,
-                                              seed=cf.seed_valid)
+                                   yolo=True if 'yolo' in cf.model_name else False,
+                                   uint8_augmentation=cf.loader_uint8)
+        valid_gen = self.flow(cf, dg_va,
+                              cf.dataset.path_valid_img,
+                              cf.dataset.path_valid_mask,
+                              cf.dataset.path_valid_shards,
+                              resize=cf.resize_valid,
+                              target_size=cf.target_size_valid,
+                              batch_size=cf.batch_size_valid,
+                              shuffle=cf.shuffle_valid,
+                              seed=cf.seed_valid)
+        valid_gen = self.cache(cf, valid_gen, 'Valid batches',
+                               paths=[cf.dataset.path_valid_img,
+                                      cf.dataset.path_valid_mask,
+                                      cf.dataset.path_valid_shards],
+                               mean=mean, std=std, dim_ordering=dg_va.dim_ordering,
+                               resize=cf.resize_valid,
+                               target_size=cf.target_size_valid,
+                               batch_size=cf.batch_size_valid)
+        valid_gen = self.prefetch(cf, valid_gen, 'Valid batches')
 
         if cf.test_model or cf.pred_model:
             # Load testing set
@@ -142,18 +182,100 @@ class Dataset_Generators():
                                        crop_size=cf.crop_size_test,
                                        dim_ordering='th' if 'yolo' in cf.model_name else 'default',
                                        class_mode=cf.dataset.class_mode,
-                                       yolo=True if 'yolo' in cf.model_name else False)
-            test_gen = dg_ts.flow_from_directory(directory=cf.dataset.path_test_img,
-                                                 gt_directory=cf.dataset.path_test_mask,
-                                                 resize=cf.resize_test,
-                                                 target_size=cf.target_size_test,
-                                                 color_mode=cf.dataset.color_mode,
-                                                 classes=cf.dataset.classes,
-                                                 class_mode=cf.dataset.class_mode,
-                                                 batch_size=cf.batch_size_test,
-                                                 shuffle=cf.shuffle_test,
-                                                 seed=cf.seed_test)
+                                       yolo=True if 'yolo' in cf.model_name else False,
+                                       uint8_augmentation=cf.loader_uint8)
+            test_gen = self.flow(cf, dg_ts,
+                                 cf.dataset.path_test_img,
+                                 cf.dataset.path_test_mask,
+                                 cf.dataset.path_test_shards,
+                                 resize=cf.resize_test,
+                                 target_size=cf.target_size_test,
+                                 batch_size=cf.batch_size_test,
+                                 shuffle=cf.shuffle_test,
+                                 seed=cf.seed_test)
+            test_gen = self.prefetch(cf, test_gen, 'Test batches')
         else:
             test_gen = None
 
         return train_gen, valid_gen, test_gen
+
+    # Serve the batches of the validation iterator from a cache after its
+    # first pass (loader_valid_cache). The batches stored on disk are named
+    # after the hash of the settings they depend on, so they are rebuilt
+    # when the configuration or the dataset changes
+    def cache(self, cf, generator, name, paths, mean, std, **settings):
+        if cf.loader_valid_cache is None:
+            return generator
+        elif cf.loader_valid_cache == 'memory':
+            cache_dir = None
+        elif cf.loader_valid_cache == 'disk':
+            cache_dir = cf.loader_valid_cache_dir or os.path.join(cf.savepath, 'valid_cache')
+        else:
+            raise ValueError('Unknown validation cache: ' + str(cf.loader_valid_cache))
+
+        settings.update((k, v) for k, v in vars(cf).items()
+                        if k.startswith('norm_'))
+        settings.update((k, getattr(cf, k)) for k in ('loader_format', 'loader_backend',
+                                                      'loader_uint8', 'loader_bucket_step'))
+        settings.update(paths=paths, color_mode=cf.dataset.color_mode,
+                        classes=cf.dataset.classes,
+                        class_mode=cf.dataset.class_mode,
+                        model_name=cf.model_name, floatx=K.floatx(),
+                        mean=None if mean is None else np.asarray(mean).tolist(),
+                        std=None if std is None else np.asarray(std).tolist())
+        if cf.loader_format == 'directory':
+            settings['mtimes'] = [Manifest.load(path).mtimes
+                                  for path in paths[:2] if path]
+        try:
+            return BatchCache(generator, cache_dir, settings, name)
+        except ValueError as e:
+            print('   {}: not cached ({})'.format(name, e))
+            return generator
+
+    # Build the batches of an iterator ahead, in the background. With
+    # loader_autotune the workers and the queue depth are chosen from the
+    # timings of the first batches
+    def prefetch(self, cf, generator, name):
+        tuner = LoaderTuner(cf.loader_cpu_budget) if cf.loader_autotune else None
+        return Prefetcher(generator, depth=cf.loader_queue_size,
+                          nb_worker=cf.loader_queue_workers,
+                          use_processes=cf.loader_queue_processes, name=name,
+                          tuner=tuner)
+
+    # Worker processes of the iterators. The autotuning measures the first
+    # batches built in process
+    def nb_worker(self, cf):
+        return 0 if cf.loader_autotune else cf.loader_workers
+
+    # Size of the batch ring of the iterators. A batch must outlive the ones
+    # built while it is queued or in use: the prefetch queue, one per
+    # prefetch worker, the one handed over to Keras and the one in use.
+    # The ring hands out its arrays in turn, so it needs the batches to be
+    # finished in order: several prefetch threads allocate new arrays
+    def ring_size(self, cf):
+        if cf.loader_ring_size == 0 or cf.loader_queue_workers > 1:
+            return 0
+        return max(cf.loader_ring_size,
+                   cf.loader_queue_size + cf.loader_queue_workers + 2)
+
+    # Create the iterator of a data split, reading the directory tree or
+    # the packed shards of the dataset
+    def flow(self, cf, dg, img_path, mask_path, shards_path, **kwargs):
+        kwargs.update(color_mode=cf.dataset.color_mode,
+                      classes=cf.dataset.classes,
+                      class_mode=cf.dataset.class_mode,
+                      nb_worker=self.nb_worker(cf),
+                      prefetch=cf.loader_prefetch,
+                      ring_size=self.ring_size(cf),
+                      backend=cf.loader_backend,
+                      bucket_step=cf.loader_bucket_step)
+        if cf.loader_format == 'directory':
+            return dg.flow_from_directory(directory=img_path,
+                                          gt_directory=mask_path,
+                                          cache_size=cf.loader_cache_size,
+                                          cache_dir=cf.loader_cache_dir,
+                                          **kwargs)
+        elif cf.loader_format == 'shards':
+            return dg.flow_from_shards(directory=shards_path, **kwargs)
+        else:
+            raise ValueError('Unknown loader format: ' + cf.loader_format)
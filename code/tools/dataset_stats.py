@@ -0,0 +1,192 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import os
+
+import numpy as np
+import skimage.io as io
+
+from tools.manifest import Manifest, cache_path
+
+"""
+    Statistics of a dataset for ImageDataGenerator.fit_from_directory.
+    The files are processed in one pass, in chunks, by a pool of processes:
+        - uint8 images are summarized as exact per channel 256 bin
+          histograms (other images as per channel sums and squared sums)
+        - masks are summarized as label histograms
+    The statistics are saved in the cache directory of the manifests, keyed
+    by the manifest of the image (or mask) directory (see Manifest.key), and
+    reused while the files do not change.
+"""
+
+
+# Key of files of a directory, from its manifest
+def files_key(directory, file_names, *extra):
+    return Manifest.load(directory).key(
+        [os.path.relpath(f, directory) for f in file_names], *extra)
+
+
+# Statistics of a chunk of images
+def _image_chunk_stats(file_names):
+    hist, n_other, sum_other, sumsq_other = None, 0, 0., 0.
+    for file_name in file_names:
+        x = io.imread(file_name)
+        x = x.reshape((x.shape[0] * x.shape[1], -1))
+        n_channels = x.shape[1]
+        if x.dtype == np.uint8:
+            # One bincount for all the channels: bin = 256 * channel + value
+            bins = x + 256 * np.arange(n_channels, dtype=np.int64)
+            counts = np.bincount(bins.ravel(), minlength=256 * n_channels)
+            counts = counts.reshape((n_channels, 256))
+            hist = counts if hist is None else hist + counts
+        else:
+            x = x.astype(np.float64)
+            n_other += x.shape[0]
+            sum_other += np.sum(x, axis=0)
+            sumsq_other += np.sum(x * x, axis=0)
+    return hist, n_other, sum_other, sumsq_other
+
+
+# Label counts of a chunk of masks
+def _mask_chunk_stats(args):
+    file_names, n_classes, n_labels = args
+    count_per_label = np.zeros(n_labels)
+    total_count_per_label = np.zeros(n_labels)
+    for file_name in file_names:
+        mask = io.imread(file_name).astype('int32')
+        counts = np.bincount(mask.ravel(), minlength=n_labels)
+        if len(counts) > n_labels:
+            raise ValueError('Label {} out of range in {}'.format(
+                len(counts) - 1, file_name))
+        count_per_label += counts
+
+        # Every label of the mask counts the pixels of the first n_classes
+        # labels present in the mask
+        present = np.flatnonzero(counts)
+        total_count_per_label[present] += np.sum(counts[present[:n_classes]])
+    return count_per_label, total_count_per_label
+
+
+# Run a function on chunks of the files and return the results
+def _map_chunks(func, chunks, nb_worker):
+    if nb_worker is None:
+        nb_worker = multiprocessing.cpu_count()
+    nb_worker = min(nb_worker, len(chunks))
+    if nb_worker <= 1:
+        return [func(chunk) for chunk in chunks]
+    pool = multiprocessing.Pool(nb_worker)
+    try:
+        return pool.map(func, chunks)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _split(file_names, chunk_size):
+    return [file_names[i:i + chunk_size]
+            for i in range(0, len(file_names), chunk_size)]
+
+
+def _load_cache(directory, key):
+    stats_path = cache_path(directory, 'fit_stats.npz')
+    if stats_path is None or not os.path.isfile(stats_path):
+        return None
+    stats = np.load(stats_path)
+    if str(stats['key']) != key:
+        return None
+    return stats
+
+
+def _save_cache(directory, **stats):
+    stats_path = cache_path(directory, 'fit_stats.npz')
+    if stats_path is None:
+        return
+    tmp_path = '{}.{}.tmp'.format(stats_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **stats)
+        os.rename(tmp_path, stats_path)
+    except (IOError, OSError) as e:
+        print('   Could not save the dataset statistics: ' + str(e))
+
+
+def image_mean_std(directory, file_names, nb_worker=None, chunk_size=64):
+    """Per channel mean and std of the images of a directory.
+    # Arguments
+        directory: Directory of the images, whose statistics are cached.
+        file_names: Image files.
+        nb_worker: Number of processes (None: one per CPU).
+        chunk_size: Number of images per task.
+    # Return
+        mean, std: Arrays with one value per channel
+    """
+    file_names = sorted(file_names)
+    key = files_key(directory, file_names)
+    stats = _load_cache(directory, key)
+    if stats is not None:
+        print('   Using the statistics saved for ' + directory)
+        return stats['mean'], stats['std']
+
+    # Merge the statistics of the chunks
+    hist, n_other, sum_other, sumsq_other = None, 0, 0., 0.
+    for c_hist, c_n, c_sum, c_sumsq in _map_chunks(_image_chunk_stats,
+                                                   _split(file_names, chunk_size),
+                                                   nb_worker):
+        if c_hist is not None:
+            hist = c_hist if hist is None else hist + c_hist
+        n_other += c_n
+        sum_other += c_sum
+        sumsq_other += c_sumsq
+
+    # Mean and variance from the histograms and the sums
+    values = np.arange(256, dtype=np.float64)
+    n = n_other
+    total = sum_other
+    if hist is not None:
+        n += hist[0].sum()
+        total = total + np.dot(hist, values)
+    mean = total / n
+    var = sumsq_other - 2 * mean * sum_other + n_other * mean ** 2
+    if hist is not None:
+        var = var + np.sum(hist * (values - mean[:, None]) ** 2, axis=1)
+    std = np.sqrt(var / n)
+
+    _save_cache(directory, key=key, mean=mean, std=std)
+    return mean, std
+
+
+def label_counts(directory, file_names, n_classes, n_labels, nb_worker=None,
+                 chunk_size=64):
+    """Label counts of the masks of a directory.
+    # Arguments
+        directory: Directory of the masks, whose counts are cached.
+        file_names: Mask files.
+        n_classes: Number of classes (not void).
+        n_labels: Number of labels (classes and void labels).
+        nb_worker: Number of processes (None: one per CPU).
+        chunk_size: Number of masks per task.
+    # Return
+        count_per_label: Pixels of each label.
+        total_count_per_label: Pixels of the masks where each label is
+            present.
+    """
+    file_names = sorted(file_names)
+    key = files_key(directory, file_names, n_classes, n_labels)
+    stats = _load_cache(directory, key)
+    if stats is not None:
+        print('   Using the label counts saved for ' + directory)
+        return stats['count_per_label'], stats['total_count_per_label']
+
+    count_per_label = np.zeros(n_labels)
+    total_count_per_label = np.zeros(n_labels)
+    chunks = [(chunk, n_classes, n_labels)
+              for chunk in _split(file_names, chunk_size)]
+    for counts, totals in _map_chunks(_mask_chunk_stats, chunks, nb_worker):
+        count_per_label += counts
+        total_count_per_label += totals
+
+    _save_cache(directory, key=key, count_per_label=count_per_label,
+                total_count_per_label=total_count_per_label)
+    return count_per_label, total_count_per_label
@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import multiprocessing
+import threading
+from collections import OrderedDict
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+"""
+    Data echoing: every decoded sample is augmented several times (echoes)
+    before it is dropped, which divides the reading and decoding cost per
+    training sample by the echo factor. The echoes of the samples of a few
+    consecutive batches are shuffled together, so the echoes of a sample
+    fall in different batches.
+"""
+
+
+def echo_index(index_generator, n, batch_size, factor, buffer_batches):
+    """Index generator yielding every index of another one `factor` times.
+    # Arguments
+        index_generator: Generator of (index_array, current_index,
+            current_batch_size), as the one of the Keras Iterator.
+        n: Number of samples of an epoch of the index generator.
+        batch_size: Maximum number of samples of a batch.
+        factor: Echoes of every sample.
+        buffer_batches: Batches of the index generator whose echoes are
+            shuffled together (1 keeps the echoes of a size bucket in its
+            batches).
+    # Yields
+        index_array, current_index, current_batch_size. current_index
+        approximately counts the samples of the epoch before the batch (each
+        sample once). It reaches the end of the epoch with its last batch
+        only
+    """
+    while 1:
+        # Indices of the next batches of the epoch (the window ends with the
+        # epoch, so the echoes of two epochs are not mixed)
+        arrays = []
+        epoch_end = False
+        for _ in range(buffer_batches):
+            index_array, current_index, current_batch_size = next(index_generator)
+            if not arrays:
+                window_start = current_index
+            arrays.append(index_array)
+            if current_index + current_batch_size >= n:
+                epoch_end = True
+                break
+        indices = np.repeat(np.concatenate(arrays), factor)
+        np.random.shuffle(indices)
+
+        for start in range(0, len(indices), batch_size):
+            index_array = indices[start:start + batch_size]
+            current_batch_size = len(index_array)
+            if epoch_end and start + batch_size >= len(indices):
+                current_index = n - current_batch_size
+            else:
+                current_index = min(window_start + start // factor,
+                                    n - current_batch_size - 1)
+            yield index_array, current_index, current_batch_size
+
+
+class SampleHold(object):
+    """Decoded samples held for their next echoes. The echoes are copies, so
+    the held samples are never modified in place. The hold is bounded, so
+    the samples whose echoes are built elsewhere (other worker processes)
+    are dropped in turn.
+    # Arguments
+        factor: Echoes of every sample.
+        max_samples: Maximum number of samples held.
+    """
+
+    def __init__(self, factor, max_samples):
+        self.factor = factor
+        self.max_samples = max_samples
+        self.samples = OrderedDict()
+        self.lock = threading.Lock()
+
+        # Samples decoded and echoed. The counters live on shared memory so
+        # forked loader workers report to the same ones, under a process lock
+        self.counts = np.frombuffer(RawArray('l', 2), dtype=np.dtype('l'))
+        self.counts_lock = multiprocessing.Lock()
+
+    def get(self, j, load_sample):
+        """Sample j: a copy of the held one, or of the one loaded with
+        load_sample(j) (then held for its next echoes).
+        """
+        with self.lock:
+            held = self.samples.get(j)
+            if held is not None:
+                held[2] -= 1
+                if held[2] == 0:
+                    del self.samples[j]
+        if held is not None:
+            x, y = held[0], held[1]
+            self.count(1)
+        else:
+            x, y = load_sample(j)
+            self.count(0)
+            with self.lock:
+                if self.factor > 1:
+                    self.samples[j] = [x, y, self.factor - 1]
+                    while len(self.samples) > self.max_samples:
+                        self.samples.popitem(last=False)
+        return x.copy(), (None if y is None else y.copy())
+
+    def count(self, column):
+        with self.counts_lock:
+            self.counts[column] += 1
+
+    def summary(self):
+        with self.counts_lock:
+            nb_decoded, nb_echoed = self.counts
+        total = max(nb_decoded + nb_echoed, 1)
+        return '{} samples decoded, {} echoed ({:.0f}% of the samples)'.format(
+            nb_decoded, nb_echoed, 100. * nb_echoed / total)
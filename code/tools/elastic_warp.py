@@ -0,0 +1,127 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+from tools.batch_augmentation import fill_indices
+
+"""
+    Elastic deformation with a bank of precomputed warp fields.
+    A field is a cubic B-spline deformation with random shifts of the
+    control points (as the SimpleITK BSplineTransform of gen_warp_field),
+    evaluated in numpy and stored as the source [row, col] coordinates of
+    every output pixel. The images are warped with one vectorized gather
+    for all the channels (bilinear) and the GT image (nearest neighbour).
+"""
+
+
+# Cubic B-spline weights of the control points of n samples over a mesh of
+# grid_size intervals, as a (n, grid_size + 3) matrix
+def bspline_weights(n, grid_size):
+    # The control points start one mesh interval before the first sample
+    u = np.arange(n) * grid_size / max(n - 1, 1.)
+    i = np.minimum(np.floor(u).astype(np.int64), grid_size - 1)
+    t = u - i
+
+    basis = np.stack(((1 - t) ** 3 / 6,
+                      (3 * t ** 3 - 6 * t ** 2 + 4) / 6,
+                      (-3 * t ** 3 + 3 * t ** 2 + 3 * t + 1) / 6,
+                      t ** 3 / 6), axis=1)
+    weights = np.zeros((n, grid_size + 3))
+    for k in range(4):
+        weights[np.arange(n), i + k] = basis[:, k]
+    return weights
+
+
+# Draw a random B-spline deformation and return the source coordinates
+def gen_warp_coords(shape, sigma=0.1, grid_size=3, rng=np.random):
+    h, w = shape
+    w_rows = bspline_weights(h, grid_size)
+    w_cols = bspline_weights(w, grid_size)
+
+    # Shifts of the control points, anchored at the edges of the image
+    p = sigma * rng.randn(2, grid_size + 3, grid_size + 3)
+    p[:, [0, -1], :] = 0
+    p[:, :, [0, -1]] = 0
+
+    # Separable evaluation of the spline: W_rows * P * W_cols^T
+    displacement = np.matmul(np.matmul(w_rows, p), w_cols.T)
+    rows, cols = np.mgrid[0:h, 0:w]
+    return (np.stack((rows, cols)) + displacement).astype(np.float32)
+
+
+class WarpFieldBank(object):
+    """Bank of precomputed warp fields, drawn at random for every sample.
+    A bank is built the first time a (shape, sigma, grid_size) is used.
+    Each field takes 8 bytes per pixel.
+    # Arguments
+        bank_size: Number of fields per (shape, sigma, grid_size).
+        seed: Seed of the fields, so every loader process builds the same
+            bank.
+    """
+
+    def __init__(self, bank_size=16, seed=1):
+        self.bank_size = bank_size
+        self.seed = seed
+        self.banks = {}
+
+    def get(self, shape, sigma, grid_size):
+        key = (tuple(int(s) for s in shape), sigma, grid_size)
+        bank = self.banks.get(key)
+        if bank is None:
+            rng = np.random.RandomState(self.seed)
+            bank = [gen_warp_coords(key[0], sigma, grid_size, rng)
+                    for _ in range(self.bank_size)]
+            self.banks[key] = bank
+        return bank[np.random.randint(len(bank))]
+
+
+# Gather the points [rows, cols] of a channels last image
+def _gather(x, rows, cols, fill_mode, cval):
+    h, w = x.shape[:2]
+    out = x[fill_indices(rows, h, fill_mode), fill_indices(cols, w, fill_mode)]
+    if fill_mode == 'constant':
+        outside = (rows < 0) | (rows > h - 1) | (cols < 0) | (cols > w - 1)
+        out[outside] = cval
+    return out
+
+
+def apply_warp_field(coords, x, y=None, channel_index=0, fill_mode='reflect',
+                     cval=0., y_cval=0.):
+    """Warp an image (bilinear) and its GT image (nearest neighbour).
+    # Arguments
+        coords: (2, rows, cols) source coordinates of every output pixel.
+        x: Image.
+        y: GT image or None.
+        channel_index: Channel axis of x and y.
+        fill_mode: 'constant', 'nearest', 'reflect' or 'wrap'.
+        cval: Value of the points outside the image when fill_mode is
+            'constant'.
+        y_cval: Value of the points outside the GT image when fill_mode is
+            'constant'.
+    # Return
+        x, y: The warped images
+    """
+    rows, cols = coords
+    r0 = np.floor(rows).astype(np.int64)
+    c0 = np.floor(cols).astype(np.int64)
+    fr = (rows - r0)[..., None]
+    fc = (cols - c0)[..., None]
+
+    # Bilinear interpolation of all the channels at once
+    x = np.rollaxis(x, channel_index, x.ndim)
+    x_warped = ((1 - fr) * (1 - fc) * _gather(x, r0, c0, fill_mode, cval) +
+                fr * (1 - fc) * _gather(x, r0 + 1, c0, fill_mode, cval) +
+                (1 - fr) * fc * _gather(x, r0, c0 + 1, fill_mode, cval) +
+                fr * fc * _gather(x, r0 + 1, c0 + 1, fill_mode, cval))
+    x_warped = np.rollaxis(x_warped.astype(x.dtype, copy=False), x.ndim - 1,
+                           channel_index)
+
+    # Nearest neighbour for the labels
+    if y is not None:
+        y = np.rollaxis(y, channel_index, y.ndim)
+        y = _gather(y, np.floor(rows + 0.5).astype(np.int64),
+                    np.floor(cols + 0.5).astype(np.int64), fill_mode, y_cval)
+        y = np.rollaxis(y, y.ndim - 1, channel_index)
+
+    return x_warped, y
@@ -0,0 +1,183 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import OrderedDict
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+"""
+    Cache of decoded and resized images for load_img.
+    Images are stored compact (uint8 when the file is uint8) in a bounded
+    in-memory LRU. Evicted images can be spilled to a directory on disk.
+    With worker processes every file is always loaded by the same worker
+    (see SharedBatchPool), which caches it in its share of the budget.
+"""
+
+# Columns of the counters of a process: hits in memory, hits on disk,
+# misses, images and bytes held in memory
+_nb_counters = 5
+
+
+class ImageCache(object):
+    """LRU cache of decoded images.
+    # Arguments
+        max_bytes: Maximum size in bytes of the images held in memory, by
+            all the processes.
+        spill_dir: Directory where evicted images are saved, or None to
+            drop them.
+    """
+
+    def __init__(self, max_bytes, spill_dir=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.n_bytes = 0
+        self.images = OrderedDict()
+        # load_img is called by concurrent threads (loader_queue_workers)
+        self.lock = threading.Lock()
+
+        # One row of counters per process (see set_workers), on shared
+        # memory so the main process reports the ones of its workers
+        self.counts_lock = multiprocessing.Lock()
+        self.counts = None
+        self.row = 0
+        self.set_workers(0)
+
+        if spill_dir is not None and not os.path.exists(spill_dir):
+            os.makedirs(spill_dir)
+
+    @staticmethod
+    def key(path, resize, order, backend='skimage'):
+        resize = None if resize is None else tuple(int(s) for s in resize)
+        return path, os.path.getmtime(path), resize, order, backend
+
+    def set_workers(self, nb_worker):
+        """Allocate the counters of the main process (row 0) and of
+        nb_worker worker processes, before they are forked. The hits and
+        misses of the previous workers are added to row 0. The images of
+        the main process are spilled (or dropped) as it stops loading them.
+        """
+        counts = np.frombuffer(RawArray('l', _nb_counters * (nb_worker + 1)),
+                               dtype=np.dtype('l')).reshape(-1, _nb_counters)
+        with self.lock:
+            if self.counts is not None:
+                counts[0, :3] = self.counts[:, :3].sum(axis=0)
+            if nb_worker > 0:
+                while self.images:
+                    self._evict()
+            self.counts = counts
+            self._count()
+
+    def init_worker(self, worker=None, nb_worker=1):
+        """Prepare the cache in a forked process.
+        # Arguments
+            worker: Index of the process in the worker pool, which holds
+                the images of its files in its share of the budget, or None
+                for a process with the counters of the main one.
+            nb_worker: Number of processes of the worker pool.
+        """
+        # The threads of the parent may hold the lock at the fork
+        self.lock = threading.Lock()
+        if worker is not None:
+            self.row = worker + 1
+            self.max_bytes //= nb_worker
+            self.images = OrderedDict()
+            self.n_bytes = 0
+            self._count()
+
+    def get(self, key):
+        with self.lock:
+            # Look in memory
+            img = self.images.pop(key, None)
+            if img is not None:
+                self.images[key] = img
+                self._count(0)
+                return img
+
+            # Look on disk
+            if self.spill_dir is not None:
+                spill_path = self._spill_path(key)
+                if os.path.isfile(spill_path):
+                    img = np.load(spill_path)
+                    img.flags.writeable = False
+                    self._store(key, img)
+                    self._count(1)
+                    return img
+
+            self._count(2)
+            return None
+
+    def put(self, key, img, src_dtype):
+        # Keep uint8 images as uint8 even if the resize made them float
+        if src_dtype == np.uint8 and img.dtype != np.uint8:
+            img = np.round(img).astype(np.uint8)
+        img.flags.writeable = False
+        with self.lock:
+            self._store(key, img)
+            self._count()
+        return img
+
+    def _count(self, column=None):
+        # Called with the lock held: count a hit or miss of this process and
+        # publish the images it holds
+        with self.counts_lock:
+            if column is not None:
+                self.counts[self.row, column] += 1
+            self.counts[self.row, 3] = len(self.images)
+            self.counts[self.row, 4] = self.n_bytes
+
+    def _store(self, key, img):
+        # Called with the lock held. Another thread may have stored the same
+        # image since this one missed it
+        old_img = self.images.pop(key, None)
+        if old_img is not None:
+            self.n_bytes -= old_img.nbytes
+        if img.nbytes > self.max_bytes:
+            return
+        self.images[key] = img
+        self.n_bytes += img.nbytes
+
+        # Evict the least recently used images
+        while self.n_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self):
+        old_key, old_img = self.images.popitem(last=False)
+        self.n_bytes -= old_img.nbytes
+        if self.spill_dir is not None:
+            self._spill(old_key, old_img)
+
+    def _spill_path(self, key):
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.spill_dir, name + '.npy')
+
+    def _spill(self, key, img):
+        spill_path = self._spill_path(key)
+        if os.path.isfile(spill_path):
+            return
+        # Write and rename, other processes may be reading the same file
+        tmp_path = '{}.{}.tmp'.format(spill_path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.save(f, img)
+        os.rename(tmp_path, spill_path)
+
+    def summary(self):
+        with self.counts_lock:
+            counts = self.counts.copy()
+        mem_hits, disk_hits, misses, nb_images, n_bytes = [
+            int(c) for c in counts.sum(axis=0)]
+        total = max(1, mem_hits + disk_hits + misses)
+        text = ('{} memory hits, {} disk hits, {} misses ({:.1f}% hit rate), '
+                '{} images / {:.1f} MB in memory').format(
+            mem_hits, disk_hits, misses,
+            100. * (mem_hits + disk_hits) / total,
+            nb_images, n_bytes / 2. ** 20)
+        if len(counts) > 1:
+            text += ' ({} MB per worker of {:.1f} MB)'.format(
+                ', '.join('{:.1f}'.format(c / 2. ** 20) for c in counts[1:, 4]),
+                float(self.max_bytes) / (len(counts) - 1) / 2. ** 20)
+        return text
@@ -0,0 +1,189 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 with the scandir package
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+"""
+    Cached directory manifests.
+    A manifest lists the files (with their sizes) of a directory and of its
+    subdirectories. It is saved in the cache directory (see set_cache_dir)
+    and reused while the modification times of the directory and its
+    subdirectories do not change, which costs one stat per directory
+    instead of one per file. Changes to the content of a file that keep its
+    name are not detected.
+"""
+
+# Manifests already read in this process
+_manifests = {}
+
+# Directory of the cache files of the datasets, None to keep them in memory
+_cache_dir = None
+
+
+def set_cache_dir(directory):
+    """Set the directory where the manifests, annotation indexes and
+    statistics of the datasets are saved (None: they are not saved).
+    """
+    global _cache_dir
+    if directory is not None and not os.path.exists(directory):
+        os.makedirs(directory)
+    _cache_dir = directory
+
+
+# Path of a cache file of a directory, named after the directory and the
+# hash of its path, or None without cache directory
+def cache_path(directory, name):
+    if _cache_dir is None:
+        return None
+    directory = os.path.normpath(os.path.abspath(directory))
+    digest = hashlib.sha1(directory.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(_cache_dir, '{}-{}.{}'.format(
+        os.path.basename(directory), digest, name))
+
+
+# List the files (name: size) and subdirectories of a directory
+def scan_dir(directory):
+    files, subdirs = {}, []
+    if scandir is not None:
+        for entry in scandir(directory):
+            if entry.is_dir():
+                subdirs.append(entry.name)
+            elif entry.is_file():
+                files[entry.name] = entry.stat().st_size
+    else:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                subdirs.append(name)
+            elif os.path.isfile(path):
+                files[name] = os.path.getsize(path)
+    return files, sorted(subdirs)
+
+
+class Manifest(object):
+    """Files of a directory and of its subdirectories.
+    Use Manifest.load(directory) to get the cached manifest.
+    # Arguments
+        directory: Path of the directory.
+        files: Files (name: size) of the directory.
+        subdirs: Files (name: size) of each subdirectory.
+        mtimes: Modification times of the directory and subdirectories.
+    """
+
+    def __init__(self, directory, files, subdirs, mtimes):
+        self.directory = directory
+        self.files = files
+        self.subdirs = subdirs
+        self.mtimes = mtimes
+
+    @classmethod
+    def load(cls, directory):
+        directory = os.path.normpath(os.path.abspath(directory))
+        manifest_path = cache_path(directory, 'manifest.json')
+
+        # Manifest of this process or saved manifest, if still valid
+        manifest = _manifests.get(directory)
+        if (manifest is None and manifest_path is not None and
+                os.path.isfile(manifest_path)):
+            try:
+                with open(manifest_path) as f:
+                    data = json.load(f)
+                manifest = cls(directory, data['files'], data['subdirs'],
+                               data['mtimes'])
+            except (IOError, OSError, ValueError, KeyError):
+                manifest = None
+        if manifest is not None and manifest.is_valid():
+            _manifests[directory] = manifest
+            return manifest
+
+        # Scan the directory
+        mtimes = {'.': os.path.getmtime(directory)}
+        files, subdir_names = scan_dir(directory)
+        subdirs = {}
+        for subdir in subdir_names:
+            subpath = os.path.join(directory, subdir)
+            mtimes[subdir] = os.path.getmtime(subpath)
+            subdirs[subdir] = scan_dir(subpath)[0]
+        manifest = cls(directory, files, subdirs, mtimes)
+        _manifests[directory] = manifest
+
+        # Save it
+        if manifest_path is None:
+            return manifest
+        tmp_path = '{}.{}.tmp'.format(manifest_path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'files': files, 'subdirs': subdirs,
+                           'mtimes': mtimes}, f)
+            os.rename(tmp_path, manifest_path)
+        except (IOError, OSError) as e:
+            print('   Could not save the manifest of {}: {}'.format(directory, e))
+        return manifest
+
+    def is_valid(self):
+        # The same subdirectories, none of them modified
+        try:
+            if os.path.getmtime(self.directory) != self.mtimes['.']:
+                return False
+            for subdir in self.subdirs:
+                subpath = os.path.join(self.directory, subdir)
+                if os.path.getmtime(subpath) != self.mtimes[subdir]:
+                    return False
+        except OSError:
+            return False
+        return True
+
+    def subdir_names(self):
+        return sorted(self.subdirs)
+
+    def list_files(self, subdir=None, filter=None):
+        """Sorted names of the files of the directory or of a subdirectory.
+        # Arguments
+            subdir: Subdirectory or None for the directory itself.
+            filter: Function that tells which file names to keep.
+        """
+        if subdir is None:
+            files = self.files
+        elif subdir in self.subdirs:
+            files = self.subdirs[subdir]
+        else:
+            raise ValueError('Directory not found: ' +
+                             os.path.join(self.directory, subdir))
+        return sorted(f for f in files if filter is None or filter(f))
+
+    def file_size(self, name):
+        # Size in bytes of a file (0 if unknown), its name relative to the
+        # directory
+        subdir, base = os.path.split(name)
+        files = self.subdirs.get(subdir, {}) if subdir else self.files
+        return files.get(base, 0)
+
+    def key(self, file_names, *extra):
+        """Key of files of the directory, from the modification times of
+        the directories and the sizes of the files, without reading them.
+        # Arguments
+            file_names: Names of the files, relative to the directory.
+            extra: Other values the key depends on.
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps(self.mtimes, sort_keys=True).encode('utf-8'))
+        for name in file_names:
+            h.update('{}:{}\n'.format(name, self.file_size(name)).encode('utf-8'))
+        h.update(repr(extra).encode('utf-8'))
+        return h.hexdigest()
+
+    def has_file(self, name, subdir=None):
+        if subdir is None:
+            return name in self.files
+        return name in self.subdirs.get(subdir, {})
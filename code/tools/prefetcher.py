@@ -0,0 +1,271 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import atexit
+import multiprocessing
+import threading
+import time
+import traceback
+
+from six.moves import queue
+
+"""
+    Prefetching of the batches of a generator: worker threads (or a
+    process) build the next batches into a bounded queue while the model
+    consumes the current one. The consumer blocks on the queue (no polling)
+    and the workers block when it is full, so at most `depth` batches are
+    built ahead. The time the consumer waits for batches tells whether the
+    training is input-bound.
+"""
+
+# The producer process is forked, so the generator is not pickled
+try:
+    _context = multiprocessing.get_context('fork')
+except AttributeError:
+    # Python 2 always forks
+    _context = multiprocessing
+
+# Seconds between the checks of the stop event of a blocked worker
+_poll_interval = 0.1
+
+
+# Marks the end of the generator
+class _End(object):
+    pass
+
+
+# Error raised by a worker, re-raised by the consumer
+class _Failure(object):
+    def __init__(self, error, traceback_text):
+        self.error = error
+        self.traceback_text = traceback_text
+
+
+# Put an item in the queue unless the prefetcher stops while it is full
+def _put(batch_queue, stop_event, item):
+    while not stop_event.is_set():
+        try:
+            batch_queue.put(item, timeout=_poll_interval)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+# Loop of a worker: build batches until the stop event or the end of the
+# generator. Every batch is sent with the seconds it took
+def _produce(generator, batch_queue, stop_event, pickle_errors):
+    while not stop_event.is_set():
+        start_time = time.time()
+        try:
+            batch = next(generator)
+        except StopIteration:
+            _put(batch_queue, stop_event, _End())
+            return
+        except Exception as e:
+            # Exceptions may not be picklable, their text is
+            error = RuntimeError(repr(e)) if pickle_errors else e
+            _put(batch_queue, stop_event,
+                 _Failure(error, traceback.format_exc()))
+            return
+        if not _put(batch_queue, stop_event, (batch, time.time() - start_time)):
+            return
+
+
+# Loop of the worker process. The iterators of the data loader reset the
+# state their threads could hold at the fork
+def _produce_in_process(generator, batch_queue, stop_event):
+    if hasattr(generator, 'init_worker'):
+        generator.init_worker()
+    _produce(generator, batch_queue, stop_event, True)
+
+
+class Prefetcher(object):
+    """Iterator over the batches of a generator, built ahead by workers.
+    The workers start on the first batch requested.
+    # Arguments
+        generator: Iterator of batches. With threads it is shared by the
+            workers, so it must be thread safe (as the DirectoryIterator).
+        depth: Maximum number of batches waiting in the queue.
+        nb_worker: Number of worker threads.
+        use_processes: Whether the batches are built in a forked process
+            (one, as its copies of the generator would yield the same
+            batches) and sent through a pipe.
+        name: Name of the prefetcher in the statistics.
+        tuner: LoaderTuner (tools/autotune.py) fed with the timings of the
+            batches, or None.
+    """
+
+    def __init__(self, generator, depth=10, nb_worker=1, use_processes=False,
+                 name='batches', tuner=None):
+        if depth < 1:
+            raise ValueError('The prefetch depth must be at least 1')
+        if use_processes and nb_worker != 1:
+            raise ValueError('Process prefetching uses one process. Build '
+                             'the batches in parallel with the workers of '
+                             'the iterator (loader_workers)')
+        if use_processes and tuner is not None:
+            raise ValueError('The iterator of a process prefetcher runs in '
+                             'another process and can not be tuned')
+        self.generator = generator
+        self.depth = depth
+        self.nb_worker = nb_worker
+        self.use_processes = use_processes
+        self.name = name
+        self.tuner = tuner
+
+        self.queue = None
+        self.stop_event = None
+        self.workers = []
+        self.finished = False
+        self.last_batch_time = None
+        self.stop_at_exit = False
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def start(self):
+        if self.workers:
+            return
+        if self.use_processes:
+            self.queue = _context.Queue(maxsize=self.depth)
+            self.stop_event = _context.Event()
+            # Not a daemon, so it may start the workers of the iterator
+            worker = _context.Process(target=_produce_in_process,
+                                      args=(self.generator, self.queue,
+                                            self.stop_event))
+            worker.start()
+            self.workers = [worker]
+            if not self.stop_at_exit:
+                atexit.register(self.stop)
+                self.stop_at_exit = True
+        else:
+            self.queue = queue.Queue(maxsize=self.depth)
+            self.stop_event = threading.Event()
+            for _ in range(self.nb_worker):
+                worker = threading.Thread(target=_produce,
+                                          args=(self.generator, self.queue,
+                                                self.stop_event, False))
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+        self.finished = False
+
+    def stop(self, timeout=5.):
+        # Stop the workers and drop the prefetched batches
+        if not self.workers:
+            return
+        self.stop_event.set()
+        self.drain()
+        for worker in self.workers:
+            worker.join(timeout)
+            if self.use_processes and worker.is_alive():
+                worker.terminate()
+        if self.use_processes:
+            self.queue.close()
+        self.workers = []
+        self.queue = None
+        self.stop_event = None
+
+    def set_depth(self, depth):
+        # Change the maximum number of waiting batches. The queue of the
+        # process workers has a fixed size
+        if self.use_processes:
+            raise ValueError('The queue depth of process prefetching is fixed')
+        self.depth = depth
+        if self.queue is not None:
+            with self.queue.mutex:
+                self.queue.maxsize = depth
+                self.queue.not_full.notify_all()
+
+    def drain(self):
+        try:
+            while True:
+                self.queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def close(self):
+        # Stop the workers and release the generator (its worker processes)
+        self.stop()
+        if hasattr(self.generator, 'close'):
+            self.generator.close()
+
+    def next(self):
+        with self.lock:
+            if self.finished:
+                raise StopIteration()
+            self.start()
+
+            # Depth of the queue seen by the consumer (not available on
+            # every platform for process queues)
+            if self.depth_sum is not None:
+                try:
+                    self.depth_sum += self.queue.qsize()
+                except NotImplementedError:
+                    self.depth_sum = None
+
+            # Time the consumer spent on the previous batch
+            start_time = time.time()
+            step_time = None
+            if self.last_batch_time is not None:
+                step_time = start_time - self.last_batch_time
+
+            item = self.queue.get()
+            wait_time = time.time() - start_time
+            self.wait_time += wait_time
+
+            if isinstance(item, _End):
+                self.finished = True
+                raise StopIteration()
+            if isinstance(item, _Failure):
+                print(item.traceback_text)
+                self.finished = True
+                raise item.error
+
+            batch, seconds = item
+            self.nb_batch += 1
+            self.build_time += seconds
+            if self.tuner is not None:
+                self.tuner.update(self, step_time, wait_time, seconds)
+            self.last_batch_time = time.time()
+            return batch
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.next()
+
+    def reset_stats(self):
+        self.nb_batch = 0
+        self.wait_time = 0.
+        self.build_time = 0.
+        self.depth_sum = 0
+        self.start_time = time.time()
+
+    def stats(self):
+        """Statistics since the last reset_stats.
+        # Return
+            Dictionary with the number of batches, the seconds the consumer
+            waited for them (and its fraction of the elapsed time), the mean
+            queue depth found by the consumer (None if unknown) and the
+            mean seconds a worker took to build a batch.
+        """
+        elapsed = time.time() - self.start_time
+        nb_batch = max(self.nb_batch, 1)
+        return {'batches': self.nb_batch,
+                'wait_time': self.wait_time,
+                'wait_fraction': self.wait_time / elapsed if elapsed > 0 else 0.,
+                'queue_depth': (None if self.depth_sum is None
+                                else self.depth_sum / float(nb_batch)),
+                'build_time': self.build_time / nb_batch}
+
+    def summary(self):
+        stats = self.stats()
+        depth = ('n/a' if stats['queue_depth'] is None
+                 else '{:.1f}'.format(stats['queue_depth']))
+        return ('{}: {} batches, waited {:.2f} s ({:.0f}% of the time), '
+                'queue depth {}/{}, {:.0f} ms/batch per worker'.format(
+                    self.name, stats['batches'], stats['wait_time'],
+                    100 * stats['wait_fraction'], depth, self.depth,
+                    1000 * stats['build_time']))
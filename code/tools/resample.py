@@ -0,0 +1,307 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+from tools.batch_augmentation import fill_indices
+
+"""
+    Geometric augmentation of the ImageDataGenerator in one resampling pass.
+    The affine transform, the flips and the crop (or pad) window are
+    composed into one matrix mapping every output pixel to its source
+    pixel, so the image and its GT image are read once, at the points the
+    output needs. The elastic warp, which is not a matrix, is composed as
+    a coordinate map between the window and the matrix.
+    Only the bounding box of the source pixels (the source region) has to
+    be standardized, so the crop window can be drawn first and the pixels
+    it discards are never processed.
+"""
+
+
+# Cast an augmented image to the data type of its source, rounded and
+# clipped to the range of integer types
+def cast_image(x, dtype):
+    dtype = np.dtype(dtype)
+    if x.dtype == dtype:
+        return x
+    if dtype.kind in 'ui':
+        info = np.iinfo(dtype)
+        x = np.clip(np.rint(x), info.min, info.max)
+    return x.astype(dtype)
+
+
+# Nearest neighbour source [rows, cols] of the output points of an affine
+# transform, as batch_apply_transform. outside is None unless fill_mode is
+# 'constant'
+def affine_source(rows, cols, matrix, h, w, fill_mode):
+    integer = np.all(matrix == np.round(matrix))
+    if integer:
+        # Flips and offsets: integer points map to integer points
+        matrix = matrix.astype(np.int64)
+    src_rows = matrix[0, 0] * rows + matrix[0, 1] * cols + matrix[0, 2]
+    src_cols = matrix[1, 0] * rows + matrix[1, 1] * cols + matrix[1, 2]
+    outside = None
+    if fill_mode == 'constant':
+        outside = ((src_rows < 0) | (src_rows > h - 1) |
+                   (src_cols < 0) | (src_cols > w - 1))
+    if not integer:
+        src_rows = np.floor(src_rows + 0.5).astype(np.int64)
+        src_cols = np.floor(src_cols + 0.5).astype(np.int64)
+    src_rows = fill_indices(src_rows, h, fill_mode)
+    src_cols = fill_indices(src_cols, w, fill_mode)
+    return src_rows, src_cols, outside
+
+
+# Integer points read by the elastic warp (as apply_warp_field), with
+# their weights and the points outside the image ('constant' fill mode)
+def warp_points(coords, h, w, fill_mode, nearest=False):
+    rows, cols = coords
+    if nearest:
+        corners = [(np.floor(rows + 0.5).astype(np.int64),
+                    np.floor(cols + 0.5).astype(np.int64), None)]
+    else:
+        r0 = np.floor(rows).astype(np.int64)
+        c0 = np.floor(cols).astype(np.int64)
+        fr = (rows - r0).astype(np.float32)[..., None]
+        fc = (cols - c0).astype(np.float32)[..., None]
+        corners = [(r0, c0, (1 - fr) * (1 - fc)),
+                   (r0 + 1, c0, fr * (1 - fc)),
+                   (r0, c0 + 1, (1 - fr) * fc),
+                   (r0 + 1, c0 + 1, fr * fc)]
+
+    points = []
+    for r, c, weight in corners:
+        outside = None
+        if fill_mode == 'constant':
+            outside = (r < 0) | (r > h - 1) | (c < 0) | (c > w - 1)
+        points.append((fill_indices(r, h, fill_mode),
+                       fill_indices(c, w, fill_mode), weight, outside))
+    return points
+
+
+def _union(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a | b
+
+
+def compose_matrix(h, w, window=(0, 0), matrix=None, horizontal_flip=False,
+                   vertical_flip=False):
+    """Compose the window offset, the flips and the affine transform of an
+    h x w image into one matrix mapping the [row, col, 1] points of the
+    output to the source points.
+    # Arguments
+        h, w: Size of the image.
+        window: (top, left, ...) of the output window in the augmented
+            image (negative when the image is padded).
+        matrix: Affine matrix mapping output to input points, or None.
+        horizontal_flip, vertical_flip: Whether the image is flipped.
+    """
+    composed = np.array([[1., 0., window[0]],
+                         [0., 1., window[1]],
+                         [0., 0., 1.]])
+    if horizontal_flip or vertical_flip:
+        flip = np.eye(3)
+        if vertical_flip:
+            flip[0, 0], flip[0, 2] = -1, h - 1
+        if horizontal_flip:
+            flip[1, 1], flip[1, 2] = -1, w - 1
+        composed = np.dot(flip, composed)
+    if matrix is not None:
+        composed = np.dot(matrix, composed)
+    return composed
+
+
+def transform_box_points(b, matrix):
+    """Transform boxes [x1, y1, x2, y2] (pixel edges) with a matrix mapping
+    source to output [row, col, 1] pixel points, and return the boxes
+    enclosing the transformed corners.
+    """
+    # Pixel edges to pixel centers
+    b = b - 0.5
+    corners = np.ones((b.shape[0], 4, 3))
+    corners[:, :, 0] = b[:, [1, 3, 3, 1]]
+    corners[:, :, 1] = b[:, [0, 2, 0, 2]]
+    points = np.dot(corners.reshape(-1, 3), matrix[:2].T).reshape(-1, 4, 2)
+
+    b = np.empty_like(b)
+    b[:, 0] = points[:, :, 1].min(axis=1)
+    b[:, 1] = points[:, :, 0].min(axis=1)
+    b[:, 2] = points[:, :, 1].max(axis=1)
+    b[:, 3] = points[:, :, 0].max(axis=1)
+    return b + 0.5
+
+
+# Crop of a flipped image: the flipped crop of the mirrored window
+def _flip_crop(x, y, row_index, col_index, channel_index, window,
+               horizontal_flip, vertical_flip, channel_shifts, standardize):
+    h, w = x.shape[row_index], x.shape[col_index]
+    top, left, crop_h, crop_w = window
+    if vertical_flip:
+        top = h - top - crop_h
+    if horizontal_flip:
+        left = w - left - crop_w
+
+    index = [slice(None)] * 3
+    index[row_index] = slice(top, top + crop_h)
+    index[col_index] = slice(left, left + crop_w)
+    index = tuple(index)
+    x_crop = np.array(x[index])
+    if standardize is not None:
+        x_crop = standardize(x_crop)
+    if channel_shifts is not None:
+        x_crop = np.rollaxis(x_crop, channel_index, 3)
+        x_crop = cast_image(np.clip(x_crop + channel_shifts, np.min(x_crop),
+                                    np.max(x_crop)), x.dtype)
+        x_crop = np.rollaxis(x_crop, 2, channel_index)
+    y_crop = y[index] if y is not None else None
+
+    flip = [slice(None)] * 3
+    if vertical_flip:
+        flip[row_index] = slice(None, None, -1)
+    if horizontal_flip:
+        flip[col_index] = slice(None, None, -1)
+    flip = tuple(flip)
+    return x_crop[flip], y_crop[flip] if y_crop is not None else None
+
+
+def resample_transform(x, y, channel_index, window, matrix=None,
+                       horizontal_flip=False, vertical_flip=False,
+                       warp_coords=None, channel_shifts=None,
+                       fill_mode='nearest', cval=0., y_cval=0., pad_cval=0.,
+                       standardize=None):
+    """Augment an image and its GT image in one resampling pass.
+    The result is the one of the chain: affine transform (nearest
+    neighbour), channel shift, flips, elastic warp and crop or pad, except
+    that the channel shift is clipped to the range of the source region
+    instead of the range of the whole image. Integer images (uint8) stay
+    integer: the warp and the channel shift are rounded.
+    # Arguments
+        x: Image.
+        y: GT image or None.
+        channel_index: Channel axis of x and y.
+        window: (top, left, rows, cols) of the output in the augmented
+            image. It may go out of the image, which pads it.
+        matrix: Affine matrix mapping output to input [row, col, 1] points,
+            or None.
+        horizontal_flip, vertical_flip: Whether the image is flipped.
+        warp_coords: (2, rows, cols) source coordinates of the elastic warp
+            of the whole image, or None.
+        channel_shifts: Intensity added to each channel, or None.
+        fill_mode: 'constant', 'nearest' or 'reflect'.
+        cval: Value of the image outside the boundaries ('constant').
+        y_cval: Value of the GT image outside the boundaries ('constant')
+            and of its padding.
+        pad_cval: Value of the padding of the image.
+        standardize: Function standardizing the source region, or None.
+    # Return
+        x, y: The augmented images
+    """
+    row_index, col_index = [i for i in range(3) if i != channel_index]
+    h, w = x.shape[row_index], x.shape[col_index]
+    top, left, out_h, out_w = window
+    padded = top < 0 or left < 0 or top + out_h > h or left + out_w > w
+    if matrix is None and warp_coords is None and not padded:
+        return _flip_crop(x, y, row_index, col_index, channel_index, window,
+                          horizontal_flip, vertical_flip, channel_shifts,
+                          standardize)
+
+    # Points of the window out of the image (padding)
+    pad = None
+    if padded:
+        rows, cols = np.mgrid[top:top + out_h, left:left + out_w]
+        pad = (rows < 0) | (rows > h - 1) | (cols < 0) | (cols > w - 1)
+
+    if warp_coords is not None:
+        # Points of the image before the warp read by the window. The
+        # matrix maps them to the source
+        rows, cols = np.mgrid[top:top + out_h, left:left + out_w]
+        coords = warp_coords[:, np.clip(rows, 0, h - 1), np.clip(cols, 0, w - 1)]
+        composed = compose_matrix(h, w, (0, 0), matrix, horizontal_flip,
+                                  vertical_flip)
+        if matrix is None:
+            # The flips are applied to the coordinates of the warp, which
+            # then reads the source directly
+            coords = np.stack((composed[0, 0] * coords[0] + composed[0, 2],
+                               composed[1, 1] * coords[1] + composed[1, 2]))
+            composed = None
+        x_points = warp_points(coords, h, w, fill_mode)
+        y_points = warp_points(coords, h, w, fill_mode, nearest=True)
+    else:
+        # The matrix maps the output pixels straight to the source
+        rows, cols = np.ogrid[0:out_h, 0:out_w]
+        x_points = [(rows, cols, None, None)]
+        y_points = x_points
+        composed = compose_matrix(h, w, window, matrix, horizontal_flip,
+                                  vertical_flip)
+
+    # Without an affine transform every point is inside the image (or in
+    # the padding, clipped and overwritten)
+    source_fill_mode = fill_mode if matrix is not None else 'nearest'
+    if composed is None:
+        x_sources = [(r, c, None) for r, c, _, _ in x_points]
+    else:
+        x_sources = [affine_source(r, c, composed, h, w, source_fill_mode)
+                     for r, c, _, _ in x_points]
+
+    # Standardize the source region only
+    r_min = min(np.min(r) for r, _, _ in x_sources)
+    r_max = max(np.max(r) for r, _, _ in x_sources)
+    c_min = min(np.min(c) for _, c, _ in x_sources)
+    c_max = max(np.max(c) for _, c, _ in x_sources)
+    index = [slice(None)] * 3
+    index[row_index] = slice(r_min, r_max + 1)
+    index[col_index] = slice(c_min, c_max + 1)
+    region = np.array(x[tuple(index)])
+    if standardize is not None:
+        region = standardize(region)
+    region = np.ascontiguousarray(np.rollaxis(region, channel_index, 3))
+    region_w = region.shape[1]
+    region = region.reshape((-1, region.shape[2]))
+
+    # Values of the source pixels (one gather of flat indices per point
+    # set), after the channel shift
+    values = []
+    for r, c, outside in x_sources:
+        v = region.take((r - r_min) * region_w + (c - c_min), axis=0)
+        if outside is not None:
+            v[outside] = cval
+        values.append(v)
+    if channel_shifts is not None:
+        min_x = min(np.min(v) for v in values)
+        max_x = max(np.max(v) for v in values)
+        values = [np.clip(v + channel_shifts, min_x, max_x) for v in values]
+
+    # Warp (bilinear) or copy the values of the output
+    x_out = None
+    for (_, _, weight, outside), v in zip(x_points, values):
+        if outside is not None:
+            v[outside] = cval
+        if weight is not None:
+            v = weight * v
+        x_out = v if x_out is None else x_out + v
+    if pad is not None:
+        x_out[pad] = pad_cval
+    x_out = np.rollaxis(cast_image(x_out, x.dtype), 2, channel_index)
+
+    # GT image, nearest neighbour (from the same source points as the
+    # image without the warp)
+    if y is not None:
+        r, c, _, warp_outside = y_points[0]
+        if y_points is x_points:
+            r, c, affine_outside = x_sources[0]
+        elif composed is None:
+            affine_outside = None
+        else:
+            r, c, affine_outside = affine_source(r, c, composed, h, w,
+                                                 source_fill_mode)
+        y_cl = np.rollaxis(y, channel_index, 3)
+        y_out = y_cl.reshape((-1, y_cl.shape[2])).take(r * w + c, axis=0)
+        outside = _union(_union(warp_outside, affine_outside), pad)
+        if outside is not None:
+            y_out[outside] = y_cval
+        y = np.rollaxis(y_out, 2, channel_index)
+
+    return x_out, y
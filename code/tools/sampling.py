@@ -0,0 +1,107 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import threading
+import time
+
+import numpy as np
+
+"""
+    Read order of the samples of an epoch. A global permutation reads the
+    files of a dataset in random disk order, which is slow on spinning
+    disks and network shares. The block shuffling permutes blocks of
+    contiguous files (in the sorted order of the directory, or of the
+    shards) and mixes the samples of consecutive blocks with a shuffle
+    buffer, so the files are read almost sequentially.
+"""
+
+
+def block_permutation(n, block_size, buffer_size=0):
+    """Permutation of range(n) reading blocks of contiguous samples in
+    random order, mixed by a shuffle buffer. Uses the numpy RNG.
+    # Arguments
+        n: Number of samples.
+        block_size: Contiguous samples of a block.
+        buffer_size: Samples of the shuffle buffer (0: the samples of a
+            block are read in order). Every position of the epoch takes a
+            random sample of the buffer, replaced by the next one of the
+            blocks.
+    """
+    starts = np.random.permutation(np.arange(0, n, block_size))
+    order = (starts[:, np.newaxis] + np.arange(block_size)).ravel()
+    order = order[order < n]
+    if buffer_size <= 1:
+        return order
+    if buffer_size >= n:
+        return np.random.permutation(order)
+
+    out = np.empty_like(order)
+    buffer = order[:buffer_size].copy()
+    picks = np.random.randint(buffer_size, size=n - buffer_size)
+    for i, k in enumerate(picks):
+        out[i] = buffer[k]
+        buffer[k] = order[buffer_size + i]
+    out[n - buffer_size:] = np.random.permutation(buffer)
+    return out
+
+
+class ReadStats(object):
+    """Time and bytes of the samples read from disk, per epoch. The thread
+    building a batch counts its reads (start, count, stop) and the iterator
+    adds them to the epoch the batch was drawn from. The worker processes
+    send their counts back with the samples, so all the epochs are summed in
+    the main process. An epoch is complete once its last batch is drawn and
+    the reads of all its batches are added.
+    """
+
+    def __init__(self):
+        # Epoch: [[samples, bytes, seconds], time of the first batch, batches
+        # in flight, whether its last batch is drawn]
+        self.epochs = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def draw(self, epoch, last):
+        # A batch of the epoch is drawn
+        with self.lock:
+            if epoch not in self.epochs:
+                self.epochs[epoch] = [np.zeros(3), time.time(), 0, False]
+            self.epochs[epoch][2] += 1
+            self.epochs[epoch][3] |= last
+
+    def start(self):
+        # Count the reads of the calling thread
+        self.local.counts = np.zeros(3)
+
+    def count(self, nbytes, seconds):
+        counts = getattr(self.local, 'counts', None)
+        if counts is not None:
+            counts += (1, nbytes, seconds)
+
+    def stop(self):
+        # Reads of the calling thread since start
+        counts = self.local.counts
+        self.local.counts = None
+        return counts
+
+    def add(self, epoch, counts=None):
+        """Add the reads of a batch (None for a batch dropped unfinished).
+        # Return
+            The summary of the epoch if it is complete, else None
+        """
+        with self.lock:
+            stats = self.epochs[epoch]
+            if counts is not None:
+                stats[0] += counts
+            stats[2] -= 1
+            if stats[2] > 0 or not stats[3]:
+                return None
+            del self.epochs[epoch]
+
+        nb_sample, nbytes, seconds = stats[0]
+        elapsed = max(time.time() - stats[1], 1e-6)
+        return ('{:.0f} samples, {:.1f} MB read in {:.1f} s ({:.1f} ms per '
+                'sample, {:.1f} MB/s over the epoch)'.format(
+                    nb_sample, nbytes / 2. ** 20, seconds,
+                    1000. * seconds / max(nb_sample, 1),
+                    nbytes / 2. ** 20 / elapsed))
@@ -0,0 +1,177 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+
+import numpy as np
+
+"""
+    Packed dataset shards.
+    A split is stored in a directory with:
+        - images_XXXXX.u8: uint8 images of shape (n, rows, cols, channels)
+        - masks_XXXXX.u8: uint8 masks of shape (n, rows, cols)
+          (segmentation only)
+        - boxes.f32: float32 table of shape (n_boxes, 5) with the
+          [class, x, y, w, h] rows of every image (detection only)
+        - index.npz: names, shard and offset of every sample, class labels,
+          offsets of the boxes of each image and the metadata
+    The images are read with np.memmap, so a sample is a view on the file.
+"""
+
+
+class ShardWriter(object):
+    """Writes the samples of a dataset split into packed shards.
+    # Arguments
+        shard_dir: Output directory.
+        image_shape: Shape (rows, cols, channels) of every image.
+        class_mode: 'categorical', 'detection' or 'segmentation'.
+        color_mode: Color mode of the images ('rgb' or 'grayscale').
+        samples_per_shard: Number of images in each shard file.
+    """
+
+    def __init__(self, shard_dir, image_shape, class_mode, color_mode='rgb',
+                 samples_per_shard=1024):
+        self.shard_dir = shard_dir
+        self.image_shape = tuple(image_shape)
+        self.class_mode = class_mode
+        self.color_mode = color_mode
+        self.samples_per_shard = samples_per_shard
+
+        self.names = []
+        self.labels = []
+        self.box_counts = []
+        self.image_file = None
+        self.mask_file = None
+
+        if not os.path.exists(shard_dir):
+            os.makedirs(shard_dir)
+        self.box_file = open(os.path.join(shard_dir, 'boxes.f32'), 'wb')
+
+    def add(self, name, img, label=-1, mask=None, boxes=None):
+        # Start a new shard when the current one is full
+        if len(self.names) % self.samples_per_shard == 0:
+            self._close_shard()
+            shard = len(self.names) // self.samples_per_shard
+            self.image_file = open(shard_path(self.shard_dir, 'images', shard), 'wb')
+            if self.class_mode == 'segmentation':
+                self.mask_file = open(shard_path(self.shard_dir, 'masks', shard), 'wb')
+
+        if img.shape != self.image_shape:
+            raise ValueError('Image {} has shape {}, expected {}'.format(
+                name, img.shape, self.image_shape))
+        self.image_file.write(np.ascontiguousarray(img, dtype=np.uint8).tobytes())
+
+        if self.class_mode == 'segmentation':
+            if mask.shape != self.image_shape[:2]:
+                raise ValueError('Mask {} has shape {}, expected {}'.format(
+                    name, mask.shape, self.image_shape[:2]))
+            self.mask_file.write(np.ascontiguousarray(mask, dtype=np.uint8).tobytes())
+
+        n_boxes = 0
+        if boxes is not None:
+            boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 5)
+            self.box_file.write(boxes.tobytes())
+            n_boxes = boxes.shape[0]
+
+        self.names.append(name)
+        self.labels.append(label)
+        self.box_counts.append(n_boxes)
+
+    def _close_shard(self):
+        if self.image_file is not None:
+            self.image_file.close()
+        if self.mask_file is not None:
+            self.mask_file.close()
+
+    def close(self, class_names):
+        self._close_shard()
+        self.box_file.close()
+
+        n = len(self.names)
+        box_counts = np.array(self.box_counts, dtype=np.int32)
+        box_starts = np.zeros(n, dtype=np.int64)
+        box_starts[1:] = np.cumsum(box_counts)[:-1]
+        np.savez(os.path.join(self.shard_dir, 'index.npz'),
+                 names=np.array(self.names),
+                 shard=np.arange(n, dtype=np.int32) // self.samples_per_shard,
+                 offset=np.arange(n, dtype=np.int32) % self.samples_per_shard,
+                 labels=np.array(self.labels, dtype=np.int32),
+                 box_starts=box_starts,
+                 box_counts=box_counts,
+                 image_shape=np.array(self.image_shape, dtype=np.int32),
+                 class_mode=np.array(self.class_mode),
+                 color_mode=np.array(self.color_mode),
+                 class_names=np.array([str(c) for c in class_names]),
+                 samples_per_shard=np.array(self.samples_per_shard))
+        print('   Wrote {} images in {} shards to {}'.format(
+            n, int(np.ceil(n / float(self.samples_per_shard))), self.shard_dir))
+
+
+class ShardReader(object):
+    """Reads the samples of a dataset split stored as packed shards.
+    The shard files are memory mapped on first use.
+    # Arguments
+        shard_dir: Directory written by ShardWriter.
+    """
+
+    def __init__(self, shard_dir):
+        index_path = os.path.join(shard_dir, 'index.npz')
+        if not os.path.isfile(index_path):
+            raise ValueError('Shard index not found: ' + index_path)
+        self.shard_dir = shard_dir
+
+        index = np.load(index_path)
+        self.names = index['names']
+        self.shard = index['shard']
+        self.offset = index['offset']
+        self.labels = index['labels']
+        self.box_starts = index['box_starts']
+        self.box_counts = index['box_counts']
+        self.image_shape = tuple(int(s) for s in index['image_shape'])
+        self.class_mode = str(index['class_mode'])
+        self.color_mode = str(index['color_mode'])
+        self.class_names = [str(c) for c in index['class_names']]
+        self.samples_per_shard = int(index['samples_per_shard'])
+
+        self.images = {}
+        self.masks = {}
+        self.boxes = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def _map(self, kind, shard, shape):
+        path = shard_path(self.shard_dir, kind, shard)
+        n = os.path.getsize(path) // int(np.prod(shape))
+        return np.memmap(path, dtype=np.uint8, mode='r', shape=(n,) + shape)
+
+    def image(self, j):
+        shard = self.shard[j]
+        if shard not in self.images:
+            self.images[shard] = self._map('images', shard, self.image_shape)
+        return self.images[shard][self.offset[j]]
+
+    def mask(self, j):
+        shard = self.shard[j]
+        if shard not in self.masks:
+            self.masks[shard] = self._map('masks', shard, self.image_shape[:2])
+        return self.masks[shard][self.offset[j]]
+
+    def box_table(self):
+        # [class, x, y, w, h] rows of all the images
+        if self.boxes is None:
+            path = os.path.join(self.shard_dir, 'boxes.f32')
+            if os.path.getsize(path) == 0:
+                self.boxes = np.zeros((0, 5), dtype=np.float32)
+            else:
+                self.boxes = np.memmap(path, dtype=np.float32,
+                                       mode='r').reshape(-1, 5)
+        return self.boxes
+
+    def image_boxes(self, j):
+        start = self.box_starts[j]
+        return self.box_table()[start:start + self.box_counts[j]]
+
+
+def shard_path(shard_dir, kind, shard):
+    return os.path.join(shard_dir, '{}_{:05d}.u8'.format(kind, shard))
@@ -74,30 +74,120 @@ class BBoxUtility(object):
                                                 iou_threshold=self._nms_thresh)
 
     def ssd_build_gt_batch(self, batch_gt, image_shape):
+        """MultiboxLoss targets of a batch.
+        # Arguments
+            batch_gt: GT boxes ([class, xcenter, ycenter, width, height]
+                rows, relative to the image) of each image.
+            image_shape: Shape of the images (unused, the boxes are
+                relative).
+        # Return
+            Float32 tensor of shape (batch_size, num_priors,
+            4 + num_classes + 8), see assign_batch
+        """
+        # Convert the boxes to the format required by assign_batch:
+        # [xmin, ymin, xmax, ymax] and the class one-hot, without background
+        batch_boxes = []
+        for gt in batch_gt:
+            gt = np.asarray(gt, dtype=np.float64).reshape(-1, 5)
+            half_wh = gt[:, 3:5] / 2
+            boxes = np.zeros((len(gt), 4 + self.num_classes - 1))
+            boxes[:, 0:2] = gt[:, 1:3] - half_wh
+            boxes[:, 2:4] = gt[:, 1:3] + half_wh
+            boxes[np.arange(len(gt)), 4 + gt[:, 0].astype(np.int64)] = 1.
+            batch_boxes.append(boxes)
+
+        return self.assign_batch(batch_boxes)
+
+    def iou_matrix(self, boxes):
+        """Intersection over union of boxes with all priors.
+        # Arguments
+            boxes: Boxes, numpy tensor of shape (..., 4).
+        # Return
+            iou: Intersection over union,
+                numpy tensor of shape (..., num_priors).
+        """
+        # One array per coordinate, so the broadcast operations run on
+        # contiguous memory
+        xmin, ymin, xmax, ymax = (boxes[..., k, np.newaxis] for k in range(4))
+        prior_xmin, prior_ymin, prior_xmax, prior_ymax = (
+            np.ascontiguousarray(self.priors[:, k]) for k in range(4))
+        # compute intersection
+        inter = np.minimum(prior_xmax, xmax) - np.maximum(prior_xmin, xmin)
+        np.maximum(inter, 0, out=inter)
+        inter_h = np.minimum(prior_ymax, ymax) - np.maximum(prior_ymin, ymin)
+        np.maximum(inter_h, 0, out=inter_h)
+        inter *= inter_h
+        # compute union
+        area_pred = (xmax - xmin) * (ymax - ymin)
+        area_gt = (prior_xmax - prior_xmin) * (prior_ymax - prior_ymin)
+        union = area_pred + area_gt - inter
+        # compute iou
+        return inter / union
+
+    def assign_batch(self, batch_boxes):
+        """Assign the boxes of a batch of images to priors for training,
+        with one (num_images, max_boxes, num_priors) IoU tensor. Every box
+        is assigned to the priors it overlaps by more than
+        overlap_threshold (or to its best prior) and every prior keeps the
+        assigned box of highest IoU.
+        # Arguments
+            batch_boxes: Boxes of each image, numpy tensors of shape
+                (num_boxes, 4 + num_classes), num_classes without
+                background.
+        # Return
+            assignment: Float32 tensor of shape
+                (num_images, num_priors, 4 + num_classes + 8), as
+                assign_boxes.
+        """
+        batch_size = len(batch_boxes)
+        assignment = np.zeros((batch_size, self.num_priors,
+                               4 + self.num_classes + 8), dtype=np.float32)
+        assignment[:, :, 4] = 1.0
+        counts = [len(boxes) for boxes in batch_boxes]
+        max_boxes = max(counts) if counts else 0
+        if max_boxes == 0:
+            return assignment
 
-        # First convert batch_gt to the format required by assign_boxes
-        # boxes: Box, numpy tensor of shape (num_boxes, 4 + num_classes), num_classes without background
-
-        targets = []
-
-        for i, gt in enumerate(batch_gt):
-            n_boxes = gt.shape[0]
-            boxes = np.zeros((n_boxes, 4 + self.num_classes - 1))  # -1 to not count background
-            for j, box in enumerate(gt):
-                coords = box[1:]  # [xcenter, ycenter, width, height]
-                # the code expects [xmin, ymin, xmax, ymax]
-                coords[0] = box[1] - box[3] / 2
-                coords[1] = box[2] - box[4] / 2
-                coords[2] = box[1] + box[3] / 2
-                coords[3] = box[2] + box[4] / 2
-                boxes[j, 0:4] = coords
-                one_hot = np.zeros(self.num_classes - 1)  # -1 to not count background
-                one_hot[int(box[0])] = 1.
-                boxes[j, 4:] = one_hot
-            y = self.assign_boxes(boxes)
-            targets.append(y)
-
-        return np.array(targets)
+        # Boxes padded to the same number per image
+        padded = np.zeros((batch_size, max_boxes, 4 + self.num_classes - 1))
+        valid = np.zeros((batch_size, max_boxes), dtype=bool)
+        for i, boxes in enumerate(batch_boxes):
+            padded[i, :counts[i]] = boxes
+            valid[i, :counts[i]] = True
+
+        # Priors assigned to every box: the ones over the threshold, or the
+        # best one. Every prior keeps its assigned box of highest IoU
+        iou = self.iou_matrix(padded[:, :, :4])
+        iou[~valid] = 0
+        assign_mask = iou > self.overlap_threshold
+        no_match = ~assign_mask.any(axis=2) & valid
+        images, boxes_idx = np.nonzero(no_match)
+        assign_mask[images, boxes_idx, iou[images, boxes_idx].argmax(axis=1)] = True
+        assigned_iou = np.where(assign_mask, iou, 0)
+        best_iou_idx = assigned_iou.argmax(axis=1)
+        images, priors_idx = np.nonzero(assigned_iou.max(axis=1) > 0)
+        best_boxes = padded[images, best_iou_idx[images, priors_idx]]
+
+        # Encode the offsets of the matched priors only, with the variance
+        assigned_priors = self.priors[priors_idx]
+        box_center = 0.5 * (best_boxes[:, :2] + best_boxes[:, 2:4])
+        box_wh = best_boxes[:, 2:4] - best_boxes[:, :2]
+        assigned_priors_center = 0.5 * (assigned_priors[:, :2] +
+                                        assigned_priors[:, 2:4])
+        assigned_priors_wh = (assigned_priors[:, 2:4] -
+                              assigned_priors[:, :2])
+        encoded = np.empty((len(priors_idx), 4))
+        encoded[:, :2] = box_center - assigned_priors_center
+        encoded[:, :2] /= assigned_priors_wh
+        encoded[:, :2] /= assigned_priors[:, -4:-2]
+        encoded[:, 2:4] = np.log(box_wh / assigned_priors_wh)
+        encoded[:, 2:4] /= assigned_priors[:, -2:]
+
+        assignment[images, priors_idx, :4] = encoded
+        assignment[images, priors_idx, 4] = 0
+        assignment[images, priors_idx, 5:-8] = best_boxes[:, 4:]
+        assignment[images, priors_idx, -8] = 1
+        return assignment
 
     def iou(self, box):
         """Compute intersection over union for the box with all priors.
@@ -168,26 +258,7 @@ class BBoxUtility(object):
                     or in other words is assigned to some ground truth box,
                 assignment[:, -7:] are all 0. See loss for more details.
         """
-        assignment = np.zeros((self.num_priors, 4 + self.num_classes + 8))
-        assignment[:, 4] = 1.0
-        if len(boxes) == 0:
-            return assignment
-
-        encoded_boxes = np.apply_along_axis(self.encode_box, 1, boxes[:, :4])
-        encoded_boxes = encoded_boxes.reshape(-1, self.num_priors, 5)
-        best_iou = encoded_boxes[:, :, -1].max(axis=0)
-        best_iou_idx = encoded_boxes[:, :, -1].argmax(axis=0)
-        best_iou_mask = best_iou > 0
-        best_iou_idx = best_iou_idx[best_iou_mask]
-        assign_num = len(best_iou_idx)
-        encoded_boxes = encoded_boxes[:, best_iou_mask, :]
-        assignment[:, :4][best_iou_mask] = encoded_boxes[best_iou_idx,
-                                           np.arange(assign_num),
-                                           :4]
-        assignment[:, 4][best_iou_mask] = 0
-        assignment[:, 5:-8][best_iou_mask] = boxes[best_iou_idx, 4:]
-        assignment[:, -8][best_iou_mask] = 1
-        return assignment
+        return self.assign_batch([boxes])[0]
 
     def decode_boxes(self, mbox_loc, mbox_priorbox, variances):
         """Convert bboxes from local predictions to shifted priors.
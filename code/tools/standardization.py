@@ -0,0 +1,131 @@
+from __future__ import absolute_import
+
+import warnings
+
+import numpy as np
+
+"""
+    Standardization of the batches of the ImageDataGenerator, compiled once
+    from its settings:
+        - rescale, featurewise center and std normalization (or the ImageNet
+          mean subtraction) are folded into one per channel scale and offset,
+          applied in place with two passes over the batch
+        - the ImageNet RGB->BGR swap is a channel permutation
+        - the data dependent steps (GCN, samplewise center and std
+          normalization, ZCA whitening) are vectorized over the batch
+"""
+
+IMAGENET_BGR_MEAN = (103.939, 116.779, 123.68)
+
+
+def masked_gcn(batch_x, mask, channel_index, eps=1e-8):
+    """Global contrast normalization of the valid pixels of each image, in
+    place. The void pixels are set to 0.
+    # Arguments
+        batch_x: Batch of images (float).
+        mask: Batch of masks (1 where valid, 0 where void), with one channel.
+        channel_index: Index of the channel axis in the batch.
+        eps: Minimum std.
+    """
+    axes = tuple(range(1, batch_x.ndim))
+    n_channels = batch_x.shape[channel_index]
+    count = np.maximum(np.sum(mask, axis=axes, keepdims=True) * n_channels, 1)
+
+    # Mean and std of the valid pixels of every image (all channels)
+    mean = np.sum(batch_x * mask, axis=axes, keepdims=True) / count
+    batch_x -= mean
+    var = np.sum(np.square(batch_x) * mask, axis=axes, keepdims=True) / count
+    batch_x /= np.maximum(np.sqrt(var), eps)
+    batch_x *= mask
+    return batch_x
+
+
+class Standardization(object):
+    """Standardization compiled from the settings of an ImageDataGenerator.
+    # Arguments
+        channel_index: Index of the channel axis of a batch.
+        ndim: Number of dimensions of a batch.
+        scale, offset: Per channel scale and offset (arrays broadcastable to
+            an image, or scalars), applied as x * scale + offset.
+        permutation: Order of the channels or None.
+        pre_scale: Scale applied before the data dependent steps or None.
+        gcn: Whether to apply the masked global contrast normalization.
+        void_label: Void label of the masks (GCN).
+        samplewise_center, samplewise_std_normalization: Per pixel
+            normalization across the channels.
+        principal_components: ZCA whitening matrix or None.
+        not_fitted: Settings skipped because the generator was not fitted.
+        dtype: Data type of the scale and offset.
+    """
+
+    def __init__(self, channel_index, ndim=4, scale=1., offset=0.,
+                 permutation=None, pre_scale=None, gcn=False, void_label=None,
+                 samplewise_center=False, samplewise_std_normalization=False,
+                 principal_components=None, not_fitted=(), dtype=np.float32):
+        self.channel_index = channel_index
+        self.permutation = (None if permutation is None
+                            else np.asarray(permutation))
+        self.pre_scale = pre_scale
+        self.gcn = gcn
+        self.void_label = void_label
+        self.samplewise_center = samplewise_center
+        self.samplewise_std_normalization = samplewise_std_normalization
+        self.principal_components = principal_components
+        self.not_fitted = list(not_fitted)
+
+        # Broadcast the per image scale and offset to a batch
+        scale = np.asarray(scale, dtype=dtype)
+        offset = np.asarray(offset, dtype=dtype)
+        self.scale = None if np.all(scale == 1) else self._batch_shape(scale, ndim)
+        self.offset = None if np.all(offset == 0) else self._batch_shape(offset, ndim)
+
+    @staticmethod
+    def _batch_shape(a, ndim):
+        if a.ndim == 0:
+            return a
+        return a.reshape((1,) * (ndim - a.ndim) + a.shape)
+
+    def apply(self, batch_x, batch_y=None):
+        """Standardize a batch in place (when it is a float array).
+        # Arguments
+            batch_x: Batch of images.
+            batch_y: Batch of GT images (GCN only).
+        # Return
+            The standardized batch
+        """
+        for setting in self.not_fitted:
+            warnings.warn('This ImageDataGenerator specifies '
+                          '`{}`, but it hasn\'t '
+                          'been fit on any training data. Fit it '
+                          'first by calling `.fit(numpy_data)`.'.format(setting))
+
+        if self.permutation is not None:
+            batch_x[...] = np.take(batch_x, self.permutation,
+                                   axis=self.channel_index)
+
+        if self.pre_scale is not None:
+            batch_x *= self.pre_scale
+
+        if self.gcn:
+            if batch_y is None:
+                raise ValueError('GCN needs the GT images of the batch')
+            mask = (batch_y != self.void_label).astype(batch_x.dtype)
+            masked_gcn(batch_x, mask, self.channel_index)
+
+        if self.samplewise_center:
+            batch_x -= np.mean(batch_x, axis=self.channel_index, keepdims=True)
+        if self.samplewise_std_normalization:
+            batch_x /= (np.std(batch_x, axis=self.channel_index,
+                               keepdims=True) + 1e-7)
+
+        # Fused per channel scale and offset
+        if self.scale is not None:
+            batch_x *= self.scale
+        if self.offset is not None:
+            batch_x += self.offset
+
+        if self.principal_components is not None:
+            flat_x = np.reshape(batch_x, (batch_x.shape[0], -1))
+            batch_x[...] = np.reshape(np.dot(flat_x, self.principal_components),
+                                      batch_x.shape)
+        return batch_x
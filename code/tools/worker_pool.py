@@ -0,0 +1,147 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import itertools
+import multiprocessing
+from collections import deque
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+
+"""
+    Multi-process batch assembly for the DirectoryIterator.
+    The worker processes are forked, so they inherit the registry below and
+    reach the iterators (and their shared buffers) without pickling them.
+    The sample j is always built by the worker j % nb_worker, so the files
+    cached (or held for their echoes) by a worker are the ones it reads
+    again.
+"""
+
+_registry = {}
+_tokens = itertools.count()
+
+# The registry only reaches the workers if they are forked
+try:
+    _context = multiprocessing.get_context('fork')
+except AttributeError:
+    # Python 2 always forks
+    _context = multiprocessing
+
+
+# Allocate a numpy array on shared memory
+def shared_array(shape, dtype=np.float32):
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    raw = RawArray('b', size * dtype.itemsize)
+    return np.frombuffer(raw, dtype=dtype, count=size).reshape(shape)
+
+
+# Prepare a worker process
+def _init_worker(token, worker):
+    pool = _registry[token]
+    pool.iterator.init_worker(worker, pool.nb_worker)
+
+
+# Build one sample inside a worker process
+def _fill_sample(task):
+    token, slot, i, j, seed = task
+    pool = _registry[token]
+    read_stats = pool.iterator.read_stats
+    read_stats.start()
+    x, y = pool.iterator.build_sample(j, seed)
+    reads = read_stats.stop()
+
+    # Images (and GT images) go to the shared buffers, boxes and the read
+    # counts go back by pipe
+    pool.batch_x[slot, i] = x
+    if pool.batch_y is not None:
+        pool.batch_y[slot, i] = y
+        return None, reads
+    return y, reads
+
+
+class SharedBatchPool(object):
+    """Builds the batches of an iterator in a pool of worker processes.
+    Each worker writes its samples directly into a slot of preallocated
+    shared-memory batch arrays, so only the indices and seeds are sent to
+    the workers.
+    # Arguments
+        iterator: DirectoryIterator providing build_sample(j, seed).
+        nb_worker: Number of worker processes.
+        prefetch: Number of batches in flight (one buffer slot each).
+    The shared buffers have the data type of the samples
+    (iterator.sample_dtype), so uint8 samples are only converted once
+    copied out.
+    """
+
+    def __init__(self, iterator, nb_worker, prefetch=2):
+        self.iterator = iterator
+        self.nb_worker = nb_worker
+        self.prefetch = max(1, prefetch)
+
+        # Allocate the shared buffers before forking the workers
+        batch_size = iterator.batch_size
+        self.batch_x = shared_array((self.prefetch, batch_size) +
+                                    iterator.image_shape, iterator.sample_dtype)
+        if iterator.has_gt_image:
+            self.batch_y = shared_array((self.prefetch, batch_size) +
+                                        iterator.gt_image_shape,
+                                        iterator.sample_dtype)
+        else:
+            self.batch_y = None
+
+        self.free_slots = deque(range(self.prefetch))
+        self.pending = deque()
+
+        # One single process pool per worker, so the samples are routed
+        self.token = next(_tokens)
+        _registry[self.token] = self
+        self.pools = [_context.Pool(1, initializer=_init_worker,
+                                    initargs=(self.token, worker))
+                      for worker in range(nb_worker)]
+        print('   Loading batches with {} worker processes (prefetch {})'.format(
+            nb_worker, self.prefetch))
+
+    def full(self):
+        return not self.free_slots
+
+    def submit(self, index_array, current_index, epoch, seeds):
+        slot = self.free_slots.popleft()
+        results = [self.pools[j % self.nb_worker].apply_async(
+                       _fill_sample, ((self.token, slot, i, j, seed),))
+                   for i, (j, seed) in enumerate(zip(index_array, seeds))]
+        self.pending.append((slot, index_array, current_index, epoch, results))
+
+    def get(self, new_batch):
+        """Wait for the oldest batch and release its slot. The batch is
+        copied out, to the arrays new_batch(n) returns, because the slot is
+        refilled while the model consumes it.
+        # Return
+            index_array, current_index, epoch, batch_x, batch_y and the
+            read counts of the samples (see ReadStats)
+        """
+        slot, index_array, current_index, epoch, results = self.pending.popleft()
+        try:
+            ys, reads = zip(*[result.get() for result in results])
+            n = len(index_array)
+            batch_x, batch_y = new_batch(n)
+            batch_x[...] = self.batch_x[slot, :n]
+            if self.batch_y is not None:
+                batch_y[...] = self.batch_y[slot, :n]
+            else:
+                batch_y = list(ys)
+        finally:
+            self.free_slots.append(slot)
+        return (index_array, current_index, epoch, batch_x, batch_y,
+                np.sum(reads, axis=0))
+
+    def pending_epochs(self):
+        # Epochs of the batches in flight
+        return [epoch for _, _, _, epoch, _ in self.pending]
+
+    def close(self):
+        for pool in self.pools:
+            pool.terminate()
+        for pool in self.pools:
+            pool.join()
+        _registry.pop(self.token, None)
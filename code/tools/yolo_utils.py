@@ -11,58 +11,68 @@ import numpy as np
 
 
 def yolo_build_gt_batch(batch_gt, image_shape, num_classes, num_priors=5):
-    h = image_shape[1] / 32
-    w = image_shape[2] / 32
+    """YOLOLoss targets of a batch, of shape (batch_size, h * w, num_priors,
+    num_classes + 10): class probabilities, confidence, coordinates (cell
+    offsets and square roots of the sizes), area, upper left and bottom
+    right corners of the box of each cell, the same for every prior.
+    # Arguments
+        batch_gt: GT boxes ([class, x, y, w, h] rows, relative to the image)
+            of each image.
+        image_shape: Shape (channels, rows, cols) of the images.
+        num_classes: Number of classes.
+        num_priors: Number of priors.
+    """
+    h = image_shape[1] // 32
+    w = image_shape[2] // 32
     c = num_classes
     b = num_priors  # TODO pass num_priors
     batch_size = len(batch_gt)
-    batch_y = np.zeros([batch_size, h * w, b, c + 4 + 1 + 1 + 2 + 2])
-
-    cellx = 32
-    celly = 32
-    for i, gt in enumerate(batch_gt):
-        if gt.shape[0] == 0:
-            # if there are no objects we'll get NaNs on YOLOLoss, set everything to one!
-            # TODO check if the following line harms learning in case of
-            #      having lots of images with no objects
-            batch_y[i] = np.ones((h * w, b, c + 4 + 1 + 1 + 2 + 2))
-            continue
-        objects = gt.tolist()
-        for obj in objects:
-            centerx = obj[1] * image_shape[2]
-            centery = obj[2] * image_shape[1]
-            cx = centerx / cellx
-            cy = centery / celly
-            obj[1] = cx - np.floor(cx)  # centerx
-            obj[2] = cy - np.floor(cy)  # centerx
-            obj[3] = np.sqrt(obj[3])
-            obj[4] = np.sqrt(obj[4])
-            obj += [int(np.floor(cy) * w + np.floor(cx))]
-
-        probs = np.zeros([h * w, b, c])
-        confs = np.zeros([h * w, b, 1])
-        coord = np.zeros([h * w, b, 4])
-        prear = np.zeros([h * w, 4])
-
-        for obj in objects:
-            probs[obj[5], :, :] = [[0.] * c] * b
-            probs[obj[5], :, int(obj[0])] = 1.
-            coord[obj[5], :, :] = [obj[1:5]] * b
-            prear[obj[5], 0] = obj[1] - obj[3] ** 2 * .5 * w  # xleft
-            prear[obj[5], 1] = obj[2] - obj[4] ** 2 * .5 * h  # yup
-            prear[obj[5], 2] = obj[1] + obj[3] ** 2 * .5 * w  # xright
-            prear[obj[5], 3] = obj[2] + obj[4] ** 2 * .5 * h  # ybot
-            confs[obj[5], :, 0] = [1.] * b
-
-        upleft = np.expand_dims(prear[:, 0:2], 1)
-        botright = np.expand_dims(prear[:, 2:4], 1)
-        wh = botright - upleft
-        area = wh[:, :, 0] * wh[:, :, 1]
-        upleft = np.concatenate([upleft] * b, 1)
-        botright = np.concatenate([botright] * b, 1)
-        areas = np.concatenate([area] * b, 1)
-
-        batch_y[i, :] = np.concatenate((probs, confs, coord, areas[:, :, np.newaxis], upleft, botright), axis=2)
+    batch_y = np.zeros([batch_size, h * w, b, c + 4 + 1 + 1 + 2 + 2],
+                       dtype=np.float32)
+
+    # if there are no objects we'll get NaNs on YOLOLoss, set everything to one!
+    # TODO check if the following line harms learning in case of
+    #      having lots of images with no objects
+    counts = np.array([len(gt) for gt in batch_gt], dtype=np.int64)
+    batch_y[counts == 0] = 1.
+    if not np.any(counts):
+        return batch_y
+
+    gt = np.concatenate([np.asarray(g, dtype=np.float64).reshape(-1, 5)
+                         for g in batch_gt])
+    images = np.repeat(np.arange(batch_size), counts)
+
+    # Cell of every object and offset of its center in the cell
+    cx = gt[:, 1] * image_shape[2] / 32.
+    cy = gt[:, 2] * image_shape[1] / 32.
+    cells = (np.floor(cy) * w + np.floor(cx)).astype(np.int64)
+    coord = np.stack((cx - np.floor(cx), cy - np.floor(cy),
+                      np.sqrt(gt[:, 3]), np.sqrt(gt[:, 4])), axis=1)
+
+    # The last object of a cell sets its targets
+    keys = images * (h * w) + cells
+    _, last = np.unique(keys[::-1], return_index=True)
+    last = len(keys) - 1 - last
+    images, cells, coord = images[last], cells[last], coord[last]
+    classes = gt[last, 0].astype(np.int64)
+
+    # Corners and area of the boxes, in cells
+    half_w = coord[:, 2] ** 2 * .5 * w
+    half_h = coord[:, 3] ** 2 * .5 * h
+    upleft = np.stack((coord[:, 0] - half_w, coord[:, 1] - half_h), axis=1)
+    botright = np.stack((coord[:, 0] + half_w, coord[:, 1] + half_h), axis=1)
+    wh = botright - upleft
+    area = wh[:, 0] * wh[:, 1]
+
+    # Scatter the targets of the cells, broadcast to the priors
+    targets = batch_y[images, cells]
+    targets[np.arange(len(classes)), :, classes] = 1.
+    targets[:, :, c] = 1.
+    targets[:, :, c + 1:c + 5] = coord[:, np.newaxis]
+    targets[:, :, c + 5] = area[:, np.newaxis]
+    targets[:, :, c + 6:c + 8] = upleft[:, np.newaxis]
+    targets[:, :, c + 8:c + 10] = botright[:, np.newaxis]
+    batch_y[images, cells] = targets
 
     return batch_y
 
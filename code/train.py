@@ -31,7 +31,7 @@ def process(cf):
 
     # Create the callbacks
     print ('\n > Creating callbacks...')
-    cb = Callbacks_Factory().make(cf, valid_gen)
+    cb = Callbacks_Factory().make(cf, valid_gen, train_gen)
 
     if cf.train_model:
         # Train the model
@@ -49,6 +49,11 @@ def process(cf):
         # Compute test metrics
         model.predict(test_gen, tag='pred')
 
+    # Stop the data generators
+    for gen in (train_gen, valid_gen, test_gen):
+        if gen is not None:
+            gen.close()
+
     # Finish
     print (' ---> Finish experiment: ' + cf.exp_name + ' <---')
 